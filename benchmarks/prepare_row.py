@@ -0,0 +1,51 @@
+"""
+Time how long events take to serialise for insertion, as every write path serialises them, against
+sending every value as a string, as pawprint did before values were sent natively.
+
+    PYTHONPATH=. python benchmarks/prepare_row.py [events] [repeats]
+
+Nothing is written to a database.
+"""
+
+import json
+import sys
+import timeit
+from datetime import datetime
+
+from pawprint.serialize import json_encoder
+from pawprint.tracker import _JSON, _TEXT, _serialize
+
+# The default schema's kinds of column, and a typical event
+KINDS = {"event": _TEXT, "user_id": _TEXT, "metadata": _JSON}
+EVENT = {
+    "event": "logged_in",
+    "user_id": 12345,
+    "timestamp": datetime(2017, 1, 1, 12, 30, 15),
+    "metadata": {"val": 3, "tags": ["x", "y"], "ok": True},
+}
+
+
+def as_strings(data):
+    return [json.dumps(value) if isinstance(value, (dict, list)) else str(value) for value in data]
+
+
+def by_column(data, encode_json):
+    return [_serialize(value, KINDS.get(field), encode_json) for field, value in data.items()]
+
+
+def main(events=100000, repeats=5):
+    cases = [("strings", lambda: as_strings(EVENT.values()))]
+    for name in ("json", "orjson"):
+        try:
+            encode_json = json_encoder(name)
+        except ImportError:
+            continue
+        cases.append((name, lambda encode_json=encode_json: by_column(EVENT, encode_json)))
+
+    for name, case in cases:
+        best = min(timeit.repeat(case, number=events, repeat=repeats))
+        print("{:<8} {:>8.0f} ns per event".format(name, best / events * 1e9))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
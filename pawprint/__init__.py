@@ -1,2 +1,3 @@
 from pawprint.tracker import Tracker
+from pawprint.async_tracker import AsyncTracker
 from pawprint.statistics import Statistics
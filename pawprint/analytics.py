@@ -0,0 +1,147 @@
+try:
+    import duckdb
+except ImportError:  # pragma: no cover
+    duckdb = None
+
+from pawprint import arrow
+
+
+def sessionize(engine, query, params, duration):
+    """
+    Split the events returned by a query, with event_id, user_id and timestamp columns, into
+    sessions inside an embedded DuckDB. Events are copied from PostgreSQL into Arrow and queried
+    in place, so they never pass through pandas, and the window functions run on every core.
+
+    Returns a DataFrame of sessions, and a DataFrame mapping each event to its session, as
+    statistics._sessionize does.
+    """
+
+    connection = _connect()
+    try:
+        connection.register("events", arrow.read_table(engine, query, params))
+        connection.execute(_SESSIONS_QUERY, [duration])
+        sessions = connection.execute(
+            "SELECT session_timestamp AS timestamp, user_id, "
+            + _SECONDS.format("MAX(timestamp) - MIN(timestamp)")
+            + " / 60.0 AS duration, COUNT(*) AS total_events "
+            "FROM numbered GROUP BY user_id, session_number, session_timestamp "
+            "ORDER BY session_timestamp"
+        ).df()
+        event_session_map = connection.execute(
+            "SELECT event_id, user_id, timestamp, session_timestamp FROM numbered "
+            "ORDER BY session_timestamp"
+        ).df()
+    finally:
+        connection.close()
+
+    return sessions, event_session_map
+
+
+def engagement(engine, sessions_query, params, start, min_sessions=0, counts_query=None):
+    """
+    Calculate DAU, WAU and MAU for every day after start inside an embedded DuckDB, from the
+    sessions returned by a query, with user_id and timestamp columns. These must include the 30
+    days before start, so that the first weekly and monthly windows are complete. If
+    min_sessions is set, counts_query returns every user's total number of sessions, with user_id
+    and sessions columns, and the counts are repeated for the users with at least that many.
+
+    Returns a DataFrame indexed by date, or None if there are no days to calculate.
+    """
+
+    connection = _connect()
+    try:
+        connection.register("recent_sessions", arrow.read_table(engine, sessions_query, params))
+
+        # If no users have enough sessions, turn off min_sessions calculations
+        if min_sessions:
+            connection.register("counts", arrow.read_table(engine, counts_query, params))
+            active = connection.execute(
+                "SELECT COUNT(*) FROM counts WHERE sessions >= ?", [min_sessions]
+            ).fetchone()[0]
+            if not active:
+                min_sessions = 0
+
+        if min_sessions:
+            connection.execute(
+                "CREATE TEMPORARY TABLE sessions AS "
+                "SELECT s.user_id, s.timestamp, COALESCE(c.sessions >= ?, FALSE) AS active "
+                "FROM recent_sessions s LEFT JOIN counts c ON c.user_id = s.user_id",
+                [min_sessions],
+            )
+        else:
+            connection.execute(
+                "CREATE TEMPORARY TABLE sessions AS "
+                "SELECT user_id, timestamp, FALSE AS active FROM recent_sessions"
+            )
+
+        stickiness = connection.execute(_ENGAGEMENT_QUERY, {"start": start}).df()
+    finally:
+        connection.close()
+
+    if not len(stickiness):
+        return None
+
+    stickiness = stickiness.set_index("timestamp")
+    if not min_sessions:
+        stickiness = stickiness.drop(["dau_active", "wau_active", "mau_active"], axis=1)
+
+    return stickiness
+
+
+def _connect():
+    if duckdb is None:
+        raise ImportError("DuckDB support requires duckdb : pip install duckdb")
+    return duckdb.connect()
+
+
+# Like pandas' Timedelta.seconds, which the pandas method uses, this ignores whole days
+_SECONDS = "(CAST(FLOOR(epoch({})) AS BIGINT) % 86400)"
+
+# Flag the events that start a new session, number sessions with a running sum, and find the
+# start of each event's session, as statistics._SESSIONS_QUERY does in PostgreSQL
+_SESSIONS_QUERY = (
+    "CREATE TEMPORARY TABLE numbered AS "
+    "WITH flagged AS ("
+    "    SELECT event_id, user_id, timestamp, "
+    "        CASE WHEN LAG(timestamp) OVER w IS NULL THEN 1 "
+    "        WHEN " + _SECONDS.format("timestamp - LAG(timestamp) OVER w") + " / 60.0 > ? THEN 1 "
+    "        ELSE 0 END AS new_session "
+    "    FROM events WHERE user_id IS NOT NULL "
+    "    WINDOW w AS (PARTITION BY user_id ORDER BY timestamp, event_id)"
+    "), sessions AS ("
+    "    SELECT event_id, user_id, timestamp, SUM(new_session) OVER ("
+    "        PARTITION BY user_id ORDER BY timestamp, event_id ROWS UNBOUNDED PRECEDING"
+    "    ) AS session_number FROM flagged"
+    ") "
+    "SELECT event_id, user_id, timestamp, session_number, "
+    "    MIN(timestamp) OVER (PARTITION BY user_id, session_number) AS session_timestamp "
+    "FROM sessions"
+)
+
+# For every day from the first to the last with sessions after start, count the distinct users
+# with sessions that day, and in the weekly and monthly windows ending on it, as
+# statistics._rolling_distinct defines them
+_ENGAGEMENT_QUERY = (
+    "WITH days AS ("
+    "    SELECT date_trunc('day', MIN(timestamp)) AS first, "
+    "        date_trunc('day', MAX(timestamp)) AS last "
+    "    FROM sessions WHERE timestamp > $start"
+    "), dates AS ("
+    "    SELECT range AS timestamp FROM days, range(days.first, days.last + INTERVAL 1 DAY, "
+    "        INTERVAL 1 DAY)"
+    ") "
+    "SELECT d.timestamp, "
+    "    COUNT(DISTINCT s.user_id) FILTER (WHERE s.timestamp > $start "
+    "        AND date_trunc('day', s.timestamp) = d.timestamp) AS dau, "
+    "    COUNT(DISTINCT s.user_id) FILTER (WHERE s.timestamp > $start "
+    "        AND date_trunc('day', s.timestamp) = d.timestamp AND s.active) AS dau_active, "
+    "    COUNT(DISTINCT s.user_id) FILTER (WHERE s.timestamp > d.timestamp - INTERVAL 6 DAY) "
+    "        AS wau, "
+    "    COUNT(DISTINCT s.user_id) AS mau, "
+    "    COUNT(DISTINCT s.user_id) FILTER (WHERE s.timestamp > d.timestamp - INTERVAL 6 DAY "
+    "        AND s.active) AS wau_active, "
+    "    COUNT(DISTINCT s.user_id) FILTER (WHERE s.active) AS mau_active "
+    "FROM dates d LEFT JOIN sessions s ON s.timestamp > d.timestamp - INTERVAL 29 DAY "
+    "    AND s.timestamp <= d.timestamp + INTERVAL 1 DAY "
+    "GROUP BY d.timestamp ORDER BY d.timestamp"
+)
@@ -0,0 +1,142 @@
+import os
+import tempfile
+
+try:
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.dataset
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+# PostgreSQL's built-in type OIDs
+_BOOL, _INT8, _INT2, _INT4, _FLOAT4, _FLOAT8, _NUMERIC = 16, 20, 21, 23, 700, 701, 1700
+_DATE, _TIMESTAMP, _TIMESTAMPTZ = 1082, 1114, 1184
+
+# Arrow reads COPY's output in blocks of this many bytes
+_BLOCK_SIZE = 16 * 1024**2
+
+
+def read_table(engine, query, params=None):
+    """Run a query and return the results as an Arrow table."""
+    spool, options = _copy(engine, query, params)
+    with spool:
+        if _empty(spool):  # Arrow can't read an empty CSV file
+            return _schema(options).empty_table()
+        return pyarrow.csv.read_csv(spool, **options)
+
+
+def write_parquet(engine, query, path, params=None, partition_by=None):
+    """
+    Run a query and write the results to a Parquet dataset at path, partitioned on the
+    partition_by column if it's given. Results are streamed from disk in blocks, so they needn't
+    fit in memory.
+
+    Returns the number of rows written.
+    """
+
+    spool, options = _copy(engine, query, params)
+    with spool:
+        if _empty(spool):
+            return 0
+        reader = pyarrow.csv.open_csv(spool, **options)
+        written = [0]
+
+        def batches():
+            for batch in reader:
+                written[0] += batch.num_rows
+                yield batch
+
+        pyarrow.dataset.write_dataset(
+            batches(),
+            path,
+            schema=reader.schema,
+            format="parquet",
+            partitioning=[partition_by] if partition_by else None,
+            partitioning_flavor="hive" if partition_by else None,
+            existing_data_behavior="overwrite_or_ignore",
+        )
+
+    return written[0]
+
+
+def _copy(engine, query, params):
+    """
+    Stream the results of a query as CSV from PostgreSQL's COPY TO into a temporary file, and work
+    out how Arrow should parse each column from its type.
+
+    Returns the file and the options to read it with.
+    """
+
+    if pyarrow is None:
+        raise ImportError("Arrow support requires pyarrow : pip install pyarrow")
+
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            query = cursor.mogrify(query, params).decode()
+
+            # Find the name and type of each column
+            cursor.execute("SELECT * FROM ({}) AS q LIMIT 0".format(query))
+            columns = [(column.name, column.type_code) for column in cursor.description]
+
+            # Timestamps with time zones are sent in UTC, as Arrow can't parse PostgreSQL's offsets
+            select = ", ".join(
+                (
+                    'q."{0}" AT TIME ZONE \'UTC\' AS "{0}"'.format(name)
+                    if type_code == _TIMESTAMPTZ
+                    else 'q."{}"'.format(name)
+                )
+                for name, type_code in columns
+            )
+            spool = tempfile.TemporaryFile()
+            cursor.copy_expert(
+                "COPY (SELECT {} FROM ({}) AS q) TO STDOUT WITH (FORMAT csv)".format(select, query),
+                spool,
+            )
+        connection.rollback()
+    finally:
+        connection.close()
+
+    spool.seek(0)
+    options = dict(
+        read_options=pyarrow.csv.ReadOptions(
+            column_names=[name for name, _ in columns], block_size=_BLOCK_SIZE
+        ),
+        parse_options=pyarrow.csv.ParseOptions(newlines_in_values=True),
+        convert_options=pyarrow.csv.ConvertOptions(
+            column_types={name: _arrow_type(type_code) for name, type_code in columns},
+            null_values=[""],
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=False,  # COPY quotes empty strings, but not NULLs
+            true_values=["t"],
+            false_values=["f"],
+        ),
+    )
+    return spool, options
+
+
+def _empty(spool):
+    return os.fstat(spool.fileno()).st_size == 0
+
+
+def _schema(options):
+    """The Arrow schema of the columns that _copy's options read."""
+    types = options["convert_options"].column_types
+    return pyarrow.schema([(name, types[name]) for name in options["read_options"].column_names])
+
+
+def _arrow_type(type_code):
+    """The Arrow type for a PostgreSQL type; anything unusual, including JSON, is kept as text."""
+    types = {
+        _BOOL: pyarrow.bool_(),
+        _INT2: pyarrow.int16(),
+        _INT4: pyarrow.int32(),
+        _INT8: pyarrow.int64(),
+        _FLOAT4: pyarrow.float32(),
+        _FLOAT8: pyarrow.float64(),
+        _NUMERIC: pyarrow.float64(),
+        _DATE: pyarrow.date32(),
+        _TIMESTAMP: pyarrow.timestamp("us"),
+        _TIMESTAMPTZ: pyarrow.timestamp("us", tz="UTC"),
+    }
+    return types.get(type_code, pyarrow.string())
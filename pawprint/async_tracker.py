@@ -0,0 +1,330 @@
+import asyncio
+import json
+import re
+from datetime import datetime
+from warnings import warn
+
+import pandas as pd
+
+from pawprint.dialects import to_positional
+from pawprint.serialize import json_encoder
+from pawprint.tracker import _MAX_INSERT_QUERIES, Tracker, _load_config, _widen
+
+try:
+    import asyncpg
+except ImportError:  # pragma: no cover
+    asyncpg = None
+
+
+# PostgreSQL types whose parameters we convert from other Python types
+_TEXT_TYPES = ("text", "varchar", "bpchar", "name")
+_TIMESTAMP_TYPES = ("timestamp", "timestamptz")
+_INTEGER_TYPES = ("int2", "int4", "int8")
+_FLOAT_TYPES = ("float4", "float8")
+
+# Tracker options for features that AsyncTracker doesn't have
+_SYNC_ONLY_OPTIONS = (
+    "buffer_size",
+    "buffer_age",
+    "background",
+    "queue_size",
+    "backpressure",
+    "spill_path",
+    "spool_path",
+    "spool_mode",
+    "spool_max_bytes",
+    "spool_interval",
+    "cache_size",
+    "cache_ttl",
+    "prepare",
+    "pool_size",
+    "max_overflow",
+    "pool_pre_ping",
+)
+
+
+def _sync_only(name):
+    """A method that AsyncTracker can't run, as it would block the event loop."""
+
+    def method(self, *args, **kwargs):
+        raise NotImplementedError(
+            "AsyncTracker doesn't support .{}(); use a Tracker on the same table.".format(name)
+        )
+
+    return method
+
+
+class AsyncTracker(Tracker):
+    """
+    This class provides the Tracker interface for asyncio applications. Writes, reads and
+    aggregates are coroutines that run on a pool of asyncpg connections, so tracking events never
+    blocks the event loop. Methods that only a synchronous Tracker supports, like .write_many()
+    and .events, raise NotImplementedError.
+    """
+
+    def __init__(self, **kwargs):
+
+        if asyncpg is None:
+            raise ImportError("AsyncTracker requires asyncpg : pip install asyncpg")
+
+        # Parse inputs by merging config files and locally-passed arguments
+        config = _load_config(kwargs)
+        unsupported = [
+            option for option in _SYNC_ONLY_OPTIONS if config.get(option) not in (None, False)
+        ]
+        if unsupported:
+            raise NotImplementedError(
+                "AsyncTracker doesn't support {}; use a Tracker for those.".format(
+                    ", ".join(unsupported)
+                )
+            )
+
+        # Save the database properties
+        self._configure(config)
+
+        # Connection pool properties; the pool is created when it's first used
+        self.min_pool_size = config.get("min_pool_size", 1)
+        self.max_pool_size = config.get("max_pool_size", 10)
+        self._pool = None
+        self._pool_lock = None
+
+        # Writes go straight to the database. Queries run through asyncpg's statement cache, and
+        # the types of their parameters and names of their columns are kept here
+        self.buffer_size = None
+        self.buffer_age = None
+        self._buffer = []
+        self._buffer_time = None
+        self._writer = None
+        self.spool_mode = "fallback"
+        self._spool = None
+        self.prepare = False
+        self._insert_queries = {}
+        self._query_types = {}
+        self._encode_json = json_encoder(config.get("json_encoder", None))
+
+        # Results aren't cached, and there's no synchronous engine
+        self._cache = None
+        self.engine = None
+
+    # These need a synchronous connection
+    events = property(_sync_only("events"))
+    write_many = _sync_only("write_many")
+    write_dataframe = _sync_only("write_dataframe")
+    read_iter = _sync_only("read_iter")
+    read_arrow = _sync_only("read_arrow")
+    export_parquet = _sync_only("export_parquet")
+    maintain_partitions = _sync_only("maintain_partitions")
+    refresh_rollups = _sync_only("refresh_rollups")
+
+    async def create_table(self, indexes=False):
+        """
+        Create a database with the correct schema. If indexes is True, the timestamp, user and
+        event fields get B-tree indexes and the JSON field a GIN index. Partitioned tables are
+        created with a Tracker.
+        """
+
+        if self.partition is not None:
+            raise NotImplementedError("Partitioned tables can only be created by a Tracker.")
+
+        await self.query(self._create_table_query())
+        if indexes:
+            for query in self._index_queries():
+                await self.query(query)
+
+    async def drop_table(self):
+        """Delete an existing table."""
+        try:
+            await self.query("DROP TABLE {}".format(self.table))
+        except asyncpg.PostgresError:
+            warn("Table drop unsuccessful. Check that table exists.")
+            raise
+
+    async def write(self, **data):
+        """Send a generic event to the user metrics database."""
+
+        # If we're autopopulating a timestamp and it isn't provided, add it
+        if self.auto_timestamp and self.timestamp_field not in data:
+            data[self.timestamp_field] = datetime.now()
+
+        fields = ", ".join(data.keys())
+        placeholders = ", ".join("${}".format(i + 1) for i in range(len(data)))
+        query = "INSERT INTO {table} ({fields}) VALUES ({placeholders});".format(
+            table=self.table, fields=fields, placeholders=placeholders
+        )
+        values = list(data.values())
+
+        try:
+            pool = await self._get_pool()
+            async with pool.acquire() as connection:
+                await self._fetch(connection, query, values)
+
+        # If the write fails, raise the exception
+        except Exception as exception:
+            if self.db is not None:  # If db is None, fail silently. Otherwise, raise the error
+                query = re.sub(r"\$\d+", "%s", query)
+                self._log_write_failure(query, values, exception)
+                raise
+
+    async def read(self, *fields, **conditionals):
+        """
+        Pull raw data into a dataframe. If no conditions are passed, pull the whole table.
+        Otherwise, filter based on the conditions specified.
+        """
+        query, params = self._read_query(*fields, **conditionals)
+        return await self._read_sql(query, params)
+
+    async def count(self, count_field="*", resolution="day", start=None, end=None, **conditionals):
+        """Count events of a given type."""
+        return await self._aggregate("COUNT", resolution, start, end, count_field, **conditionals)
+
+    async def sum(self, sum_field, resolution="day", start=None, end=None, **conditionals):
+        """Sum numerical values of events of a given type."""
+        return await self._aggregate("SUM", resolution, start, end, sum_field, **conditionals)
+
+    async def average(self, avg_field, resolution="day", start=None, end=None, **conditionals):
+        """Average events of a given type."""
+        return await self._aggregate("AVG", resolution, start, end, avg_field, **conditionals)
+
+    async def aggregate(
+        self, resolution="day", aggs=None, by=(), start=None, end=None, wide=False, **conditionals
+    ):
+        """Calculate several aggregates of events in a single scan, as Tracker.aggregate() does."""
+        query = self._aggregates_query(resolution, aggs, by, start, end, wide, **conditionals)
+        return _widen(await self._read_sql(*query.compile()), by, wide)
+
+    async def query(self, query):
+        """User-defined SQL query."""
+        pool = await self._get_pool()
+        async with pool.acquire() as connection:
+            return await connection.fetch(query)
+
+    async def flush(self):
+        """Writes aren't queued, so there's nothing to flush."""
+
+    async def close(self):
+        """Close the connection pool."""
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def _aggregate(self, agg_operation, resolution, start, end, agg_field, **conditionals):
+        """
+        Aggregate events into a dataframe, between a date range, at a given temporal resolution.
+        """
+        query, params = self._aggregate_query(
+            agg_operation, resolution, start, end, agg_field, **conditionals
+        )
+        return await self._read_sql(query, params)
+
+    async def _read_sql(self, query, params=None):
+        """Run a query with psycopg2-style parameters and return the results as a DataFrame."""
+
+        args = []
+        if params:
+            query, args = to_positional(query, params)
+
+        pool = await self._get_pool()
+        async with pool.acquire() as connection:
+            rows, columns = await self._fetch(connection, query, args)
+
+        return pd.DataFrame.from_records([tuple(row) for row in rows], columns=columns)
+
+    async def _fetch(self, connection, query, args):
+        """
+        Run a query with $n parameters and return its rows and the names of its columns. asyncpg
+        caches the statement on each connection; the first time the tracker runs a query, it's
+        prepared to learn the types of its parameters, which arguments are converted to.
+        """
+
+        types = self._query_types.get(query)
+        if types is None:
+            statement = await connection.prepare(query)
+            types = (
+                [parameter.name for parameter in statement.get_parameters()],
+                [attribute.name for attribute in statement.get_attributes()],
+            )
+            if len(self._query_types) >= _MAX_INSERT_QUERIES:
+                self._query_types.clear()
+            self._query_types[query] = types
+
+        parameters, columns = types
+        try:
+            rows = await connection.fetch(
+                query, *_coerce_arguments(parameters, args, self._encode_json)
+            )
+        except Exception:
+            # The table may have changed, so learn its types again next time
+            self._query_types.pop(query, None)
+            raise
+
+        return rows, columns
+
+    async def _get_pool(self):
+        """Create the connection pool if it doesn't exist yet, and return it."""
+
+        if self.db is None:
+            raise ValueError("AsyncTracker has no database to connect to.")
+
+        if self._pool is None:
+            if self._pool_lock is None:
+                self._pool_lock = asyncio.Lock()
+            async with self._pool_lock:
+                if self._pool is None:
+                    self._pool = await asyncpg.create_pool(
+                        _asyncpg_dsn(self.db),
+                        min_size=self.min_pool_size,
+                        max_size=self.max_pool_size,
+                        init=self._init_connection,
+                    )
+
+        return self._pool
+
+    async def _init_connection(self, connection):
+        """Encode and decode JSON fields as Python objects on every new connection."""
+        for json_type in ("json", "jsonb"):
+            await connection.set_type_codec(
+                json_type, encoder=self._encode_json_field, decoder=json.loads, schema="pg_catalog"
+            )
+
+    def _encode_json_field(self, value):
+        """Strings are assumed to already be JSON; everything else gets encoded."""
+        if isinstance(value, str):
+            return value
+        return self._encode_json(value)
+
+    def __repr__(self):
+        return "pawprint.AsyncTracker on table '{}' and database '{}'".format(self.table, self.db)
+
+    def __str__(self):
+        return (
+            "pawprint AsyncTracker object.\n" "db : {}\n" "table : {}".format(self.db, self.table)
+        )
+
+
+def _asyncpg_dsn(db):
+    """Strip the SQLAlchemy driver, as in postgresql+psycopg2://, from a connection string."""
+    return re.sub(r"^postgres(ql)?\+\w+://", "postgresql://", db)
+
+
+def _coerce_arguments(parameters, args, encode_json):
+    """
+    asyncpg requires arguments to match the types of their parameters exactly. Convert arguments
+    in the same way that PostgreSQL would interpret a quoted literal, so that AsyncTracker accepts
+    the same values as Tracker.
+    """
+
+    coerced = []
+    for parameter, value in zip(parameters, args):
+        if value is None:
+            pass
+        elif parameter in _TEXT_TYPES and not isinstance(value, str):
+            value = encode_json(value) if isinstance(value, dict) else str(value)
+        elif parameter in _TIMESTAMP_TYPES and not isinstance(value, datetime):
+            value = pd.Timestamp(value).to_pydatetime()
+        elif parameter in _INTEGER_TYPES and isinstance(value, str):
+            value = int(value)
+        elif parameter in _FLOAT_TYPES and isinstance(value, str):
+            value = float(value)
+        coerced.append(value)
+
+    return coerced
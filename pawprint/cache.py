@@ -0,0 +1,79 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+class QueryCache(object):
+    """
+    This class caches the results of queries, as DataFrames, in memory. The least recently used
+    results are evicted to stay within max_bytes, and results expire after a time to live.
+    """
+
+    def __init__(self, max_bytes=64 * 1024**2, ttl=60):
+
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+
+        # Counters for monitoring
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+        # Keys map to (result, size, expiry), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return a cached result, or None if there isn't one that's still fresh."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] < time.monotonic():
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return entry[0]
+
+    def put(self, key, result, ttl=None):
+        """Cache a result, evicting the least recently used results to make room for it."""
+
+        size = int(result.memory_usage(index=True, deep=True).sum())
+        if size > self.max_bytes:
+            return
+
+        expiry = time.monotonic() + (self.ttl if ttl is None else ttl)
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            while self.size + size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.counters["evictions"] += 1
+            self._entries[key] = (result, size, expiry)
+            self.size += size
+
+    def invalidate(self):
+        """Forget every cached result."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        self.size -= self._entries.pop(key)[1]
+
+
+def cache_key(query, params):
+    """Key a query on its SQL, ignoring differences in whitespace, and its parameters."""
+    query = re.sub(r"\s+", " ", query).strip()
+    if not params:
+        return query, ()
+    return query, tuple(sorted((name, repr(value)) for name, value in params.items()))
@@ -0,0 +1,350 @@
+import json
+import math
+import re
+from datetime import date, datetime, time
+from decimal import Decimal
+
+import pandas as pd
+import psycopg2
+from psycopg2.extras import execute_values
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import InterfaceError, OperationalError
+
+from pawprint.serialize import NATIVE_TYPES
+
+
+class PostgresDialect(object):
+    """
+    This class builds the parts of pawprint's SQL that differ between databases, as PostgreSQL
+    writes them. Queries are written with psycopg2's parameter style, %(name)s and %s.
+    """
+
+    name = "postgresql"
+
+    # Errors that mean the database can't be reached, rather than that an event can't be written
+    unavailable = (
+        OperationalError,
+        InterfaceError,
+        psycopg2.OperationalError,
+        psycopg2.InterfaceError,
+    )
+
+    def create_engine(self, db, **pool_settings):
+        return create_engine(db, **pool_settings)
+
+    def query(self, query):
+        """Convert a query to the driver's parameter style."""
+        return query
+
+    def adapt(self, value):
+        """Convert a value the driver can't send as it is."""
+        return value
+
+    def schema_type(self, field_type):
+        """Translate a PostgreSQL type from a tracker's schema."""
+        return field_type
+
+    def json_path(self, field, path, mode):
+        """
+        Traverse a JSON field. The mode is "json" to return JSON, "text" to return text, or
+        "value" to return something that can be compared with a value.
+        """
+        operator = "#>>" if mode == "text" else "#>"
+        return "{} {} '{{{}}}'".format(field, operator, ", ".join(path))
+
+    def text(self, expression):
+        return "{}::text".format(expression)
+
+    def float(self, expression):
+        return "({})::float".format(expression)
+
+    def date_trunc(self, resolution, timestamp):
+        """Truncate timestamps to a resolution, which is passed as the resolution parameter."""
+        return "date_trunc(%(resolution)s, {})".format(timestamp)
+
+    def contains(self, field, name):
+        """Whether a JSON field has a key, or an array element, passed as a parameter."""
+        return "{} ? %({})s".format(field, name)
+
+    def any(self, field, name, values, params, cast=None):
+        """
+        Whether a field is one of values, which are sent as a single array parameter of text. If
+        cast is the field's type, the array is cast to it, so the field's indexes can be used.
+        """
+        params[name] = values
+        if cast is not None:
+            return "{} = ANY(CAST(%({})s AS TEXT[])::{}[])".format(field, name, cast)
+        return "{} = ANY(%({})s)".format(field, name)
+
+    def compare_value(self, value):
+        """A value to compare with, in >, >=, < or <= conditions."""
+        return text_parameter(value)
+
+    def percentile(self, fraction, expression):
+        """The continuous percentile of an expression, as an aggregate."""
+        return "percentile_cont({}) WITHIN GROUP (ORDER BY {})".format(fraction, expression)
+
+    def decode(self, results, timestamps=(), json_fields=()):
+        """Convert the columns of a query's results that the driver returns as text."""
+        return results
+
+    def insert_many(self, connection, table, fields, rows):
+        """Insert rows of values with a multi-row INSERT, on a raw connection, without committing."""
+        query = "INSERT INTO {} ({}) VALUES %s;".format(table, ", ".join(fields))
+        with connection.cursor() as cursor:
+            execute_values(cursor, query, rows, page_size=len(rows))
+
+    def load(self, connection, table, fields, rows, encode_json):
+        """
+        Bulk-load an iterable of rows of values with COPY FROM STDIN, on a raw connection, without
+        committing. Rows are streamed to the database as they're consumed.
+        """
+        query = "COPY {} ({}) FROM STDIN".format(table, ", ".join(fields))
+        lines = ("\t".join(_copy_text(value, encode_json) for value in row) + "\n" for row in rows)
+        with connection.cursor() as cursor:
+            cursor.copy_expert(query, _IteratorFile(lines))
+
+
+class SQLiteDialect(PostgresDialect):
+    """
+    This class builds SQL for SQLite, so that trackers can keep events in a local file. JSON
+    fields are stored as text and traversed with SQLite's JSON functions, and timestamps are
+    stored as ISO-8601 text.
+    """
+
+    name = "sqlite"
+
+    # SQLite is embedded, so it's never unavailable
+    unavailable = ()
+
+    # strftime formats to truncate timestamps to each resolution, with percent signs escaped as in
+    # any query; weeks start on Monday
+    resolutions = {
+        "second": "strftime('%%Y-%%m-%%d %%H:%%M:%%S', {})",
+        "minute": "strftime('%%Y-%%m-%%d %%H:%%M:00', {})",
+        "hour": "strftime('%%Y-%%m-%%d %%H:00:00', {})",
+        "day": "strftime('%%Y-%%m-%%d 00:00:00', {})",
+        "week": "strftime('%%Y-%%m-%%d 00:00:00', {}, 'weekday 0', '-6 days')",
+        "month": "strftime('%%Y-%%m-01 00:00:00', {})",
+        "quarter": (
+            "printf('%%s-%%02d-01 00:00:00', strftime('%%Y', {0}), "
+            "(CAST(strftime('%%m', {0}) AS INTEGER) - 1) / 3 * 3 + 1)"
+        ),
+        "year": "strftime('%%Y-01-01 00:00:00', {})",
+    }
+
+    def create_engine(self, db, **pool_settings):
+        """SQLite manages its own connections, and writes through a write-ahead log."""
+
+        engine = create_engine(db)
+
+        @event.listens_for(engine, "connect")
+        def connect(connection, record):
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA busy_timeout=5000")
+
+        return engine
+
+    def query(self, query):
+        return _PLACEHOLDERS.sub(_sqlite_placeholder, query)
+
+    def adapt(self, value):
+        if isinstance(value, datetime):
+            return value.isoformat(" ")
+        if isinstance(value, (date, time)):
+            return value.isoformat()
+        if isinstance(value, Decimal):
+            return str(value)
+        return value
+
+    def schema_type(self, field_type):
+        """SERIAL keys become SQLite's auto-incrementing integer keys, and JSON is kept as text."""
+        field_type = re.sub(
+            r"(?i)^SERIAL PRIMARY KEY$", "INTEGER PRIMARY KEY AUTOINCREMENT", field_type
+        )
+        field_type = re.sub(r"(?i)^(BIG|SMALL)?SERIAL\b", "INTEGER", field_type)
+        return re.sub(r"(?i)^JSONB?\b", "TEXT", field_type)
+
+    def json_path(self, field, path, mode):
+        path = "$" + "".join(
+            "[{}]".format(key) if key.isdigit() else ".{}".format(key) for key in path
+        )
+        if mode == "json":
+            return "{} -> '{}'".format(field, path)
+        if mode == "text":
+            return "CAST({} ->> '{}' AS TEXT)".format(field, path)
+        return "{} ->> '{}'".format(field, path)
+
+    def text(self, expression):
+        return "CAST({} AS TEXT)".format(expression)
+
+    def float(self, expression):
+        return "CAST({} AS REAL)".format(expression)
+
+    def date_trunc(self, resolution, timestamp):
+        if resolution not in self.resolutions:
+            raise ValueError("resolution must be one of {}".format(", ".join(self.resolutions)))
+        return self.resolutions[resolution].format(timestamp)
+
+    def contains(self, field, name):
+        return (
+            "EXISTS (SELECT 1 FROM json_each({}) AS element "
+            "WHERE element.key = %({name})s OR element.value = %({name})s)".format(field, name=name)
+        )
+
+    def any(self, field, name, values, params, cast=None):
+        names = []
+        for i, value in enumerate(values):
+            names.append("%({}_{})s".format(name, i))
+            params["{}_{}".format(name, i)] = value
+        return "{} IN ({})".format(field, ", ".join(names))
+
+    def compare_value(self, value):
+        """Numbers are compared as numbers, as JSON values are extracted as SQL values."""
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return value
+        return text_parameter(value)
+
+    def percentile(self, fraction, expression):
+        raise NotImplementedError("Percentiles are only supported on PostgreSQL.")
+
+    def insert_many(self, connection, table, fields, rows):
+        query = "INSERT INTO {} ({}) VALUES ({})".format(
+            table, ", ".join(fields), ", ".join(["?"] * len(fields))
+        )
+        cursor = connection.cursor()
+        try:
+            cursor.executemany(query, ([self.adapt(value) for value in row] for row in rows))
+        finally:
+            cursor.close()
+
+    def load(self, connection, table, fields, rows, encode_json):
+        """Bulk-load rows in a single transaction; SQLite has no COPY, but is local."""
+        self.insert_many(
+            connection,
+            table,
+            fields,
+            ([_load_value(value, encode_json) for value in row] for row in rows),
+        )
+
+    def decode(self, results, timestamps=(), json_fields=()):
+        for column in results.columns:
+            if column in timestamps and results[column].dtype == object:
+                results[column] = pd.to_datetime(results[column])
+            elif column in json_fields and results[column].dtype == object:
+                results[column] = [
+                    json.loads(value) if isinstance(value, str) else value
+                    for value in results[column]
+                ]
+        return results
+
+
+# psycopg2's placeholders, and escaped percent signs
+_PLACEHOLDERS = re.compile(r"%\((\w+)\)s|%s|%%")
+
+
+def to_positional(query, params):
+    """
+    Convert a query with psycopg2's placeholders, named like %(start)s or positional like %s, into
+    one with PostgreSQL's numbered placeholders, like $1, as PREPARE and asyncpg take them.
+
+    Returns the query and a list of arguments.
+    """
+
+    names = []
+    arguments = []
+
+    def replace(match):
+        name = match.group(1)
+        if match.group(0) == "%%":
+            return "%"
+        if name is None:
+            arguments.append(params[len(arguments)])
+            return "${}".format(len(arguments))
+        if name not in names:
+            names.append(name)
+            arguments.append(params[name])
+        return "${}".format(names.index(name) + 1)
+
+    return _PLACEHOLDERS.sub(replace, query), arguments
+
+
+def _sqlite_placeholder(match):
+    if match.group(1):
+        return ":" + match.group(1)
+    return "?" if match.group(0) == "%s" else "%"
+
+
+def dialect_for(db):
+    """The dialect of a database's connection string; PostgreSQL if there isn't one."""
+    if db is not None and make_url(db).get_backend_name() == "sqlite":
+        return SQLiteDialect()
+    return PostgresDialect()
+
+
+def text_parameter(value):
+    """Conditional values are compared as text : dicts as JSON, anything else as a string."""
+    if isinstance(value, dict):
+        return json.dumps(value)
+    return str(value)
+
+
+def _missing(value):
+    return value is None or value is pd.NaT or (isinstance(value, float) and math.isnan(value))
+
+
+def _copy_text(value, encode_json=json.dumps):
+    """Encode a value for PostgreSQL's COPY text format."""
+
+    # Missing values are NULL
+    if _missing(value):
+        return "\\N"
+
+    # JSON needs to be correctly encoded; everything else is sent as a string
+    if isinstance(value, (dict, list)):
+        value = encode_json(value)
+    else:
+        value = str(value)
+
+    return (
+        value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+    )
+
+
+def _load_value(value, encode_json):
+    """Encode a value for bulk-loading into SQLite, as _copy_text does for PostgreSQL."""
+    if _missing(value):
+        return None
+    if isinstance(value, (dict, list)):
+        return encode_json(value)
+    if isinstance(value, NATIVE_TYPES):
+        return value
+    return str(value)
+
+
+class _IteratorFile(object):
+    """A read-only file-like object over an iterator of strings, for streaming into COPY."""
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._pending = ""
+
+    def read(self, size=-1):
+        chunks = [self._pending]
+        length = len(self._pending)
+        while size < 0 or length < size:
+            try:
+                line = next(self._lines)
+            except StopIteration:
+                break
+            chunks.append(line)
+            length += len(line)
+
+        data = "".join(chunks)
+        if size < 0:
+            self._pending = ""
+            return data
+        self._pending = data[size:]
+        return data[:size]
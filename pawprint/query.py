@@ -0,0 +1,186 @@
+import re
+
+# Aggregate operations, and their SQL
+AGGREGATES = {
+    "count": "COUNT({})",
+    "count_distinct": "COUNT(DISTINCT {})",
+    "sum": "SUM({})",
+    "avg": "AVG({})",
+    "min": "MIN({})",
+    "max": "MAX({})",
+}
+
+# Percentiles are aggregated as median, or as p followed by the percentile, like p95
+_PERCENTILE = re.compile(r"^p([1-9][0-9]?)$")
+
+# Result columns are named after fields and aggregates, so these must be plain identifiers
+_IDENTIFIER = re.compile(r"^[A-Za-z_]\w*$")
+
+
+class Query(object):
+    """
+    This class is a lazy query over a tracker's events. Conditions, fields, groupings and
+    aggregates are added by chaining methods, each of which returns a new query, so a query can
+    be shared and refined. Nothing is sent to the database until results are asked for with
+    .to_df(), .iter() or .count(), and then only a single statement, however many aggregates
+    there are.
+
+        logins = tracker.events.filter(event="logged_in")
+        daily = logins.group_by(resolution="day").aggregate(
+            logins=("count", "*"), users=("count_distinct", "user_id")
+        )
+        daily.where(timestamp__gte="2017-01-01").to_df()
+    """
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self._conditions = ()
+        self._fields = ()
+        self._groups = ()
+        self._resolution = None
+        self._aggregates = ()
+
+    def filter(self, **conditionals):
+        """Keep only the events that meet these conditions, as well as any already added."""
+        return self._extend(_conditions=self._conditions + tuple(sorted(conditionals.items())))
+
+    where = filter
+
+    def select(self, *fields):
+        """Return these fields of each event, rather than all of them."""
+        return self._extend(_fields=self._fields + fields)
+
+    def group_by(self, *fields, resolution=None):
+        """
+        Aggregate events by the values of these fields and, if resolution is given, by the
+        period of their timestamp, returned in a datetime column.
+        """
+        for field in fields:
+            _check_identifier(field)
+        if resolution is None:
+            resolution = self._resolution
+        return self._extend(_groups=self._groups + fields, _resolution=resolution)
+
+    def aggregate(self, **aggregates):
+        """
+        Calculate aggregates, each passed as name=(operation, field), where the operation is one
+        of count, count_distinct, sum, avg, min or max, or a percentile : median, or p followed by
+        the percentile, like p95. Counts may take the field "*".
+        """
+
+        added = []
+        for name, (operation, field) in aggregates.items():
+            _check_identifier(name)
+            if operation not in AGGREGATES and not _percentile(operation):
+                raise ValueError(
+                    "Aggregates must be one of {}, median or a percentile like p95".format(
+                        ", ".join(AGGREGATES)
+                    )
+                )
+            if field == "*" and operation != "count":
+                raise ValueError("Only count can aggregate every event, with '*'")
+            added.append((name, operation, field))
+
+        return self._extend(_aggregates=self._aggregates + tuple(added))
+
+    def to_df(self, ttl=None):
+        """Run the query, and return its results as a DataFrame."""
+        query, params = self.compile()
+        return self.tracker._fetch(query, params, ttl)
+
+    def iter(self, chunksize=10000, raw=False):
+        """
+        Run the query through a server-side cursor, and return an iterator of its results,
+        chunksize rows at a time, as Tracker.read_iter() does. Only events can be iterated over,
+        not aggregates.
+        """
+        if self._aggregates or self._groups or self._resolution:
+            raise ValueError("Only queries without aggregates can be iterated over")
+        return self.tracker._read_iter(self._fields, self._conditions, chunksize, raw=raw)
+
+    def count(self, ttl=None):
+        """Return the number of events that meet the query's conditions."""
+        conditionals_query, params = self.tracker._parse_conditions(self._conditions)
+        query = "SELECT COUNT(*) AS count FROM {} {}".format(self.tracker.table, conditionals_query)
+        return int(self.tracker._fetch(query, params or None, ttl)["count"][0])
+
+    def compile(self):
+        """
+        Build the query's SQL.
+
+        Returns the query and its parameters.
+        """
+
+        if not (self._aggregates or self._groups or self._resolution):
+            return self.tracker._select_query(self._fields, self._conditions)
+
+        if not self._aggregates:
+            raise ValueError("Grouped queries need at least one aggregate")
+        if self._fields:
+            raise ValueError("Aggregated queries can't also select fields; group by them instead")
+
+        tracker = self.tracker
+        conditionals_query, params = tracker._parse_conditions(self._conditions)
+
+        # Group by period, then by each field's value
+        columns, groups = [], []
+        if self._resolution is not None:
+            bucket = tracker.dialect.date_trunc(self._resolution, tracker.timestamp_field)
+            columns.append("{} AS datetime".format(bucket))
+            groups.append(bucket)
+            params["resolution"] = self._resolution
+        for field in self._groups:
+            expression = tracker._parse_fields(field, skip_alias=True, json_aggregate=True)
+            columns.append("{} AS {}".format(expression, field))
+            groups.append(expression)
+
+        for name, operation, field in self._aggregates:
+            columns.append("{} AS {}".format(self._aggregate_expression(operation, field), name))
+
+        query = "SELECT {} FROM {} {}".format(", ".join(columns), tracker.table, conditionals_query)
+        if groups:
+            query += " GROUP BY {0} ORDER BY {0}".format(", ".join(groups))
+
+        return query, params or None
+
+    def _aggregate_expression(self, operation, field):
+        """The SQL for one aggregate; numbers in the JSON field are aggregated as numbers."""
+
+        if field == "*":
+            return AGGREGATES[operation].format(field)
+
+        expression = self.tracker._parse_fields(field, skip_alias=True, json_aggregate=True)
+        is_json = field.startswith(self.tracker.json_field) and field != self.tracker.json_field
+        fraction = _percentile(operation)
+        if operation in ("sum", "avg") or is_json and (operation in ("min", "max") or fraction):
+            expression = self.tracker.dialect.float(expression)
+        if fraction:
+            return self.tracker.dialect.percentile(fraction, expression)
+        return AGGREGATES[operation].format(expression)
+
+    def _extend(self, **attributes):
+        """A copy of this query, with some of its attributes changed."""
+        query = Query(self.tracker)
+        query.__dict__.update(self.__dict__)
+        query.__dict__.update(attributes)
+        return query
+
+    def __repr__(self):
+        try:
+            query = self.compile()[0]
+        except ValueError as exception:
+            query = "incomplete ( {} )".format(exception)
+        return "pawprint.Query on table '{}' : {}".format(self.tracker.table, query)
+
+
+def _percentile(operation):
+    """The fraction of a percentile operation, or None if it isn't one."""
+    if operation == "median":
+        return 0.5
+    match = _PERCENTILE.match(operation)
+    return int(match.group(1)) / 100.0 if match else None
+
+
+def _check_identifier(name):
+    if not _IDENTIFIER.match(name):
+        raise ValueError("'{}' can't be used as a column name".format(name))
@@ -0,0 +1,62 @@
+import json
+from datetime import date, datetime, time
+from decimal import Decimal
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+# JSON libraries, fastest first
+JSON_ENCODERS = ("orjson", "ujson", "json")
+
+# Types that psycopg2 sends to the database as they are, so they needn't be converted to strings
+NATIVE_TYPES = (str, int, float, bool, datetime, date, time, Decimal, type(None))
+
+
+def json_encoder(name=None):
+    """
+    Return a function that encodes a value as a JSON string, using the named library, or the
+    fastest one installed if name is None. Datetimes are encoded as ISO-8601 strings, and anything
+    else JSON can't represent as its string.
+    """
+
+    if name is None:
+        name = "orjson" if orjson is not None else "ujson" if ujson is not None else "json"
+
+    if name not in JSON_ENCODERS:
+        raise ValueError("json_encoder must be one of {}".format(", ".join(JSON_ENCODERS)))
+
+    if name == "orjson":
+        if orjson is None:
+            raise ImportError("orjson isn't installed : pip install orjson")
+        option = orjson.OPT_NON_STR_KEYS
+
+        def encode(value):
+            return orjson.dumps(value, default=_json_default, option=option).decode()
+
+        return encode
+
+    if name == "ujson":
+        if ujson is None:
+            raise ImportError("ujson isn't installed : pip install ujson")
+
+        def encode(value):
+            return ujson.dumps(value, default=_json_default)
+
+        return encode
+
+    # One encoder is reused for every value, rather than building one per call
+    return json.JSONEncoder(default=_json_default).encode
+
+
+def _json_default(value):
+    """Encode datetimes, which json doesn't handle natively, as ISO-8601 strings."""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
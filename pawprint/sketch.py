@@ -0,0 +1,145 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+# Bounds on the number of register index bits; 2 ** 16 registers give a standard error of 0.4%
+MIN_PRECISION = 4
+MAX_PRECISION = 16
+
+
+class HyperLogLog(object):
+    """
+    This class is a HyperLogLog sketch : a fixed-size summary of a set of values that estimates
+    how many distinct values have been added. Sketches of different sets can be merged to estimate
+    the size of their union, so distinct counts over long windows can be built from small daily
+    sketches rather than from raw events.
+    """
+
+    def __init__(self, error=0.01, precision=None, registers=None):
+
+        if registers is not None:
+            precision = int(math.log2(len(registers)))
+        elif precision is None:
+            precision = precision_for(error)
+
+        if not MIN_PRECISION <= precision <= MAX_PRECISION:
+            raise ValueError(
+                "precision must be between {} and {}".format(MIN_PRECISION, MAX_PRECISION)
+            )
+
+        self.precision = precision
+        if registers is None:
+            registers = np.zeros(2**precision, dtype=np.uint8)
+        self.registers = np.asarray(registers, dtype=np.uint8)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Load a sketch serialised with .to_bytes()."""
+        return cls(registers=np.frombuffer(bytes(data), dtype=np.uint8).copy())
+
+    @property
+    def error(self):
+        """The standard error of the sketch's estimates, as a fraction of the true count."""
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def add(self, values):
+        """Add an iterable of values to the sketch. Returns the sketch."""
+        index, rank = _hash_values(values, self.precision)
+        np.maximum.at(self.registers, index, rank)
+        return self
+
+    def merge(self, other):
+        """Return a new sketch of the union of this sketch's values and another's."""
+        if other.precision != self.precision:
+            raise ValueError("Only sketches with the same precision can be merged.")
+        return HyperLogLog(registers=np.maximum(self.registers, other.registers))
+
+    def count(self):
+        """Estimate the number of distinct values added to the sketch."""
+        return int(round(float(estimate(self.registers))))
+
+    def to_bytes(self):
+        """Serialise the sketch, for storage in a BYTEA field."""
+        return self.registers.tobytes()
+
+    def __repr__(self):
+        return "pawprint.HyperLogLog with precision {} ( ~{} distinct values )".format(
+            self.precision, self.count()
+        )
+
+
+def precision_for(error):
+    """The smallest precision whose standard error is no greater than error."""
+    precision = int(math.ceil(math.log2((1.04 / error) ** 2)))
+    return min(max(precision, MIN_PRECISION), MAX_PRECISION)
+
+
+def build(groups, values, precision):
+    """
+    Sketch values in a number of groups at once. groups holds integer group numbers, from 0, for
+    each value.
+
+    Returns a 2D array with one row of registers per group.
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    index, rank = _hash_values(values, precision)
+    registers = np.zeros((groups.max() + 1 if len(groups) else 0, 2**precision), dtype=np.uint8)
+    np.maximum.at(registers, (groups, index), rank)
+    return registers
+
+
+def estimate(registers):
+    """
+    Estimate distinct counts from registers. A 2D array of registers, one sketch per row, gives
+    one estimate per row.
+    """
+
+    registers = np.asarray(registers)
+    m = registers.shape[-1]
+
+    if m == 16:
+        alpha = 0.673
+    elif m == 32:
+        alpha = 0.697
+    elif m == 64:
+        alpha = 0.709
+    else:
+        alpha = 0.7213 / (1 + 1.079 / m)
+
+    raw = alpha * m**2 / np.power(2.0, -registers.astype(np.float64)).sum(axis=-1)
+
+    # Small cardinalities are estimated more accurately by counting empty registers
+    zeros = (registers == 0).sum(axis=-1)
+    with np.errstate(divide="ignore"):
+        linear = m * np.log(m / np.maximum(zeros, 1))
+
+    return np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+
+
+def _hash_values(values, precision):
+    """
+    Hash values to 64 bits. The first precision bits pick a register; the rank is the position
+    of the first set bit in the rest.
+
+    Returns arrays of register indexes and ranks.
+    """
+
+    values = pd.Series(list(values), dtype=object).astype(str).values
+    hashes = pd.util.hash_array(values)
+
+    width = 64 - precision
+    index = (hashes >> np.uint64(width)).astype(np.int64)
+    remainder = hashes & np.uint64((1 << width) - 1)
+
+    # Find the bit length of each remainder by binary search
+    length = np.zeros(len(remainder), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        shifted = remainder >> np.uint64(shift)
+        wide = shifted > 0
+        remainder = np.where(wide, shifted, remainder)
+        length += wide * shift
+    length += remainder > 0
+
+    rank = (width - length + 1).astype(np.uint8)
+    return index, rank
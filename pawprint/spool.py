@@ -0,0 +1,251 @@
+import json
+import os
+import re
+import threading
+import time
+
+from pawprint.serialize import _json_default
+
+# Segments are numbered in the order they're written, and replayed in that order
+_SEGMENT_FORMAT = "segment-{:012d}.jsonl"
+_SEGMENT_PATTERN = re.compile(r"^segment-(\d{12})\.jsonl$")
+
+
+class Spool(object):
+    """
+    This class is a durable, append-only spool of events on local disk, for when they can't be
+    written to the database. Events are appended to segment files as JSON lines, and replayed into
+    the database in bulk, oldest first, once it's back.
+    """
+
+    def __init__(
+        self,
+        path,
+        max_bytes=1024**3,
+        segment_bytes=16 * 1024**2,
+        sync_every=1000,
+        sync_interval=1.0,
+    ):
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+
+        # Appends are fsynced once this many events, or this many seconds, have gone unsynced
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+
+        # Counters for monitoring
+        self.counters = {"spooled": 0, "replayed": 0, "dropped": 0, "rejected": 0}
+
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._file = None
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = None
+
+        # Pick up where an earlier process left off
+        self.depth = 0
+        self.size = 0
+        self._sequence = 0
+        for segment in self._segments():
+            self.depth += len(self._read(segment, self._offset(segment)))
+            self.size += os.path.getsize(segment)
+            self._sequence = int(_SEGMENT_PATTERN.match(os.path.basename(segment)).group(1)) + 1
+
+    def append(self, events):
+        """
+        Append events to the spool, unless that would take it over max_bytes, in which case
+        they're dropped.
+
+        Returns the number of events spooled.
+        """
+
+        lines = [json.dumps(data, default=_json_default) + "\n" for data in events]
+        data = "".join(lines).encode()
+
+        with self._lock:
+            if self.size + len(data) > self.max_bytes:
+                self.counters["dropped"] += len(lines)
+                return 0
+
+            if self._file is None or self._file.tell() >= self.segment_bytes:
+                self._close_segment()
+                self._file = open(
+                    os.path.join(self.path, _SEGMENT_FORMAT.format(self._sequence)), "ab"
+                )
+                self._sequence += 1
+
+            self._file.write(data)
+            self._file.flush()
+            self.size += len(data)
+            self.depth += len(lines)
+            self.counters["spooled"] += len(lines)
+
+            self._unsynced += len(lines)
+            if (
+                self._unsynced >= self.sync_every
+                or time.monotonic() - self._synced_at >= self.sync_interval
+            ):
+                self._sync()
+
+        return len(lines)
+
+    def sync(self):
+        """Make sure every appended event is on disk."""
+        with self._lock:
+            self._sync()
+
+    def replay(self, write_batch, batch_size=1000, retry_on=(Exception,)):
+        """
+        Write spooled events with write_batch, in batches, oldest first. Replay stops at the
+        first batch that fails with one of the retry_on exceptions, leaving it and the events
+        after it for the next replay. A batch that fails with any other exception is split in
+        halves until the events that fail are found; only those are set aside, in a file with the
+        segment's name and a .rejected suffix, and the rest are written.
+
+        Returns the number of events written.
+        """
+
+        with self._replay_lock:
+            replayed = self.counters["replayed"]
+
+            # Start a new segment, so that every event spooled so far can be replayed, and events
+            # spooled while we replay go to segments we leave alone
+            with self._lock:
+                self._close_segment()
+                segments = self._segments()
+
+            for segment in segments:
+                events = self._read(segment, self._offset(segment))
+                try:
+                    for start in range(0, len(events), batch_size):
+                        self._write(
+                            write_batch, segment, events[start : start + batch_size], retry_on
+                        )
+                except retry_on:
+                    break
+                self._remove(segment)
+
+            return self.counters["replayed"] - replayed
+
+    def start(self, replay, interval=5.0):
+        """Call replay every interval seconds from a background thread, until the spool closes."""
+
+        def run():
+            while not self._stop.wait(interval):
+                self.sync()
+                try:
+                    replay()
+                except Exception:  # failures are logged by the tracker; try again next time
+                    pass
+
+        self._thread = threading.Thread(target=run, name="pawprint-spool")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """Stop the replay thread, and sync and close the current segment."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            self._close_segment()
+
+    def _write(self, write_batch, segment, batch, retry_on):
+        """
+        Write a batch of events from a segment, splitting it in halves if it fails with an
+        exception other than retry_on, and setting aside the single events that still fail.
+        """
+
+        try:
+            write_batch([data for data, _ in batch])
+        except retry_on:
+            raise
+        except Exception:
+            if len(batch) > 1:
+                middle = len(batch) // 2
+                self._write(write_batch, segment, batch[:middle], retry_on)
+                self._write(write_batch, segment, batch[middle:], retry_on)
+                return
+            with open(segment + ".rejected", "a") as f:
+                f.write(json.dumps(batch[0][0], default=_json_default) + "\n")
+            counter = "rejected"
+        else:
+            counter = "replayed"
+
+        # Record how far we've got, so a restart doesn't write these events twice
+        self._save_offset(segment, batch[-1][1])
+        with self._lock:
+            self.depth -= len(batch)
+            self.counters[counter] += len(batch)
+
+    def _segments(self):
+        """Paths to the spool's segments, oldest first."""
+        return [
+            os.path.join(self.path, name)
+            for name in sorted(os.listdir(self.path))
+            if _SEGMENT_PATTERN.match(name)
+        ]
+
+    def _read(self, segment, offset):
+        """
+        Read the events in a segment after offset. A partly written last line, left by a crash,
+        is skipped.
+
+        Returns a list of events and the offset just after each.
+        """
+
+        events = []
+        with open(segment, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                offset += len(line)
+                if line.endswith(b"\n"):
+                    events.append((json.loads(line.decode()), offset))
+        return events
+
+    def _offset(self, segment):
+        """How many bytes of a segment have already been replayed."""
+        try:
+            with open(segment + ".offset") as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return 0
+
+    def _save_offset(self, segment, offset):
+        """Atomically record how many bytes of a segment have been replayed."""
+        with open(segment + ".offset.tmp", "w") as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(segment + ".offset.tmp", segment + ".offset")
+
+    def _remove(self, segment):
+        """Delete a replayed segment."""
+
+        size = os.path.getsize(segment)
+        os.remove(segment)
+        if os.path.exists(segment + ".offset"):
+            os.remove(segment + ".offset")
+
+        with self._lock:
+            self.size -= size
+
+    def _sync(self):
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    def _close_segment(self):
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+            self._file = None
@@ -1,9 +1,51 @@
+from collections import OrderedDict
+import multiprocessing
 import numpy as np
 import pandas as pd
 from datetime import timedelta
 from sqlalchemy.exc import ProgrammingError
 
 from pawprint import Tracker
+from pawprint import analytics, sketch
+
+# Schemas of the derived tables, matching the types that pandas creates them with
+SESSIONS_SCHEMA = OrderedDict(
+    [
+        ("timestamp", "TIMESTAMP"),
+        ("user_id", "TEXT"),
+        ("duration", "FLOAT(53)"),
+        ("total_events", "BIGINT"),
+    ]
+)
+EVENT_SESSION_MAP_SCHEMA = OrderedDict(
+    [
+        ("event_id", "BIGINT"),
+        ("user_id", "TEXT"),
+        ("timestamp", "TIMESTAMP"),
+        ("session_timestamp", "TIMESTAMP"),
+    ]
+)
+USER_SESSION_COUNTS_SCHEMA = OrderedDict(
+    [("user_id", "TEXT PRIMARY KEY"), ("sessions", "BIGINT"), ("last_session", "TIMESTAMP")]
+)
+DAILY_USERS_SCHEMA = OrderedDict(
+    [("timestamp", "TIMESTAMP"), ("user_id", "TEXT"), ("PRIMARY KEY", "(timestamp, user_id)")]
+)
+USER_SKETCHES_SCHEMA = OrderedDict([("timestamp", "TIMESTAMP PRIMARY KEY"), ("users", "BYTEA")])
+WATERMARKS_SCHEMA = OrderedDict([("name", "TEXT PRIMARY KEY"), ("timestamp", "TIMESTAMP")])
+
+# Indexes on the derived tables, as lists of columns
+SESSIONS_INDEXES = [("timestamp",), ("user_id", "timestamp")]
+EVENT_SESSION_MAP_INDEXES = [("timestamp",), ("event_id",)]
+
+# The derived tables that grow with every session, and so can be partitioned on their timestamp
+_PARTITIONED_TABLES = ("sessions", "event_session_map")
+
+# How many times each shard of users is attempted when sessions are calculated in parallel
+_SHARD_ATTEMPTS = 3
+
+# The derived tables with a timestamp, from which old rows can be removed
+_RETAINED_TABLES = ("sessions", "event_session_map", "engagement", "user_sketches", "daily_users")
 
 
 class Statistics(object):
@@ -11,18 +53,55 @@ class Statistics(object):
     This class interfaces with an existing Tracker and calculated derived statistics.
     """
 
-    def __init__(self, tracker):
+    def __init__(self, tracker, partition=None):
 
         # Save the tracker
         self.tracker = tracker
 
+        # How the sessions and event/session map tables are partitioned, if at all
+        self.partition = partition
+
+        # Trackers for derived statistics tables, created as they're needed
+        self._trackers = {}
+
     def __getitem__(self, tracker):
         """Overload the [] operator."""
 
-        return Tracker(db=self.tracker.db, table="{}__{}".format(self.tracker.table, tracker))
+        if tracker not in self._trackers:
+            self._trackers[tracker] = Tracker(
+                db=self.tracker.db,
+                table="{}__{}".format(self.tracker.table, tracker),
+                pool_size=self.tracker.pool_size,
+                max_overflow=self.tracker.max_overflow,
+                pool_pre_ping=self.tracker.pool_pre_ping,
+                partition=self.partition if tracker in _PARTITIONED_TABLES else None,
+            )
 
-    def sessions(self, duration=30, clean=False, event_id_col="id"):
-        """Create a table of user sessions."""
+        return self._trackers[tracker]
+
+    def sessions(
+        self,
+        duration=30,
+        clean=False,
+        event_id_col="id",
+        method="pandas",
+        workers=None,
+        shards=None,
+    ):
+        """
+        Create a table of user sessions. By default, events are pulled into pandas to calculate
+        sessions; pass method="sql" to calculate them inside PostgreSQL instead, so that events
+        never leave the database, or method="duckdb" to calculate them in an embedded DuckDB.
+
+        With the pandas method, pass workers to split users into shards, by a hash of their id,
+        and calculate each shard's sessions in its own process. There are as many shards as
+        workers unless shards is given.
+        """
+
+        if method not in ("pandas", "sql", "duckdb"):
+            raise ValueError("method must be one of 'pandas', 'sql' or 'duckdb'")
+        if workers is not None and method != "pandas":
+            raise ValueError("workers can only be used with method='pandas'")
 
         # Create a tracker for basic interaction
         stats = self["sessions"]
@@ -34,124 +113,173 @@ class Statistics(object):
         if clean:
             stats.drop_table()
             event_session_map.drop_table()
+            self._clear_watermarks(event_session_map)
 
         # Determine whether the stats table exists and contains data, or if we should create one
-        try:  # if this passes, the table exists and may contain data
-            last_entry = pd.read_sql(
-                "SELECT timestamp FROM {} ORDER BY timestamp DESC LIMIT 1".format(
-                    event_session_map.table
-                ),
-                self.tracker.db,
-            ).loc[0, "timestamp"]
-        except ProgrammingError:  # otherwise, the table doesn't exist
-            last_entry = None
+        last_entry = self._last_entry(event_session_map)
 
-        # Query : what's the final time we have a session duration for ?
-        query = "SELECT DISTINCT({}) FROM {}".format(self.tracker.user_field, self.tracker.table)
-        if last_entry:
-            query += " WHERE {} > %(last_entry)s".format(self.tracker.timestamp_field)
-        params = {"last_entry": str(last_entry)}
+        if method == "sql":
+            return self._sessions_sql(duration, event_id_col, last_entry)
 
-        # Get the list of unique users since the last data we've tracked
-        users = pd.read_sql(query, self.tracker.db, params=params)[self.tracker.user_field].values
-
-        if len(users) == 0:
-            return
+        if workers is not None:
+            return self._sessions_parallel(duration, event_id_col, last_entry, workers, shards)
 
         # Query : the timestamp and user for all events since the last recorded session start
-        query = "SELECT {}, {}, {} FROM {}".format(
-            event_id_col, self.tracker.user_field, self.tracker.timestamp_field, self.tracker.table
-        )
-        if last_entry:
-            query += " WHERE {} > %(last_entry)s".format(self.tracker.timestamp_field)
-
-        # Pull the time-series
-        events = pd.read_sql(query, self.tracker.db, params=params)
-
-        # Session durations DataFrame
-        session_data = pd.DataFrame()
-        event_session_map_data = pd.DataFrame()
-
-        # For each user, calculate session durations
-        for user in users:
-
-            # Get the user's time series
-            user_events = events[events[self.tracker.user_field] == user].sort_values(
-                self.tracker.timestamp_field
+        if method == "duckdb":
+            query = "SELECT {} AS event_id, {} AS user_id, {} AS timestamp FROM {}".format(
+                event_id_col,
+                self.tracker.user_field,
+                self.tracker.timestamp_field,
+                self.tracker.table,
             )
-            user_times = user_events[self.tracker.timestamp_field]
-
-            # Index the final elements of each session
-            time_between = user_times.diff()  # look at the time between events
-            time_between.iloc[0] = timedelta(minutes=0)  # fix NaT
-            final_events = np.where(time_between.dt.seconds / 60 > duration)[0]
-
-            # Identify times where the user has finished a session
-            # The zeroth "session" finished at -1; the last session finishes at the end
-            end = len(final_events)
-            breaks = np.insert(final_events, [0, end], [0, len(user_times)])
-
-            # Calculate session durations
-            user_durations = []
-            for i, j in zip(breaks[:-1], breaks[1:]):
-                user_durations.append((user_times.iloc[j - 1] - user_times.iloc[i]).seconds / 60)
-
-            # Write session durations to the DataFrame
-            user_session_data = pd.DataFrame(
-                {
-                    "timestamp": user_times.iloc[breaks[:-1]].values,
-                    "user_id": [user] * len(user_durations),
-                    "duration": user_durations,
-                    "total_events": np.diff(breaks),
-                }
+        else:
+            query = "SELECT {}, {}, {} FROM {}".format(
+                event_id_col,
+                self.tracker.user_field,
+                self.tracker.timestamp_field,
+                self.tracker.table,
             )
+        if last_entry:
+            query += " WHERE {} > %(last_entry)s".format(self.tracker.timestamp_field)
+        params = {"last_entry": str(last_entry)}
 
-            session_starts = user_session_data["timestamp"].sort_values()
-            session_ends = pd.concat(
-                [user_session_data["timestamp"].sort_values().iloc[1:], pd.Series(user_times.max())]
-            ).reset_index(drop=True)
-            session_idxs = np.searchsorted(
-                session_ends.sort_values(), user_events[self.tracker.timestamp_field]
+        # Calculate sessions for all users at once
+        if method == "duckdb":
+            session_data, event_session_map_data = analytics.sessionize(
+                self.tracker.engine, query, params, duration
             )
-            user_events["session_timestamp"] = session_starts[session_idxs].values
-            event_session_map_data = event_session_map_data.append(
-                user_events.loc[:, ["id", "user_id", "timestamp", "session_timestamp"]],
-                ignore_index=True,
+            if len(session_data) == 0:
+                return
+        else:
+            # Pull the time-series
+            events = pd.read_sql(query, self.tracker.engine, params=params)
+            events = events[events[self.tracker.user_field].notnull()]
+
+            if len(events) == 0:
+                return
+
+            session_data, event_session_map_data = _sessionize(
+                events,
+                duration,
+                event_id_col,
+                self.tracker.user_field,
+                self.tracker.timestamp_field,
             )
 
-            session_data = session_data.append(user_session_data, ignore_index=True)
-
         # Write the session durations to the database
-        session_data[["timestamp", "user_id", "duration", "total_events"]].sort_values(
-            "timestamp"
-        ).to_sql(stats.table, stats.db, if_exists="append", index=False)
+        _create_table_if_missing(stats, SESSIONS_SCHEMA, SESSIONS_INDEXES)
+        stats.write_dataframe(session_data)
 
         # Write event/session lookup table to the database
-        event_session_map_data = event_session_map_data.rename(columns={event_id_col: "event_id"})
-        event_session_map_data[
-            ["event_id", "user_id", "timestamp", "session_timestamp"]
-        ].sort_values("session_timestamp").to_sql(
-            event_session_map.table, event_session_map.db, if_exists="append", index=False
+        _create_table_if_missing(
+            event_session_map, EVENT_SESSION_MAP_SCHEMA, EVENT_SESSION_MAP_INDEXES
         )
+        event_session_map.write_dataframe(event_session_map_data)
+        self._save_watermark(event_session_map)
 
-    def engagement(self, clean=False, start=None, min_sessions=3):
-        """Calculates the daily and monthly average users, and the stickiness as the ratio."""
+    def sketches(self, error=0.01, clean=False):
+        """
+        Create a table of daily HyperLogLog sketches of the users who wrote events, from which
+        distinct user counts over any number of days can be estimated without rescanning events.
+        error is the standard error of the estimates, as a fraction of the true count.
+        """
 
         # Create a tracker for basic interaction
-        stats = self["engagement"]
+        stats = self["user_sketches"]
 
         # If we're starting clean, delete the table
         if clean:
             stats.drop_table()
+            self._clear_watermarks(stats)
+
+        precision = sketch.precision_for(error)
+
+        # The last day sketched may have been incomplete, so we sketch it again
+        last_entry = self._last_entry(stats)
+        if last_entry is not None:
+            existing = pd.read_sql(
+                "SELECT LENGTH(users) AS size FROM {} LIMIT 1".format(stats.table), stats.engine
+            ).loc[0, "size"]
+            if existing != 2**precision:
+                raise ValueError(
+                    "Existing sketches have a different error; pass clean=True to rebuild them."
+                )
+
+        # Query : the timestamp and user for all events since the start of the last sketched day
+        query = "SELECT {user}, {timestamp} FROM {table} WHERE {user} IS NOT NULL".format(
+            user=self.tracker.user_field,
+            timestamp=self.tracker.timestamp_field,
+            table=self.tracker.table,
+        )
+        if last_entry is not None:
+            query += " AND {} >= %(last_entry)s".format(self.tracker.timestamp_field)
+        events = pd.read_sql(query, self.tracker.engine, params={"last_entry": last_entry})
+
+        if len(events) == 0:
+            return
+
+        # Sketch every day at once
+        days = pd.to_datetime(events[self.tracker.timestamp_field]).dt.floor("D")
+        groups, dates = pd.factorize(days, sort=True)
+        registers = sketch.build(groups, events[self.tracker.user_field], precision)
+        rows = [
+            {"timestamp": date.to_pydatetime(), "users": row.tobytes()}
+            for date, row in zip(dates, registers)
+        ]
+
+        # Replace the last day's sketch and add the new ones
+        _create_table_if_missing(stats, USER_SKETCHES_SCHEMA)
+        with stats.engine.begin() as connection:
+            if last_entry is not None:
+                connection.execute(
+                    "DELETE FROM {} WHERE timestamp >= %(last_entry)s".format(stats.table),
+                    {"last_entry": last_entry},
+                )
+            connection.execute(
+                "INSERT INTO {} (timestamp, users) VALUES (%(timestamp)s, %(users)s)".format(
+                    stats.table
+                ),
+                rows,
+            )
+        self._save_watermark(stats)
+
+    def engagement(
+        self,
+        clean=False,
+        start=None,
+        min_sessions=3,
+        approximate=False,
+        error=0.01,
+        incremental=False,
+        method="pandas",
+    ):
+        """
+        Calculates the daily and monthly average users, and the stickiness as the ratio. Pass
+        approximate=True to estimate DAU, WAU and MAU by merging daily user sketches, or
+        incremental=True to keep running per-user and per-day state in the database, so that
+        each run only processes sessions that are new since the last. Pass method="duckdb" to
+        count users exactly in an embedded DuckDB rather than in pandas.
+        """
+
+        if approximate and incremental:
+            raise ValueError("engagement can't be both approximate and incremental")
+        if method not in ("pandas", "duckdb"):
+            raise ValueError("method must be one of 'pandas' or 'duckdb'")
+        if method == "duckdb" and (approximate or incremental):
+            raise ValueError("engagement with method='duckdb' can't be approximate or incremental")
+
+        # Create a tracker for basic interaction
+        stats = self["engagement"]
+
+        # If we're starting clean, delete the table, and any incremental state
+        if clean:
+            stats.drop_table()
+            for name in ("user_session_counts", "daily_users"):
+                self[name].query("DROP TABLE IF EXISTS {}".format(self[name].table))
+            self._clear_watermarks(stats)
 
         # Determine whether the stats table exists and contains data, or if we should create one
-        try:  # if this passes, the table exists and may contain data
-            last_entry = pd.read_sql(
-                "SELECT timestamp FROM {} ORDER BY timestamp DESC LIMIT 1".format(stats.table),
-                self.tracker.db,
-            ).loc[0, "timestamp"]
-        except ProgrammingError:  # otherwise, the table doesn't exist
-            last_entry = None
+        last_entry = self._last_entry(stats)
 
         # If a start_date isn't passed, start from the last known date, or from the beginning
         if not start:
@@ -160,6 +288,15 @@ class Statistics(object):
             else:
                 start = "1900-01-01"  # datetime(year=1900, month=1, day=1).date()
 
+        if incremental or method == "duckdb":
+            if incremental:
+                stickiness = self._incremental_engagement(start, min_sessions)
+            else:
+                stickiness = self._duckdb_engagement(start, min_sessions)
+            if stickiness is not None:  # unless this has been run too recently
+                self._write_engagement(stickiness)
+            return
+
         # If we're also calculating by imposing a minimum number of events per user
         if min_sessions:
             # Count the number of rows per user in the sessions table
@@ -173,16 +310,24 @@ class Statistics(object):
             if not len(active_users):
                 min_sessions = 0
 
-        # DAU : daily active users
-        stickiness = self["sessions"].count(
-            "DISTINCT({})".format(self.tracker.user_field), timestamp__gt=start
-        )
-        if not len(stickiness):  # if this has been run too recently, do nothing
-            return
-        stickiness.rename(columns={"count": "dau", "datetime": "timestamp"}, inplace=True)
-        stickiness.index = pd.to_datetime(stickiness["timestamp"])
-        stickiness.drop("timestamp", axis=1, inplace=True)
-        stickiness = stickiness.resample("D").sum().fillna(0).astype(int)
+        if approximate:
+            # DAU, WAU and MAU : estimated from daily user sketches
+            self.sketches(error=error)
+            stickiness = self._approximate_engagement(start)
+            if stickiness is None:  # if this has been run too recently, do nothing
+                return
+
+        else:
+            # DAU : daily active users
+            stickiness = self["sessions"].count(
+                "DISTINCT({})".format(self.tracker.user_field), timestamp__gt=start
+            )
+            if not len(stickiness):  # if this has been run too recently, do nothing
+                return
+            stickiness.rename(columns={"count": "dau", "datetime": "timestamp"}, inplace=True)
+            stickiness.index = pd.to_datetime(stickiness["timestamp"])
+            stickiness.drop("timestamp", axis=1, inplace=True)
+            stickiness = stickiness.resample("D").sum().fillna(0).astype(int)
 
         # Calculate DAU for active users if requested
         if min_sessions:
@@ -196,75 +341,612 @@ class Statistics(object):
             active_dau = active_dau.resample("D").sum().fillna(0).astype(int)
             stickiness["dau_active"] = active_dau["count"]
 
-        # Weekly and monthly average users
-        stickiness["wau"] = np.nan
-        stickiness["mau"] = np.nan
+        # Pull every session that falls in a weekly or monthly window ending on one of our dates
+        dates = stickiness.index
+        if not approximate or min_sessions:
+            sessions = self["sessions"].read(
+                self.tracker.user_field,
+                "timestamp",
+                timestamp__gt=dates.min() - timedelta(days=29),
+                timestamp__lte=dates.max() + timedelta(days=1),
+            )
+            users = sessions[self.tracker.user_field]
+
+        # Calculate weekly and monthly average users in a single pass over these sessions
+        if not approximate:
+            stickiness["wau"] = _rolling_distinct(users, sessions["timestamp"], dates, days=6)
+            stickiness["mau"] = _rolling_distinct(users, sessions["timestamp"], dates, days=29)
 
+        # Calculate WAU and MAU for active users only if requested
         if min_sessions:
-            stickiness["wau_active"] = np.nan
-            stickiness["mau_active"] = np.nan
-
-        # Calculate weekly and monthly average users
-        for date in stickiness.index:
-            weekly = (
-                self["sessions"]
-                .read(
-                    "DISTINCT({})".format(self.tracker.user_field),
-                    timestamp__gt=date - timedelta(days=6),
-                    timestamp__lte=date + timedelta(days=1),
-                )
-                .count()
+            active = users.astype(str).isin(active_users)
+            stickiness["wau_active"] = _rolling_distinct(
+                users[active], sessions["timestamp"][active], dates, days=6
             )
-            monthly = (
-                self["sessions"]
-                .read(
-                    "DISTINCT({})".format(self.tracker.user_field),
-                    timestamp__gt=date - timedelta(days=29),
-                    timestamp__lte=date + timedelta(days=1),
-                )
-                .count()
+            stickiness["mau_active"] = _rolling_distinct(
+                users[active], sessions["timestamp"][active], dates, days=29
             )
 
-            # Calculate WAU and MAU for active users only if requested
-            if min_sessions:
-                weekly_active = (
-                    self["sessions"]
-                    .read(
-                        "DISTINCT({})".format(self.tracker.user_field),
-                        timestamp__gt=date - timedelta(days=6),
-                        timestamp__lte=date + timedelta(days=1),
-                        **active_users_query
-                    )
-                    .count()
-                )
-                monthly_active = (
-                    self["sessions"]
-                    .read(
-                        "DISTINCT({})".format(self.tracker.user_field),
-                        timestamp__gt=date - timedelta(days=29),
-                        timestamp__lte=date + timedelta(days=1),
-                        **active_users_query
-                    )
-                    .count()
-                )
+        self._write_engagement(stickiness)
 
-                stickiness.loc[date, "wau_active"] = weekly_active.iloc[0]
-                stickiness.loc[date, "mau_active"] = monthly_active.iloc[0]
+    def _write_engagement(self, stickiness):
+        """Add engagement ratios to DAU, WAU and MAU by date, and append them to the table."""
 
-            stickiness.loc[date, "wau"] = weekly.iloc[0]
-            stickiness.loc[date, "mau"] = monthly.iloc[0]
+        stats = self["engagement"]
 
         # Calculate engagement as DAU / MAU
         stickiness["engagement"] = stickiness.dau / stickiness.mau
-        if min_sessions:
+        if "dau_active" in stickiness:
             stickiness["engagement_active"] = stickiness.dau_active / stickiness.mau_active
 
         # Active user counts should be ints
         stickiness.wau = stickiness.wau.astype(int)
         stickiness.mau = stickiness.mau.astype(int)
-        if min_sessions:
+        if "dau_active" in stickiness:
             stickiness.wau_active = stickiness.wau_active.astype(int)
             stickiness.mau_active = stickiness.mau_active.astype(int)
 
         # Write the engagement data to the database
-        stickiness.sort_index().to_sql(stats.table, stats.db, if_exists="append")
+        stickiness.sort_index().to_sql(stats.table, stats.engine, if_exists="append")
+        self._save_watermark(stats)
+
+    def maintain(self, ahead=3, retention=None):
+        """
+        Create upcoming partitions of the partitioned derived tables and, if retention is a number
+        of days, remove sessions, engagement, sketches and per-day users older than that. Old
+        partitions are dropped whole; other tables have their old rows deleted.
+        """
+
+        cutoff = None
+        if retention is not None:
+            cutoff = (pd.Timestamp.now() - pd.Timedelta(days=retention)).to_pydatetime()
+
+        for name in _RETAINED_TABLES:
+            stats = self[name]
+            if not _table_exists(stats):
+                continue
+
+            # Later runs carry on from the watermark, rather than redoing what's removed
+            if cutoff is not None:
+                self._save_watermark(stats)
+
+            if stats.partition is not None:
+                stats.maintain_partitions(ahead=ahead, retention=retention, drop=True)
+            elif cutoff is not None:
+                with stats.engine.begin() as connection:
+                    connection.execute(
+                        "DELETE FROM {} WHERE timestamp < %(cutoff)s".format(stats.table),
+                        {"cutoff": cutoff},
+                    )
+
+    def _incremental_engagement(self, start, min_sessions):
+        """
+        Bring the per-user session counts and per-day user tables up to date with the sessions
+        table, then calculate DAU, WAU and MAU for every day after start from them.
+
+        Returns a DataFrame indexed by date, or None if there are no days to calculate.
+        """
+
+        sessions = self["sessions"]
+        counts = self["user_session_counts"]
+        daily_users = self["daily_users"]
+        tables = dict(
+            user=self.tracker.user_field,
+            sessions_table=sessions.table,
+            counts_table=counts.table,
+            daily_users_table=daily_users.table,
+        )
+
+        _create_table_if_missing(counts, USER_SESSION_COUNTS_SCHEMA)
+        _create_table_if_missing(daily_users, DAILY_USERS_SCHEMA)
+        _create_table_if_missing(sessions, SESSIONS_SCHEMA, SESSIONS_INDEXES)
+
+        # Fold sessions that are newer than the state into it
+        with self.tracker.engine.begin() as connection:
+            connection.execute(_ENGAGEMENT_STATE_QUERY.format(**tables))
+
+        # If no users have enough sessions, turn off min_sessions calculations
+        if min_sessions:
+            active = pd.read_sql(
+                "SELECT COUNT(*) AS active FROM {} WHERE sessions >= %(min_sessions)s".format(
+                    counts.table
+                ),
+                counts.engine,
+                params={"min_sessions": min_sessions},
+            ).loc[0, "active"]
+            if not active:
+                min_sessions = 0
+
+        stickiness = pd.read_sql(
+            _INCREMENTAL_ENGAGEMENT_QUERY.format(**tables),
+            self.tracker.engine,
+            params={"start": start, "min_sessions": min_sessions},
+            index_col="timestamp",
+        )
+        if not len(stickiness):
+            return None
+
+        if not min_sessions:
+            stickiness = stickiness.drop(["dau_active", "wau_active", "mau_active"], axis=1)
+
+        return stickiness
+
+    def _duckdb_engagement(self, start, min_sessions):
+        """
+        Calculate DAU, WAU and MAU for every day after start in DuckDB, from the sessions since
+        30 days before start.
+
+        Returns a DataFrame indexed by date, or None if there are no days to calculate.
+        """
+
+        sessions = self["sessions"]
+        start = pd.Timestamp(start).to_pydatetime()
+
+        query = (
+            "SELECT user_id, timestamp FROM {} "
+            "WHERE user_id IS NOT NULL AND timestamp > %(earliest)s".format(sessions.table)
+        )
+        counts_query = "SELECT user_id, COUNT(*) AS sessions FROM {} GROUP BY user_id".format(
+            sessions.table
+        )
+        params = {"earliest": start - timedelta(days=30)}
+
+        return analytics.engagement(
+            sessions.engine, query, params, start, min_sessions, counts_query
+        )
+
+    def _approximate_engagement(self, start):
+        """
+        Estimate DAU, WAU and MAU for every day after start, by merging the sketches of each day
+        in the week or month ending on it.
+
+        Returns a DataFrame indexed by date, or None if there are no days to calculate.
+        """
+
+        stats = self["user_sketches"]
+        start = pd.Timestamp(start)
+
+        # Pull the sketches for every day we need, and the 29 days before them
+        days = pd.read_sql(
+            "SELECT timestamp, users FROM {} WHERE timestamp > %(earliest)s "
+            "ORDER BY timestamp".format(stats.table),
+            stats.engine,
+            params={"earliest": (start - timedelta(days=30)).to_pydatetime()},
+        )
+        dates = pd.DatetimeIndex(days["timestamp"])
+        if not len(dates) or dates.max() <= start - timedelta(days=1):
+            return None
+
+        # One row of registers per day, with empty sketches for days without events
+        all_dates = pd.date_range(dates.min(), dates.max(), freq="D")
+        registers = np.zeros((len(all_dates), len(days.loc[0, "users"])), dtype=np.uint8)
+        for position, users in zip(all_dates.get_indexer(dates), days["users"]):
+            registers[position] = np.frombuffer(bytes(users), dtype=np.uint8)
+
+        stickiness = pd.DataFrame(index=all_dates)
+        stickiness.index.name = "timestamp"
+        stickiness["dau"] = sketch.estimate(registers)
+        stickiness["wau"] = sketch.estimate(_rolling_max(registers, 7))
+        stickiness["mau"] = sketch.estimate(_rolling_max(registers, 30))
+        stickiness = stickiness.round().astype(int)
+
+        return stickiness[stickiness.index > start - timedelta(days=1)]
+
+    def _sessions_sql(self, duration, event_id_col, last_entry):
+        """
+        Calculate sessions inside PostgreSQL. Window functions flag the events that start a new
+        session and number sessions with a running sum, and the results are inserted straight
+        into the sessions and event/session map tables.
+        """
+
+        stats = self["sessions"]
+        event_session_map = self["event_session_map"]
+        _create_table_if_missing(stats, SESSIONS_SCHEMA, SESSIONS_INDEXES)
+        _create_table_if_missing(
+            event_session_map, EVENT_SESSION_MAP_SCHEMA, EVENT_SESSION_MAP_INDEXES
+        )
+
+        conditions = "{} IS NOT NULL".format(self.tracker.user_field)
+        if last_entry:
+            conditions += " AND {} > %(last_entry)s".format(self.tracker.timestamp_field)
+
+        query = _SESSIONS_QUERY.format(
+            event_id=event_id_col,
+            user=self.tracker.user_field,
+            timestamp=self.tracker.timestamp_field,
+            table=self.tracker.table,
+            conditions=conditions,
+            sessions_table=stats.table,
+            map_table=event_session_map.table,
+        )
+        params = {"duration": duration, "last_entry": last_entry}
+
+        with self.tracker.engine.begin() as connection:
+            connection.execute(query, params)
+        self._save_watermark(event_session_map)
+
+    def _sessions_parallel(self, duration, event_id_col, last_entry, workers, shards=None):
+        """
+        Calculate sessions for shards of users in a pool of processes, each of which pulls,
+        sessionises and writes its own users' events. A shard that fails is attempted again; if
+        one still fails, every shard's new sessions are removed before the exception is raised,
+        so that the next run starts from the same place.
+        """
+
+        shards = shards or workers
+        stats = self["sessions"]
+        event_session_map = self["event_session_map"]
+        _create_table_if_missing(stats, SESSIONS_SCHEMA, SESSIONS_INDEXES)
+        _create_table_if_missing(
+            event_session_map, EVENT_SESSION_MAP_SCHEMA, EVENT_SESSION_MAP_INDEXES
+        )
+
+        # Workers connect to the database themselves, so they're started fresh rather than forked
+        # with this process's connections
+        config = dict(
+            db=self.tracker.db,
+            table=self.tracker.table,
+            user_field=self.tracker.user_field,
+            timestamp_field=self.tracker.timestamp_field,
+            partition=self.partition,
+        )
+        args = (duration, event_id_col, last_entry)
+
+        pending = list(range(shards))
+        failures = {}
+        pool = multiprocessing.get_context("spawn").Pool(processes=min(workers, shards))
+        try:
+            for _ in range(_SHARD_ATTEMPTS):
+                results = [
+                    (shard, pool.apply_async(_sessions_shard, (config,) + args + (shard, shards)))
+                    for shard in pending
+                ]
+                failures = {}
+                for shard, result in results:
+                    try:
+                        result.get()
+                    except Exception as exception:
+                        failures[shard] = exception
+                pending = sorted(failures)
+                if not pending:
+                    break
+        finally:
+            pool.close()
+            pool.join()
+
+        if pending:
+            self._delete_sessions(last_entry)
+            raise failures[pending[0]]
+
+        self._save_watermark(event_session_map)
+
+    def _sessions_shard(self, duration, event_id_col, last_entry, shard, shards):
+        """
+        Calculate the sessions of one shard of users, replacing any that an earlier attempt at
+        the same shard wrote.
+
+        Returns the number of sessions written.
+        """
+
+        condition = _SHARD_CONDITION.format(user=self.tracker.user_field)
+        query = "SELECT {}, {}, {} FROM {} WHERE {} IS NOT NULL AND {}".format(
+            event_id_col,
+            self.tracker.user_field,
+            self.tracker.timestamp_field,
+            self.tracker.table,
+            self.tracker.user_field,
+            condition,
+        )
+        if last_entry:
+            query += " AND {} > %(last_entry)s".format(self.tracker.timestamp_field)
+        params = {"last_entry": last_entry, "shard": shard, "shards": shards}
+        events = pd.read_sql(query, self.tracker.engine, params=params)
+
+        self._delete_sessions(last_entry, shard, shards)
+        if len(events) == 0:
+            return 0
+
+        session_data, event_session_map_data = _sessionize(
+            events, duration, event_id_col, self.tracker.user_field, self.tracker.timestamp_field
+        )
+        self["sessions"].write_dataframe(session_data)
+        self["event_session_map"].write_dataframe(event_session_map_data)
+        return len(session_data)
+
+    def _delete_sessions(self, last_entry, shard=None, shards=None):
+        """Remove the sessions after last_entry, of one shard of users if shard is given."""
+
+        conditions = []
+        if last_entry:
+            conditions.append("timestamp > %(last_entry)s")
+        if shard is not None:
+            conditions.append(_SHARD_CONDITION.format(user="user_id"))
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        params = {"last_entry": last_entry, "shard": shard, "shards": shards}
+
+        with self.tracker.engine.begin() as connection:
+            for name in ("sessions", "event_session_map"):
+                connection.execute("DELETE FROM {}{}".format(self[name].table, where), params)
+
+    def _last_entry(self, tracker):
+        """
+        Find the latest timestamp in a derived table, from its watermark and any rows after it, so
+        that rows removed for retention are still accounted for. Returns None if the table doesn't
+        exist or has never held data.
+        """
+
+        watermark = self._watermark(tracker)
+        query = "SELECT MAX(timestamp) AS timestamp FROM {}".format(tracker.table)
+        if watermark is not None:
+            query += " WHERE timestamp > %(watermark)s"
+
+        try:  # if this passes, the table exists and may contain data
+            last_entry = pd.read_sql(query, tracker.engine, params={"watermark": watermark}).loc[
+                0, "timestamp"
+            ]
+        except ProgrammingError:  # otherwise, the table doesn't exist
+            return None
+
+        return watermark if pd.isnull(last_entry) else last_entry
+
+    def _watermark(self, tracker):
+        """The latest timestamp recorded for a derived table, or None if there isn't one."""
+        watermarks = self["watermarks"]
+        try:
+            rows = pd.read_sql(
+                "SELECT timestamp FROM {} WHERE name = %(name)s".format(watermarks.table),
+                watermarks.engine,
+                params={"name": tracker.table},
+            )
+        except ProgrammingError:  # the watermarks table doesn't exist yet
+            return None
+        return rows.loc[0, "timestamp"] if len(rows) else None
+
+    def _save_watermark(self, tracker):
+        """Record the latest timestamp in a derived table, after writing to it."""
+
+        last_entry = self._last_entry(tracker)
+        if last_entry is None:
+            return
+
+        watermarks = self["watermarks"]
+        _create_table_if_missing(watermarks, WATERMARKS_SCHEMA)
+        with watermarks.engine.begin() as connection:
+            connection.execute(
+                "INSERT INTO {0} (name, timestamp) VALUES (%(name)s, %(timestamp)s) "
+                "ON CONFLICT (name) DO UPDATE SET "
+                "timestamp = GREATEST({0}.timestamp, EXCLUDED.timestamp)".format(watermarks.table),
+                {"name": tracker.table, "timestamp": last_entry.to_pydatetime()},
+            )
+
+    def _clear_watermarks(self, *trackers):
+        """Forget the watermarks of derived tables that have been dropped."""
+        watermarks = self["watermarks"]
+        if _table_exists(watermarks):
+            with watermarks.engine.begin() as connection:
+                connection.execute(
+                    "DELETE FROM {} WHERE name = ANY(%(names)s)".format(watermarks.table),
+                    {"names": [tracker.table for tracker in trackers]},
+                )
+
+
+def _sessions_shard(config, *args):
+    """Calculate the sessions of one shard of users, in a worker process."""
+    config = dict(config)
+    partition = config.pop("partition")
+    return Statistics(Tracker(**config), partition=partition)._sessions_shard(*args)
+
+
+def _create_table_if_missing(tracker, schema, indexes=()):
+    """
+    Create a derived table with the given schema, unless it already exists, partitioned if its
+    tracker is, and make sure it has the given indexes.
+    """
+
+    if tracker.partition is None:
+        fields = ", ".join("{} {}".format(name, field_type) for name, field_type in schema.items())
+        tracker.query("CREATE TABLE IF NOT EXISTS {} ({})".format(tracker.table, fields))
+    elif not _table_exists(tracker):
+        tracker.schema = schema
+        tracker.create_table()
+
+    for columns in indexes:
+        tracker.query(
+            "CREATE INDEX IF NOT EXISTS {0}_{1}_idx ON {0} ({2})".format(
+                tracker.table, "_".join(columns), ", ".join(columns)
+            )
+        )
+
+
+def _table_exists(tracker):
+    """Whether a tracker's table exists."""
+    return (
+        pd.io.sql.execute(
+            "SELECT to_regclass(%(table)s)", tracker.engine, params={"table": tracker.table}
+        ).scalar()
+        is not None
+    )
+
+
+# Users are split into shards by a hash of their id as text
+_SHARD_CONDITION = (
+    "MOD(MOD(hashtext({user}::text), %(shards)s) + %(shards)s, %(shards)s) = %(shard)s"
+)
+
+# Like pandas' Timedelta.seconds, which the pandas method uses, this ignores whole days
+_SECONDS = "MOD(FLOOR(EXTRACT(EPOCH FROM {}))::BIGINT, 86400)"
+
+# Sessionise events inside the database, writing both derived tables in a single scan
+_SESSIONS_QUERY = (
+    "WITH events AS ("
+    "    SELECT {event_id} AS event_id, {user} AS user_id, {timestamp} AS timestamp, "
+    "        CASE WHEN LAG({timestamp}) OVER w IS NULL THEN 1 "
+    "        WHEN " + _SECONDS.format("{timestamp} - LAG({timestamp}) OVER w") + " / 60.0 "
+    "            > %(duration)s THEN 1 "
+    "        ELSE 0 END AS new_session "
+    "    FROM {table} WHERE {conditions} "
+    "    WINDOW w AS (PARTITION BY {user} ORDER BY {timestamp}, {event_id})"
+    "), numbered AS ("
+    "    SELECT event_id, user_id, timestamp, SUM(new_session) OVER ("
+    "        PARTITION BY user_id ORDER BY timestamp, event_id ROWS UNBOUNDED PRECEDING"
+    "    ) AS session_number FROM events"
+    "), sessions AS ("
+    "    INSERT INTO {sessions_table} (timestamp, user_id, duration, total_events) "
+    "    SELECT MIN(timestamp), user_id, "
+    + _SECONDS.format("MAX(timestamp) - MIN(timestamp)")
+    + " / 60.0, COUNT(*) "
+    "    FROM numbered GROUP BY user_id, session_number ORDER BY MIN(timestamp)"
+    ") "
+    "INSERT INTO {map_table} (event_id, user_id, timestamp, session_timestamp) "
+    "SELECT event_id, user_id, timestamp, "
+    "    MIN(timestamp) OVER (PARTITION BY user_id, session_number) AS session_timestamp "
+    "FROM numbered ORDER BY session_timestamp"
+)
+
+
+# Count each user's new sessions, and record the first day of any weekly or monthly window that
+# each new session falls in, as _rolling_distinct does
+_ENGAGEMENT_STATE_QUERY = (
+    "WITH watermark AS ("
+    "    SELECT MAX(last_session) AS timestamp FROM {counts_table}"
+    "), new_sessions AS ("
+    "    SELECT s.{user} AS user_id, s.timestamp FROM {sessions_table} s, watermark w "
+    "    WHERE s.{user} IS NOT NULL AND (w.timestamp IS NULL OR s.timestamp > w.timestamp)"
+    "), daily_users AS ("
+    "    INSERT INTO {daily_users_table} (timestamp, user_id) "
+    "    SELECT DISTINCT date_trunc('day', timestamp - INTERVAL '1 microsecond'), user_id "
+    "    FROM new_sessions ON CONFLICT DO NOTHING"
+    ") "
+    "INSERT INTO {counts_table} (user_id, sessions, last_session) "
+    "SELECT user_id, COUNT(*), MAX(timestamp) FROM new_sessions GROUP BY user_id "
+    "ON CONFLICT (user_id) DO UPDATE SET "
+    "sessions = {counts_table}.sessions + EXCLUDED.sessions, "
+    "last_session = GREATEST({counts_table}.last_session, EXCLUDED.last_session)"
+)
+
+# DAU from the sessions since start, and WAU and MAU from the per-day users in each window
+_INCREMENTAL_ENGAGEMENT_QUERY = (
+    "WITH dau AS ("
+    "    SELECT date_trunc('day', s.timestamp) AS timestamp, COUNT(DISTINCT s.{user}) AS dau, "
+    "        COUNT(DISTINCT s.{user}) FILTER (WHERE c.sessions >= %(min_sessions)s) AS dau_active "
+    "    FROM {sessions_table} s LEFT JOIN {counts_table} c ON c.user_id = s.{user} "
+    "    WHERE s.timestamp > %(start)s GROUP BY 1"
+    "), dates AS ("
+    "    SELECT generate_series(MIN(timestamp), MAX(timestamp), INTERVAL '1 day') AS timestamp "
+    "    FROM dau"
+    ") "
+    "SELECT dates.timestamp, COALESCE(MAX(dau.dau), 0) AS dau, "
+    "    COALESCE(MAX(dau.dau_active), 0) AS dau_active, "
+    "    COUNT(DISTINCT d.user_id) FILTER ("
+    "        WHERE d.timestamp > dates.timestamp - INTERVAL '7 days'"
+    "    ) AS wau, "
+    "    COUNT(DISTINCT d.user_id) AS mau, "
+    "    COUNT(DISTINCT d.user_id) FILTER ("
+    "        WHERE d.timestamp > dates.timestamp - INTERVAL '7 days' "
+    "        AND c.sessions >= %(min_sessions)s"
+    "    ) AS wau_active, "
+    "    COUNT(DISTINCT d.user_id) FILTER (WHERE c.sessions >= %(min_sessions)s) AS mau_active "
+    "FROM dates LEFT JOIN dau ON dau.timestamp = dates.timestamp "
+    "LEFT JOIN {daily_users_table} d ON d.timestamp > dates.timestamp - INTERVAL '30 days' "
+    "    AND d.timestamp <= dates.timestamp "
+    "LEFT JOIN {counts_table} c ON c.user_id = d.user_id "
+    "GROUP BY dates.timestamp ORDER BY dates.timestamp"
+)
+
+
+def _rolling_distinct(users, timestamps, dates, days):
+    """
+    For each date, count the distinct users with a timestamp after `date - days` and no later
+    than `date + 1 day`, as Statistics.engagement defines weekly and monthly windows.
+
+    Rather than querying each window, this works out which windows each timestamp falls into,
+    merges each user's overlapping windows, and sums the resulting +1 / -1 steps over time.
+
+    Returns a Series of counts indexed by date.
+    """
+
+    valid = users.notnull()
+    users = users[valid]
+    timestamps = pd.to_datetime(timestamps[valid])
+
+    if not len(users):
+        return pd.Series(0, index=dates)
+
+    # A timestamp is counted on every date from the first whose window contains it, for days + 1
+    # days; a user only needs counting once however many of their timestamps a window contains
+    first = (timestamps - timedelta(days=1)).dt.ceil("D")
+    windows = pd.DataFrame({"user": users.values, "first": first.values}).drop_duplicates()
+    windows = windows.sort_values(["user", "first"])
+
+    # Each user's span of dates ends when it runs out, or where their next span begins
+    end = windows["first"] + timedelta(days=days + 1)
+    next_first = windows.groupby("user")["first"].shift(-1)
+    end = end.where(~(next_first < end), next_first)
+
+    # Sum the steps where users enter and leave the count
+    steps = pd.concat([pd.Series(1, index=windows["first"]), pd.Series(-1, index=end.values)])
+    counts = steps.groupby(level=0).sum().sort_index().cumsum()
+
+    return counts.reindex(dates, method="ffill").fillna(0).astype(int)
+
+
+def _rolling_max(registers, days):
+    """Merge each row of sketch registers with those of the days - 1 rows before it."""
+    merged = registers.copy()
+    for shift in range(1, days):
+        merged[shift:] = np.maximum(merged[shift:], registers[:-shift])
+    return merged
+
+
+def _sessionize(events, duration, event_id_col, user_field, timestamp_field):
+    """
+    Split each user's events into sessions, where a session ends when more than `duration`
+    minutes pass between consecutive events. This is done in a single pass over all users : sort
+    by user and time, flag the events that start a new session, and number sessions with a
+    cumulative sum of those flags.
+
+    Returns a DataFrame of sessions, and a DataFrame mapping each event to its session.
+    """
+
+    # Sort events by user, then by time
+    events = events.sort_values([user_field, timestamp_field], kind="mergesort")
+    events = events.reset_index(drop=True)
+    users = events[user_field]
+    times = events[timestamp_field]
+
+    # A session starts at a user's first event, or after a long enough gap between events
+    time_between = times.diff()
+    new_user = users != users.shift()
+    new_session = new_user | (time_between.dt.seconds / 60 > duration)
+    session_ids = new_session.cumsum()
+
+    # Summarise each session
+    session_times = times.groupby(session_ids)
+    session_starts = session_times.first()
+    session_data = pd.DataFrame(
+        {
+            "timestamp": session_starts.values,
+            "user_id": users.groupby(session_ids).first().values,
+            "duration": (session_times.last() - session_starts).dt.seconds.values / 60,
+            "total_events": session_times.size().values,
+        },
+        columns=["timestamp", "user_id", "duration", "total_events"],
+    )
+
+    # Map each event to the start of its session
+    event_session_map_data = pd.DataFrame(
+        {
+            "event_id": events[event_id_col].values,
+            "user_id": users.values,
+            "timestamp": times.values,
+            "session_timestamp": session_starts.loc[session_ids].values,
+        },
+        columns=["event_id", "user_id", "timestamp", "session_timestamp"],
+    )
+
+    session_data = session_data.sort_values("timestamp", kind="mergesort")
+    event_session_map_data = event_session_map_data.sort_values(
+        "session_timestamp", kind="mergesort"
+    )
+
+    return session_data, event_session_map_data
@@ -1,10 +1,60 @@
 from collections import OrderedDict
+import atexit
+import hashlib
+import itertools
 import json
+import re
+import threading
+import time
+import weakref
 from datetime import datetime
 from warnings import warn
+import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine
-from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.exc import DBAPIError, ProgrammingError
+
+from pawprint import arrow, sketch
+from pawprint.serialize import NATIVE_TYPES, json_encoder
+from pawprint.cache import QueryCache, cache_key
+from pawprint.dialects import _missing, dialect_for, text_parameter, to_positional
+from pawprint.query import Query
+from pawprint.spool import Spool
+from pawprint.writer import BackgroundWriter
+
+# Connection engines, and so connection pools, shared by all trackers on the same database
+_engines = {}
+_engines_lock = threading.Lock()
+
+# Rollup resolutions, from finest to coarsest; every one but week nests into those after it
+_ROLLUP_RESOLUTIONS = ("minute", "hour", "day", "week", "month", "quarter", "year")
+
+# Parquet exports are partitioned by formatting the timestamp
+_PARTITION_FORMATS = OrderedDict([("day", "YYYY-MM-DD"), ("month", "YYYY-MM"), ("year", "YYYY")])
+
+# The most INSERT queries, one per set of fields, that a tracker keeps
+_MAX_INSERT_QUERIES = 1000
+
+# Kinds of column, by type, that values are serialised for on write; values for columns of any
+# other type are sent as they are, if the driver can adapt them
+_TEXT, _JSON = "text", "json"
+_TEXT_TYPES = re.compile(r"(?i)^\s*(TEXT|VARCHAR|CHAR|CHARACTER|CITEXT|NAME)\b")
+_JSON_TYPES = re.compile(r"(?i)^\s*JSONB?\b")
+
+# The type of a column in the schema, without its size, constraints or default
+_COLUMN_TYPE = re.compile(
+    r"(?i)^\s*([A-Z][A-Z ]*?)\s*"
+    r"(?:\(|\b(?:PRIMARY|NOT|NULL|DEFAULT|UNIQUE|REFERENCES|CHECK|CONSTRAINT|COLLATE)\b|$)"
+)
+_SERIAL_TYPES = {"SMALLSERIAL": "SMALLINT", "SERIAL": "INTEGER", "BIGSERIAL": "BIGINT"}
+
+# Resolutions at which distinct user counts can be estimated by merging daily sketches
+_SKETCH_RESOLUTIONS = ("day", "week", "month", "quarter", "year")
+
+# Tables can be range partitioned on the timestamp, one partition per period; partitions are named
+# by formatting the start of their period
+_TABLE_PARTITIONS = OrderedDict(
+    [("day", ("D", "%Y_%m_%d")), ("month", ("M", "%Y_%m")), ("year", ("Y", "%Y"))]
+)
 
 
 class Tracker(object):
@@ -15,29 +65,82 @@ class Tracker(object):
     def __init__(self, **kwargs):
 
         # Parse inputs by merging config files and locally-passed arguments
-        if "dotfile" in kwargs:
-            with open(kwargs["dotfile"], "r") as f:
-                config = json.load(f)
-                config.update(kwargs)
-        else:
-            config = kwargs
-
-        # Set a default schema if none is passed
-        if "schema" not in config:
-            config["schema"] = OrderedDict(
-                [
-                    ("id", "SERIAL PRIMARY KEY"),
-                    ("timestamp", "TIMESTAMP DEFAULT CURRENT_TIMESTAMP"),
-                    ("user_id", "TEXT"),
-                    ("event", "TEXT"),
-                    ("metadata", "JSONB"),
-                ]
-            )
-        else:  # If a schema is passed, ensure it's an ordered dict
-            if not isinstance(config["schema"], OrderedDict) and isinstance(config["schema"], dict):
-                config["schema"] = OrderedDict(config["schema"])
+        config = _load_config(kwargs)
 
         # Save the database properties
+        self._configure(config)
+
+        # Buffered writes : flush once this many events are queued, or once the oldest is this old
+        self.buffer_size = config.get("buffer_size", None)
+        self.buffer_age = config.get("buffer_age", None)
+        self._buffer = []
+        self._buffer_time = None
+        self._buffer_lock = threading.Lock()
+        self._buffer_timer = None
+
+        # Spool : events that can't be written because the database is unavailable, or every event
+        # in "defer" mode, are appended to files under spool_path and replayed by a worker thread
+        self.spool_mode = config.get("spool_mode", "fallback")
+        if self.spool_mode not in ("fallback", "defer"):
+            raise ValueError("spool_mode must be one of 'fallback' or 'defer'")
+        self._spool = None
+        if config.get("spool_path"):
+            self._spool = Spool(
+                config["spool_path"], max_bytes=config.get("spool_max_bytes", 1024**3)
+            )
+
+        # Background writes : events are queued and written to the database by a worker thread
+        self._writer = None
+        if config.get("background", False):
+            self._writer = BackgroundWriter(
+                self._write_events,
+                queue_size=config.get("queue_size", 10000),
+                batch_size=self.buffer_size or 1000,
+                backpressure=config.get("backpressure", "block"),
+                spill_path=config.get("spill_path", None),
+                retry_on=self.dialect.unavailable,
+            )
+
+        # Make sure queued events are written when the interpreter shuts down
+        if self.buffered or self._writer is not None or self._spool is not None:
+            atexit.register(_close_at_exit, weakref.ref(self))
+
+        # Query cache : results of reads and aggregates are kept for up to cache_ttl seconds, in at
+        # most cache_size bytes, until this tracker writes to the table. By default, it's off
+        self._cache = None
+        if config.get("cache_size"):
+            self._cache = QueryCache(config["cache_size"], ttl=config.get("cache_ttl", 60))
+
+        # JSON fields are encoded with the fastest JSON library installed, unless one is named
+        self._encode_json = json_encoder(config.get("json_encoder", None))
+
+        # INSERT queries by set of fields, and whether to run them as prepared statements
+        self.prepare = config.get("prepare", False)
+        if self.prepare:
+            self._postgres_only("Prepared statements")
+        self._insert_queries = {}
+
+        # Connection pool settings
+        self.pool_size = config.get("pool_size", 5)
+        self.max_overflow = config.get("max_overflow", 10)
+        self.pool_pre_ping = config.get("pool_pre_ping", False)
+
+        # Get the connection engine, shared with other trackers on the same database
+        self.engine = None
+        if self.db is not None:
+            self.engine = _get_engine(
+                self.db,
+                pool_size=self.pool_size,
+                max_overflow=self.max_overflow,
+                pool_pre_ping=self.pool_pre_ping,
+            )
+
+        # Replay spooled events every spool_interval seconds
+        if self._spool is not None and self.engine is not None:
+            self._spool.start(self._replay_spool, interval=config.get("spool_interval", 5))
+
+    def _configure(self, config):
+        """Save the database and table properties shared by all kinds of tracker."""
         self.db = config.get("db", None)
         self.table = config.get("table", None)
         self.logger = config.get("logger", None)
@@ -46,24 +149,225 @@ class Tracker(object):
         self.timestamp_field = config.get("timestamp_field", "timestamp")
         self.auto_timestamp = config.get("auto_timestamp", False)
         self.schema = config["schema"]
-
-        # Create the connection engine
-        if self.db is not None:
-            self.engine = create_engine(self.db)
-
-    def create_table(self):
+        self.event_field = config.get("event_field", "event")
+        self.rollups = config.get("rollups", {})
+        self.partition = config.get("partition", None)
+
+        # The SQL that differs between databases is built by the database's dialect
+        self.dialect = dialect_for(self.db)
+
+        # The kind of each field's column, worked out from the schema the first time it's needed
+        self._field_kinds = None
+        self._field_kinds_schema = None
+
+    @property
+    def buffered(self):
+        """Whether writes are queued in memory and sent to the database in batches."""
+        return bool(self.buffer_size or self.buffer_age is not None)
+
+    @property
+    def events(self):
+        """A lazy query over the table's events, to be filtered and aggregated; see Query."""
+        return Query(self)
+
+    @property
+    def counters(self):
+        """Counts of queued, written, dropped, spilled and failed events in background mode."""
+        if self._writer is None:
+            return {}
+        return dict(self._writer.counters)
+
+    @property
+    def cache_counters(self):
+        """Counts of query cache hits, misses and evictions, if caching is on."""
+        if self._cache is None:
+            return {}
+        return dict(self._cache.counters, entries=len(self._cache), bytes=self._cache.size)
+
+    @property
+    def spool_counters(self):
+        """Counts of spooled, replayed, dropped and rejected events, and the spool's depth."""
+        if self._spool is None:
+            return {}
+        return dict(self._spool.counters, depth=self._spool.depth, bytes=self._spool.size)
+
+    def create_table(self, partition=None, indexes=False):
         """
         Create a database with the correct schema.
+
+        If partition is one of "day", "month" or "year", the table is range partitioned on the
+        timestamp field, with a partition for the current period and the next few; see
+        .maintain_partitions(). If indexes is True, the timestamp, user and event fields get B-tree
+        indexes and the JSON field a GIN index.
         """
 
-        # Build a query from the schema
+        partition = partition or self.partition
+        if partition is not None and partition not in _TABLE_PARTITIONS:
+            raise ValueError(
+                "Tables can only be partitioned by {}".format(", ".join(_TABLE_PARTITIONS))
+            )
+        if partition is not None:
+            self._postgres_only("Partitioning")
+            if self.timestamp_field not in self.schema:
+                raise ValueError("Partitioned tables need a timestamp field in their schema.")
+
+        # Execute the query to create the table.
+        pd.io.sql.execute(self._create_table_query(partition), self.engine)
+        self._invalidate_cache()
+
+        if indexes:
+            self._create_indexes()
+
+        if partition is not None:
+            self.partition = partition
+            self.maintain_partitions()
+
+    def _create_table_query(self, partition=None):
+        """Build the query that creates the table from the schema."""
+
         fields = ", ".join(
-            "{} {}".format(field_name, field_type) for field_name, field_type in self.schema.items()
+            "{} {}".format(field_name, self.dialect.schema_type(field_type))
+            for field_name, field_type in self.schema.items()
         )
         query = "CREATE TABLE {} ({})".format(self.table, fields)
 
-        # Execute the query to create the table.
-        pd.io.sql.execute(query, self.engine)
+        # A partitioned table's primary key has to include the timestamp
+        if partition is not None:
+            keys = [
+                field_name
+                for field_name, field_type in self.schema.items()
+                if "PRIMARY KEY" in field_type.upper()
+            ]
+            if keys:
+                fields = ", ".join(
+                    "{} {}".format(field_name, re.sub(r"(?i)\s*PRIMARY KEY", "", field_type))
+                    for field_name, field_type in self.schema.items()
+                )
+                if self.timestamp_field not in keys:
+                    keys.append(self.timestamp_field)
+                fields += ", PRIMARY KEY ({})".format(", ".join(keys))
+            query = "CREATE TABLE {} ({}) PARTITION BY RANGE ({}); ".format(
+                self.table, fields, self.timestamp_field
+            )
+            # Events outside every partition land in a default one, rather than failing
+            query += "CREATE TABLE {0}_default PARTITION OF {0} DEFAULT".format(self.table)
+
+        return query
+
+    def maintain_partitions(self, ahead=3, retention=None, drop=False):
+        """
+        Create partitions for the current period and the next few, and for any events that have
+        landed in the default partition. Run this regularly, say daily, so that new events always
+        have a partition to go to.
+
+        If retention is a number of days, partitions whose events are all older than that are
+        detached from the table, so they can be archived, or dropped if drop is True.
+
+        Returns a dict with the names of the partitions created, and of those removed, whether they
+        were detached or dropped, as "created" and "removed".
+        """
+
+        self._postgres_only("Partitioning")
+        if self.partition is None:
+            raise ValueError("Pass partition to create_table(), or to the tracker, to partition.")
+        freq, name_format = _TABLE_PARTITIONS[self.partition]
+
+        with self.engine.begin() as connection:
+            rows = connection.execute(
+                "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+                "FROM pg_inherits AS i JOIN pg_class AS c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = %(table)s::regclass",
+                {"table": self.table},
+            ).fetchall()
+            default = "{}_default".format(self.table)
+
+            # The end of each partition's range; the default partition has none
+            ends = {}
+            for name, bound in rows:
+                end = re.search(r"TO \('([^']+)'\)", bound)
+                ends[name] = pd.Timestamp(end.group(1)).replace(tzinfo=None) if end else None
+
+            # Partition the coming periods, and any periods with events in the default partition
+            now = pd.Timestamp(datetime.now()).to_period(freq)
+            periods = {now + i for i in range(ahead + 1)}
+            if default in ends:
+                starts = connection.execute(
+                    "SELECT DISTINCT date_trunc(%(partition)s, {}) FROM {} WHERE {} IS NOT NULL".format(
+                        self.timestamp_field, default, self.timestamp_field
+                    ),
+                    {"partition": self.partition},
+                ).fetchall()
+                periods.update(pd.Timestamp(start).to_period(freq) for start, in starts)
+
+            created = []
+            for period in sorted(periods):
+                name = "{}_{}".format(self.table, period.start_time.strftime(name_format))
+                if name in ends:
+                    continue
+                params = {
+                    "lo": period.start_time.to_pydatetime(),
+                    "hi": (period + 1).start_time.to_pydatetime(),
+                }
+                connection.execute(_PARTITION_CREATE_QUERY.format(table=self.table, partition=name))
+                if default in ends:
+                    connection.execute(
+                        _PARTITION_MOVE_QUERY.format(
+                            partition=name, default=default, timestamp=self.timestamp_field
+                        ),
+                        params,
+                    )
+                connection.execute(
+                    "ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (%(lo)s) TO (%(hi)s)".format(
+                        self.table, name
+                    ),
+                    params,
+                )
+                created.append(name)
+                ends[name] = (period + 1).start_time
+
+            # Remove partitions that end at or before the retention cutoff
+            removed = []
+            if retention is not None:
+                cutoff = pd.Timestamp(datetime.now()) - pd.Timedelta(days=retention)
+                for name, end in sorted(ends.items()):
+                    if end is None or end > cutoff:
+                        continue
+                    connection.execute(
+                        "ALTER TABLE {} DETACH PARTITION {}".format(self.table, name)
+                    )
+                    if drop:
+                        connection.execute("DROP TABLE {}".format(name))
+                    removed.append(name)
+
+        self._invalidate_cache()
+        return {"created": created, "removed": removed}
+
+    def _create_indexes(self):
+        """Index the fields that reads, aggregates and statistics filter on."""
+        for query in self._index_queries():
+            self.query(query)
+
+    def _index_queries(self):
+        """Build the queries that create the indexes, if they don't exist already."""
+        queries = []
+        if self.timestamp_field in self.schema:
+            queries.append(("timestamp", "({})".format(self.timestamp_field)))
+        for name, field in (("user", self.user_field), ("event", self.event_field)):
+            if field in self.schema:
+                if self.timestamp_field in self.schema:
+                    queries.append((name, "({}, {})".format(field, self.timestamp_field)))
+                else:
+                    queries.append((name, "({})".format(field)))
+        if (
+            self.schema.get(self.json_field, "").upper() == "JSONB"
+            and self.dialect.name == "postgresql"
+        ):
+            queries.append(("json", "USING GIN ({})".format(self.json_field)))
+
+        return [
+            "CREATE INDEX IF NOT EXISTS {0}_{1}_idx ON {0} {2}".format(self.table, name, columns)
+            for name, columns in queries
+        ]
 
     def drop_table(self):
         """Delete an existing table."""
@@ -75,89 +379,854 @@ class Tracker(object):
 
     def write(self, **data):
         """
-        Send a generic event to the user metrics database.
+        Send a generic event to the user metrics database. In buffered mode, the event is queued
+        and only written when the buffer is flushed; in background mode, it's handed to the
+        writer thread and this returns immediately.
         """
 
         # If we're autopopulating a timestamp and it isn't provided, add it
         if self.auto_timestamp and self.timestamp_field not in data:
             data[self.timestamp_field] = datetime.now()
 
-        # Parse the field headers
-        fields = ", ".join(data.keys())
-
-        values = data.values()
-        new_values = []
-        for value in values:
-            if isinstance(value, dict):
-                new_values.append(json.dumps(value))
-            else:
-                new_values.append(str(value))
-        values = new_values
-
-        # Build the PostgreSQL query
-        placeholders = "{}".format(", ".join(["%s"] * len(values)))
-        query = "INSERT INTO {table} ({fields}) VALUES ({placeholders});".format(
-            table=self.table, fields=fields, placeholders=placeholders
-        )
+        # In defer mode, spool the event for the replay worker to write
+        if self._spool is not None and self.spool_mode == "defer":
+            self._spool_events([data])
+            return
+
+        # In background mode, queue the event for the writer thread
+        if self._writer is not None:
+            self._writer.put(data)
+            return
+
+        # In buffered mode, queue the event and flush if we've hit the size or age threshold; a
+        # timer flushes the buffer once it reaches the age threshold, even if nothing else is
+        # written
+        if self.buffered:
+            with self._buffer_lock:
+                self._buffer.append(data)
+                if self._buffer_time is None:
+                    self._buffer_time = time.time()
+                    if self.buffer_age:
+                        self._start_buffer_timer(self.buffer_age)
+                full = self._buffer_full()
+            if full:
+                self.flush()
+            return
+
+        # Parse the field headers and values
+        fields, values = self._prepare_row(data)
+
+        # Fetch the PostgreSQL query for this set of fields
+        query = self._insert_query(fields)
 
         # Write to the database
         try:
-            self.engine.execute(query, values)
+            if self.prepare:
+                self._execute_prepared(query, values)
+            else:
+                self.engine.execute(
+                    self.dialect.query(query), [self.dialect.adapt(value) for value in values]
+                )
+            self._invalidate_cache()
 
-        # If the write fails, raise the exception
+        # If the write fails, spool the event if the database is unavailable, or raise the exception
         except Exception as exception:
             if self.db is not None:  # If db is None, fail silently. Otherwise, raise the error
+                self._log_write_failure(query, values, exception)
+                if self._spool is not None and isinstance(exception, self.dialect.unavailable):
+                    self._spool_events([data])
+                    return
+                raise
 
-                # If we have a logger, log the error
-                if self.logger:
-                    # add vars to the query string
-                    query = query.replace("%s", "'{}'").format(*values)
-                    self.logger.warning(
-                        "pawprint failed to write. Table: {}. Query: {}. Exception: {} ({})".format(
-                            self.table, query, exception, exception.args
+    def flush(self):
+        """
+        Write all buffered events to the database as multi-row INSERTs, one per set of fields.
+        In background mode, block until the writer thread has written every queued event. Then
+        try to write any spooled events.
+        """
+
+        if self._writer is not None:
+            self._writer.flush()
+        else:
+            with self._buffer_lock:
+                events, self._buffer = self._buffer, []
+                self._buffer_time = None
+                if self._buffer_timer is not None:
+                    self._buffer_timer.cancel()
+                    self._buffer_timer = None
+            if events:
+                self._write_events(events)
+
+        if self._spool is not None:
+            self._replay_spool()
+
+    def close(self):
+        """
+        Write any queued events and stop the background writer thread, if there is one, and the
+        spool's replay worker.
+        """
+        if self._writer is not None:
+            self._writer.close()
+        if self._spool is not None:
+            self._spool.close()
+        self.flush()
+
+    def write_many(self, events, fields=None):
+        """
+        Bulk-load an iterable of events, each a dict of field values, using PostgreSQL's
+        COPY FROM STDIN, or a single transaction on SQLite. Events are streamed to the database as
+        they're consumed, so generators can be used to load more events than fit in memory.
+
+        If fields aren't passed, they're taken from the first event. Events may omit fields, which
+        are then NULL, but may not include fields that aren't being loaded.
+
+        Returns the number of events written.
+        """
+
+        events = iter(events)
+        try:
+            first = next(events)
+        except StopIteration:
+            return 0
+
+        # Determine which fields we're loading
+        if fields is None:
+            fields = list(first.keys())
+        else:
+            fields = list(fields)
+        if self.auto_timestamp and self.timestamp_field not in fields:
+            fields.append(self.timestamp_field)
+
+        # Check each event, and take its values in the order of the fields, serialised as .write()
+        # serialises them
+        field_set = set(fields)
+        kinds = self._kinds()
+        encode_json = self._encode_json
+        written = 0
+        invalid = None
+
+        def rows():
+            nonlocal written, invalid
+            for data in itertools.chain([first], events):
+                unknown = set(data) - field_set
+                if unknown:
+                    invalid = ValueError(
+                        "Event has fields that aren't being loaded : {}".format(
+                            ", ".join(sorted(unknown))
                         )
                     )
+                    raise invalid  # aborts the COPY
+                if self.auto_timestamp and data.get(self.timestamp_field) is None:
+                    data = dict(data)
+                    data[self.timestamp_field] = datetime.now()
+                written += 1
+                values = (data.get(field) for field in fields)
+                yield [
+                    None if _missing(value) else _serialize(value, kinds.get(field), encode_json)
+                    for field, value in zip(fields, values)
+                ]
 
+        # Stream the events to the database
+        try:
+            connection = self.engine.raw_connection()
+            try:
+                self.dialect.load(connection, self.table, fields, rows(), self._encode_json)
+                connection.commit()
+            finally:
+                connection.close()
+            self._invalidate_cache()
+
+        # If the write fails, log it and raise the exception
+        except Exception as exception:
+            if invalid is not None:  # the events themselves were invalid; nothing was written
+                raise invalid
+            if self.db is None:  # If db is None, fail silently
+                return 0
+            if self.logger:
+                self.logger.warning(
+                    "pawprint failed to bulk write. "
+                    "Table: {}. Fields: {}. Exception: {} ({})".format(
+                        self.table, ", ".join(fields), exception, exception.args
+                    )
+                )
+            raise
+
+        return written
+
+    def write_dataframe(self, df):
+        """
+        Bulk-load a DataFrame whose columns are field names, using COPY FROM STDIN. Missing
+        values are written as NULL.
+
+        Returns the number of events written.
+        """
+
+        fields = [str(column) for column in df.columns]
+        events = (dict(zip(fields, row)) for row in df.itertuples(index=False, name=None))
+        return self.write_many(events, fields=fields)
+
+    def _write_events(self, events):
+        """Write a batch of events, spooling them if the database is unavailable."""
+        try:
+            self._write_batch(events)
+        except self.dialect.unavailable:
+            if self._spool is None:
+                raise
+            self._spool_events(events)
+
+    def _spool_events(self, events):
+        """Append events to the spool, logging any that are dropped because it's full."""
+        spooled = self._spool.append(events)
+        if spooled < len(events) and self.logger:
+            self.logger.warning(
+                "pawprint spool is full; dropped {} events. Table: {}.".format(
+                    len(events) - spooled, self.table
+                )
+            )
+
+    def _replay_spool(self):
+        """Write spooled events to the database, until they run out or it's unavailable."""
+        return self._spool.replay(
+            self._write_batch,
+            batch_size=self.buffer_size or 1000,
+            retry_on=self.dialect.unavailable,
+        )
+
+    def _write_batch(self, events):
+        """
+        Write a list of events in a single transaction, with one multi-row INSERT per set of
+        fields.
+        """
+
+        # Group events by the fields they set, keeping the order in which they were written
+        batches = OrderedDict()
+        for data in events:
+            fields, values = self._prepare_row(data)
+            batches.setdefault(fields, []).append(values)
+
+        # Write all batches in a single transaction
+        try:
+            connection = self.engine.raw_connection()
+            try:
+                for fields, rows in batches.items():
+                    self.dialect.insert_many(connection, self.table, fields, rows)
+                connection.commit()
+            finally:
+                connection.close()
+            self._invalidate_cache()
+
+        # If the write fails, log every event in the failed batch and raise the exception
+        except Exception as exception:
+            if self.db is not None:  # If db is None, fail silently. Otherwise, raise the error
+                for fields, rows in batches.items():
+                    query = self._insert_query(fields)
+                    for values in rows:
+                        self._log_write_failure(query, values, exception)
+                raise
+
+    def _start_buffer_timer(self, delay):
+        """Check the age of the buffer after delay seconds, from a timer thread."""
+        self._buffer_timer = threading.Timer(delay, self._flush_aged)
+        self._buffer_timer.daemon = True
+        self._buffer_timer.start()
+
+    def _flush_aged(self):
+        """Flush the buffer if its oldest event has reached the age threshold, or check again."""
+
+        with self._buffer_lock:
+            self._buffer_timer = None
+            if not self._buffer:
+                return
+            wait = self._buffer_time + self.buffer_age - time.time()
+            if wait > 0:
+                self._start_buffer_timer(wait)
+                return
+
+        try:
+            self.flush()
+        except Exception:  # failed batches are logged by the tracker
+            pass
+
+    def _buffer_full(self):
+        """Determine whether the write buffer has reached its size or age threshold."""
+        if self.buffer_size and len(self._buffer) >= self.buffer_size:
+            return True
+        if self.buffer_age is not None and time.time() - self._buffer_time >= self.buffer_age:
+            return True
+        return False
+
+    def _prepare_row(self, data):
+        """
+        Serialise an event for insertion, as _serialize() does for each field's column.
+
+        Returns a tuple of field names and a list of values.
+        """
+
+        kinds = self._kinds()
+        encode_json = self._encode_json
+        values = [_serialize(value, kinds.get(field), encode_json) for field, value in data.items()]
+        return tuple(data.keys()), values
+
+    def _kinds(self):
+        """
+        The kind of column of each field in the schema : text, JSON, or else the column's type,
+        if it can be told.
+        """
+
+        if self._field_kinds_schema is not self.schema:
+            kinds = {}
+            for field, field_type in self.schema.items():
+                if field == self.json_field or _JSON_TYPES.match(field_type):
+                    kinds[field] = _JSON
+                elif _TEXT_TYPES.match(field_type):
+                    kinds[field] = _TEXT
+                else:
+                    column_type = _COLUMN_TYPE.match(field_type)
+                    if column_type:
+                        column_type = column_type.group(1).upper()
+                        kinds[field] = _SERIAL_TYPES.get(column_type, column_type)
+            self._field_kinds = kinds
+            self._field_kinds_schema = self.schema
+        return self._field_kinds
+
+    def _insert_query(self, fields):
+        """Build the INSERT query for a set of fields, or fetch it if it's been built before."""
+
+        query = self._insert_queries.get(fields)
+        if query is None:
+            if len(self._insert_queries) >= _MAX_INSERT_QUERIES:
+                self._insert_queries.clear()
+            query = "INSERT INTO {table} ({fields}) VALUES ({placeholders});".format(
+                table=self.table,
+                fields=", ".join(fields),
+                placeholders=", ".join(["%s"] * len(fields)),
+            )
+            self._insert_queries[fields] = query
+
+        return query
+
+    def _execute_prepared(self, query, values, fetch=False):
+        """
+        Run a query as a prepared statement, so that PostgreSQL parses and plans it only once per
+        connection. The statements prepared on each pooled connection are tracked in its info.
+        Values are a list, or a dict for a query with named placeholders.
+
+        Errors from the driver are raised as SQLAlchemy's, as they would be for any other query.
+
+        Returns the names of the result's columns and its rows, if fetch is True.
+        """
+
+        query, values = to_positional(query, values)
+        name = "pawprint_{}".format(hashlib.md5(query.encode()).hexdigest()[:16])
+        result = None
+
+        connection = self.engine.raw_connection()
+        try:
+            prepared = connection.info.setdefault("pawprint_prepared", set())
+            try:
+                with connection.cursor() as cursor:
+                    if name not in prepared:
+                        cursor.execute("PREPARE {} AS {}".format(name, query))
+                        prepared.add(name)
+                    if values:
+                        cursor.execute(
+                            "EXECUTE {} ({})".format(name, ", ".join(["%s"] * len(values))), values
+                        )
+                    else:
+                        cursor.execute("EXECUTE {}".format(name))
+                    if fetch:
+                        result = [column[0] for column in cursor.description], cursor.fetchall()
+                connection.commit()
+
+            # Start afresh on this connection, in case the failure left a statement unusable
+            except Exception as exception:
+                error = self.engine.dialect.dbapi.Error
+                try:
+                    connection.rollback()
+                    with connection.cursor() as cursor:
+                        cursor.execute("DEALLOCATE ALL")
+                    connection.commit()
+                except error:  # the connection itself has failed
+                    pass
+                prepared.clear()
+                if isinstance(exception, error):
+                    raise DBAPIError.instance(query, values, exception, error) from exception
                 raise
 
-    def read(self, *fields, **conditionals):
+        finally:
+            connection.close()
+
+        return result
+
+    def _log_write_failure(self, query, values, exception):
+        """If we have a logger, log a failed write along with the query that caused it."""
+        if self.logger:
+            # add vars to the query string
+            query = query.replace("%s", "'{}'").format(*values)
+            self.logger.warning(
+                "pawprint failed to write. Table: {}. Query: {}. Exception: {} ({})".format(
+                    self.table, query, exception, exception.args
+                )
+            )
+
+    def read(self, *fields, ttl=None, **conditionals):
         """
         Pull raw data into a dataframe. If no conditions are passed, pull the whole table.
-        Otherwise, filter based on the conditions specified ( currently only equality ).
+        Otherwise, filter based on the conditions specified ( currently only equality ). If the
+        query cache is on, ttl overrides how many seconds the result is cached for.
         """
+        query, params = self._read_query(*fields, **conditionals)
+        return self._fetch(query, params, ttl)
 
-        # Parse the list of fields to return
+    def read_iter(
+        self, *fields, chunksize=10000, after=None, id_field="id", raw=False, **conditionals
+    ):
+        """
+        Pull raw data lazily, chunksize rows at a time, through a server-side cursor, so tables
+        that don't fit in memory can be read. Takes the same fields and conditions as .read().
+
+        Rows are ordered by timestamp, then id_field. The iterator's .after attribute holds the
+        timestamp and id of the last row read; pass it as after to carry on from that row later.
+
+        Returns an iterator of DataFrames, or of lists of row tuples if raw is True.
+        """
+        return self._read_iter(
+            fields, sorted(conditionals.items()), chunksize, after, id_field, raw
+        )
+
+    def _read_iter(self, fields, conditions, chunksize, after=None, id_field="id", raw=False):
+        """Build the iterator returned by .read_iter(), from a list of conditions and values."""
+
+        self._postgres_only("read_iter")
+
+        # Select the keys we paginate on after the requested fields
+        keys = [self.timestamp_field, id_field]
+        field_query = "{}, {} AS _pawprint_after_timestamp, {} AS _pawprint_after_id".format(
+            self._parse_fields(*fields), *keys
+        )
+
+        conditionals_query, params = self._parse_conditions(conditions)
+        if after is not None:
+            conditionals_query += " AND " if conditionals_query else "WHERE "
+            conditionals_query += "({}, {}) > (%(after_timestamp)s, %(after_id)s)".format(*keys)
+            params.update(after_timestamp=after[0], after_id=after[1])
+
+        query = "SELECT {} FROM {} {} ORDER BY {}, {}".format(
+            field_query, self.table, conditionals_query, *keys
+        )
+        return ReadIterator(self.engine, query, params or None, chunksize, raw, after)
+
+    def read_arrow(self, *fields, **conditionals):
+        """
+        Pull raw data into an Arrow table, with the same fields and conditions as .read(). Rows
+        are streamed with COPY and parsed by Arrow, which is much faster than .read() for large
+        results; JSON fields are returned as JSON strings. Requires pyarrow.
+        """
+        self._postgres_only("Arrow reads")
+        query, params = self._read_query(*fields, **conditionals)
+        return arrow.read_table(self.engine, query, params)
+
+    def export_parquet(self, path, *fields, partition_by="day", **conditionals):
+        """
+        Write raw data, with the same fields and conditions as .read(), to a Parquet dataset in
+        the directory path. By default, the dataset is partitioned by day; pass "month", "year"
+        or None to partition it differently. Requires pyarrow.
+
+        Returns the number of events written.
+        """
+
+        self._postgres_only("Parquet exports")
         field_query = self._parse_fields(*fields)
+        if partition_by is not None:
+            if partition_by not in _PARTITION_FORMATS:
+                raise ValueError(
+                    "partition_by must be one of {}, or None".format(", ".join(_PARTITION_FORMATS))
+                )
+            field_query += ", to_char({}, '{}') AS {}".format(
+                self.timestamp_field, _PARTITION_FORMATS[partition_by], partition_by
+            )
 
-        # Parse the conditions
-        conditionals_query = self._parse_conditionals(**conditionals)
+        conditionals_query, params = self._parse_conditionals(**conditionals)
+        query = "SELECT {} FROM {} {} ORDER BY {}".format(
+            field_query, self.table, conditionals_query, self.timestamp_field
+        )
+        return arrow.write_parquet(
+            self.engine, query, path, params=params or None, partition_by=partition_by
+        )
 
-        query = "SELECT {} FROM {} {}".format(field_query, self.table, conditionals_query)
+    def count(
+        self,
+        count_field="*",
+        resolution="day",
+        start=None,
+        end=None,
+        approximate=False,
+        ttl=None,
+        **conditionals
+    ):
+        """
+        Count events of a given type. Pass approximate=True to estimate distinct user counts from
+        the daily user sketches built by Statistics.sketches().
+        """
+        if approximate:
+            counts = self._approximate_distinct(count_field, resolution, start, end, **conditionals)
+            if counts is not None:
+                return counts
+            warn("No user sketches can answer this count; counting exactly instead.")
+        return self._aggregate(
+            "COUNT", resolution, start, end, count_field, ttl=ttl, **conditionals
+        )
 
-        if "DISTINCT" not in query:
-            query += " ORDER BY {}".format(self.timestamp_field)
+    def aggregate(
+        self,
+        resolution="day",
+        aggs=None,
+        by=(),
+        start=None,
+        end=None,
+        wide=False,
+        ttl=None,
+        **conditionals
+    ):
+        """
+        Calculate several aggregates of events in a single scan, by period and by the values of
+        the fields in by, which may be JSON subfields. aggs maps the name of each aggregate to an
+        (operation, field) pair, as Query.aggregate() takes them, like {"n": ("count", "*"),
+        "p95": ("p95", "metadata__price")}. Pass resolution=None for totals over all time.
+
+        Returns a DataFrame with a row per period and group, and a column per aggregate; or, if
+        wide is True, with a row per period, and a column per aggregate and group.
+        """
+
+        query = self._aggregates_query(resolution, aggs, by, start, end, wide, **conditionals)
+        return _widen(query.to_df(ttl), by, wide)
+
+    def _aggregates_query(self, resolution, aggs, by, start, end, wide, **conditionals):
+        """Build the Query behind .aggregate()."""
 
-        return pd.read_sql(query, self.db)
+        if not aggs:
+            raise ValueError("Pass at least one aggregate in aggs")
+        if wide and resolution is None:
+            raise ValueError("Only aggregates by period can be wide")
 
-    def count(self, count_field="*", resolution="day", start=None, end=None, **conditionals):
-        """Count events of a given type."""
-        return self._aggregate("COUNT", resolution, start, end, count_field, **conditionals)
+        query = Query(self).filter(**conditionals)
+        if start is not None:
+            query = query.where(**{self.timestamp_field + "__gte": start})
+        if end is not None:
+            query = query.where(**{self.timestamp_field + "__lte": end})
+        return query.group_by(*by, resolution=resolution).aggregate(**aggs)
 
-    def sum(self, sum_field, resolution="day", start=None, end=None, **conditionals):
+    def sum(self, sum_field, resolution="day", start=None, end=None, ttl=None, **conditionals):
         """Sum numerical values of events of a given type."""
-        return self._aggregate("SUM", resolution, start, end, sum_field, **conditionals)
+        return self._aggregate("SUM", resolution, start, end, sum_field, ttl=ttl, **conditionals)
 
-    def average(self, avg_field, resolution="day", start=None, end=None, **conditionals):
+    def average(self, avg_field, resolution="day", start=None, end=None, ttl=None, **conditionals):
         """Average events of a given type."""
-        return self._aggregate("AVG", resolution, start, end, avg_field, **conditionals)
+        return self._aggregate("AVG", resolution, start, end, avg_field, ttl=ttl, **conditionals)
 
     def query(self, query):  # pragma: no cover
-        """User-defined SQL query."""
+        """User-defined SQL query. As it may change the table, this clears the query cache."""
+        self._invalidate_cache()
         return pd.io.sql.execute(query, self.engine)
 
-    def _aggregate(self, agg_operation, resolution, start, end, agg_field, **conditionals):
+    def refresh_rollups(self):
+        """
+        Bring the rollup tables up to date. A trigger on the table logs the earliest timestamp of
+        every INSERT or COPY, in the same transaction, so every bucket from the earliest one
+        written to since the last refresh is recalculated from the raw events, whenever the
+        events were committed. Refreshing is cheap and can be run as often as needed.
+        """
+
+        self._postgres_only("Rollups")
+
+        for resolution in self.rollups:
+            if resolution not in _ROLLUP_RESOLUTIONS:
+                raise ValueError(
+                    "Rollup resolutions must be among {}".format(", ".join(_ROLLUP_RESOLUTIONS))
+                )
+
+        # Log writes before rolling up, so that none fall between the two
+        for resolution in self.rollups:
+            table = self._rollup_table(resolution)
+            self.query(_ROLLUP_SCHEMA.format(table=table, timestamp=self.timestamp_field))
+        self._create_rollup_trigger()
+
+        for resolution, fields in self.rollups.items():
+            table = self._rollup_table(resolution)
+
+            # One row per bucket, event and field; the count of all events is field '*'
+            values = ["('*', 1.0::float)"]
+            params = {"resolution": resolution}
+            for i, field in enumerate(fields):
+                values.append(
+                    "(%(field_{})s, ({})::float)".format(
+                        i, self._parse_fields(field, skip_alias=True, json_aggregate=True)
+                    )
+                )
+                params["field_{}".format(i)] = field
+
+            with self.engine.begin() as connection:
+                connection.execute("LOCK TABLE {} IN SHARE ROW EXCLUSIVE MODE".format(table))
+                empty = connection.execute("SELECT 1 FROM {} LIMIT 1".format(table)).scalar()
+                params["dirty"] = connection.execute(
+                    "WITH dirty AS (DELETE FROM {0}_dirty RETURNING {1}) "
+                    "SELECT MIN({1}) FROM dirty".format(table, self.timestamp_field)
+                ).scalar()
+
+                # Recalculate from the earliest bucket written to, or everything the first time
+                since = ""
+                if empty is not None:
+                    if params["dirty"] is None:
+                        continue
+                    since = "AND {} >= date_trunc(%(resolution)s, %(dirty)s::timestamp)".format(
+                        self.timestamp_field
+                    )
+                    connection.execute(
+                        "DELETE FROM {} "
+                        "WHERE bucket >= date_trunc(%(resolution)s, %(dirty)s::timestamp)".format(
+                            table
+                        ),
+                        params,
+                    )
+                connection.execute(
+                    _ROLLUP_REFRESH_QUERY.format(
+                        rollup_table=table,
+                        table=self.table,
+                        timestamp=self.timestamp_field,
+                        event=self.event_field,
+                        values=", ".join(values),
+                        since=since,
+                    ),
+                    params,
+                )
+
+    def _create_rollup_trigger(self):
+        """Create, or update, the trigger that logs writes to every rollup's dirty table."""
+
+        name = "{}__rollup_log".format(self.table)
+        inserts = "".join(
+            "INSERT INTO {0}_dirty SELECT MIN({1}) FROM new_events HAVING MIN({1}) IS NOT NULL; ".format(
+                self._rollup_table(resolution), self.timestamp_field
+            )
+            for resolution in self.rollups
+        )
+        self.query(_ROLLUP_LOG_FUNCTION.format(name=name, inserts=inserts))
+
+        exists = self.engine.execute(
+            "SELECT 1 FROM pg_trigger WHERE tgrelid = %(table)s::regclass AND tgname = %(name)s",
+            {"table": self.table, "name": name},
+        ).scalar()
+        if not exists:
+            self.query(_ROLLUP_LOG_TRIGGER.format(name=name, table=self.table))
+
+    def _aggregate(
+        self, agg_operation, resolution, start, end, agg_field, ttl=None, **conditionals
+    ):
         """
         Aggregate events into a dataframe, between a date range, at a given temporal resolution.
+        Where a rollup table can serve the aggregate, it's combined with the events that haven't
+        been rolled up yet, rather than aggregating every event.
+        """
+        query, params = self._rollup_query(
+            agg_operation, resolution, start, end, agg_field, **conditionals
+        )
+        if query is not None:
+            try:
+                return self._fetch(query, params, ttl)
+            except ProgrammingError:  # the rollup table hasn't been created yet
+                pass
+
+        query, params = self._aggregate_query(
+            agg_operation, resolution, start, end, agg_field, **conditionals
+        )
+        return self._fetch(query, params, ttl)
+
+    def _fetch(self, query, params=None, ttl=None):
+        """
+        Run a query and return the results as a DataFrame, from the query cache if it's on and
+        holds a fresh result. A ttl of 0 skips the cache.
+        """
+
+        if self._cache is None or ttl == 0:
+            return self._read_sql(query, params)
+
+        key = cache_key(query, params)
+        result = self._cache.get(key)
+        if result is None:
+            result = self._read_sql(query, params)
+            self._cache.put(key, result, ttl)
+
+        # Callers are free to modify the results, so never hand out the cached copy
+        return result.copy()
+
+    def _read_sql(self, query, params=None):
+        """
+        Run a query in the database's dialect, as a prepared statement if prepare is on, and
+        return the results as a DataFrame.
+        """
+        if params:
+            params = {name: self.dialect.adapt(value) for name, value in params.items()}
+        if self.prepare:
+            columns, rows = self._execute_prepared(query, params or {}, fetch=True)
+            results = pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+        else:
+            results = pd.read_sql(self.dialect.query(query), self.engine, params=params)
+        return self.dialect.decode(
+            results,
+            timestamps=(self.timestamp_field, "datetime"),
+            json_fields=(self.json_field, "json_field"),
+        )
+
+    def _postgres_only(self, feature):
+        if self.dialect.name != "postgresql":
+            raise NotImplementedError("{} are only supported on PostgreSQL.".format(feature))
+
+    def _invalidate_cache(self):
+        """Clear the query cache after this tracker changes the table."""
+        if self._cache is not None:
+            self._cache.invalidate()
+
+    def _rollup_table(self, resolution):
+        return "{}__rollup_{}".format(self.table, resolution)
+
+    def _rollup_query(self, agg_operation, resolution, start, end, agg_field, **conditionals):
+        """
+        Build a query that answers an aggregate from the coarsest rollup that can serve it. Only
+        counts of all events, and sums and averages of rolled-up fields, can be served, and only
+        events can be filtered on.
+
+        Returns the query and its parameters, or None and None if no rollup can serve it.
+        """
+
+        if set(conditionals) - {self.event_field} or self.dialect.name != "postgresql":
+            return None, None
+
+        if agg_operation == "COUNT":
+            if agg_field != "*":
+                return None, None
+            value = "1.0"
+        else:
+            value = "({})::float".format(
+                self._parse_fields(agg_field, skip_alias=True, json_aggregate=True)
+            )
+
+        # Rollups nest into coarser resolutions, except weeks, which don't fit into months
+        candidates = [
+            rollup
+            for rollup, fields in self.rollups.items()
+            if (agg_field == "*" or agg_field in fields)
+            and rollup in _ROLLUP_RESOLUTIONS
+            and resolution in _ROLLUP_RESOLUTIONS
+            and (
+                rollup == resolution
+                or "week" not in (rollup, resolution)
+                and _ROLLUP_RESOLUTIONS.index(rollup) < _ROLLUP_RESOLUTIONS.index(resolution)
+            )
+        ]
+        if not candidates:
+            return None, None
+        rollup = max(candidates, key=_ROLLUP_RESOLUTIONS.index)
+
+        params = {
+            "resolution": resolution,
+            "rollup": rollup,
+            "step": "3 months" if rollup == "quarter" else "1 {}".format(rollup),
+            "start": datetime(1900, 1, 1) if start is None else start,
+            "end": datetime(2100, 1, 1) if end is None else end,
+            "field": "*" if agg_operation == "COUNT" else agg_field,
+        }
+        rollup_condition = condition = ""
+        if conditionals:
+            rollup_condition = "AND event = %(event)s"
+            condition = "AND {} = %(event)s".format(self.event_field)
+            params["event"] = str(conditionals[self.event_field])
+
+        query = _ROLLUP_AGGREGATE_QUERY.format(
+            aggregate=_ROLLUP_AGGREGATES[agg_operation],
+            rollup_table=self._rollup_table(rollup),
+            table=self.table,
+            timestamp=self.timestamp_field,
+            value=value,
+            rollup_condition=rollup_condition,
+            condition=condition,
+        )
+        return query, params
+
+    def _approximate_distinct(self, count_field, resolution, start, end, **conditionals):
+        """
+        Estimate the number of distinct users per period by merging daily user sketches. Only
+        unconditional counts of DISTINCT(user_field), at a resolution of a day or longer, can be
+        estimated this way.
+
+        Returns a DataFrame, or None if the count can't be estimated.
+        """
+
+        if self.dialect.name != "postgresql":
+            return None
+        distinct = "DISTINCT({})".format(self.user_field).lower()
+        if conditionals or re.sub(r"\s+", "", str(count_field)).lower() != distinct:
+            return None
+        if resolution not in _SKETCH_RESOLUTIONS:
+            return None
+
+        # Set temporal range
+        if start is None:
+            start = datetime(1900, 1, 1)
+        if end is None:
+            end = datetime(2100, 1, 1)
+
+        query = (
+            "SELECT date_trunc(%(resolution)s, timestamp) AS datetime, users "
+            "FROM {}__user_sketches "
+            "WHERE timestamp > %(start)s::timestamp - INTERVAL '1 day' AND timestamp <= %(end)s "
+            "ORDER BY timestamp".format(self.table)
+        )
+        params = {"resolution": resolution, "start": start, "end": end}
+        try:
+            sketches = pd.read_sql(query, self.engine, params=params)
+        except ProgrammingError:  # the sketches table doesn't exist
+            return None
+
+        counts = []
+        for period, users in sketches.groupby("datetime", sort=True)["users"]:
+            registers = np.stack([np.frombuffer(bytes(data), dtype=np.uint8) for data in users])
+            counts.append((period, int(round(float(sketch.estimate(registers.max(axis=0)))))))
+
+        return pd.DataFrame(counts, columns=["datetime", "count"])
+
+    def _read_query(self, *fields, **conditionals):
+        """
+        Build the query used by .read().
+
+        Returns the query and its parameters.
+        """
+        return self._select_query(fields, sorted(conditionals.items()))
+
+    def _select_query(self, fields, conditions):
+        """
+        Build a query for fields of the events that match a list of conditions and values.
+
+        Returns the query and its parameters.
+        """
+
+        # Parse the list of fields to return
+        field_query = self._parse_fields(*fields)
+
+        # Parse the conditions
+        conditionals_query, params = self._parse_conditions(conditions)
+
+        query = "SELECT {} FROM {} {}".format(field_query, self.table, conditionals_query)
+
+        if "DISTINCT" not in query:
+            query += " ORDER BY {}".format(self.timestamp_field)
+
+        return query, params or None
+
+    def _aggregate_query(self, agg_operation, resolution, start, end, agg_field, **conditionals):
+        """
+        Build the query used by ._aggregate().
+
+        Returns the query and its parameters.
         """
 
         # Set temporal range
@@ -166,40 +1235,46 @@ class Tracker(object):
         if end is None:
             end = datetime(2100, 1, 1)
 
+        # Aggregates are named as PostgreSQL names them, whatever the database
         if agg_operation == "COUNT":
-            agg_query = "COUNT ({})".format(agg_field)
+            agg_query = "COUNT ({}) AS count".format(agg_field)
         else:
-            agg_query = "{aggregate}(({field})::float)".format(
+            agg_query = "{aggregate}({field}) AS {name}".format(
                 aggregate=agg_operation,
-                field=self._parse_fields(agg_field, skip_alias=True, json_aggregate=True),
+                field=self.dialect.float(
+                    self._parse_fields(agg_field, skip_alias=True, json_aggregate=True)
+                ),
+                name=agg_operation.lower(),
             )
 
         # Parse conditionals; replace WHERE with AND
-        conditionals = self._parse_conditionals(**conditionals).replace("WHERE", "AND")
+        conditionals, params = self._parse_conditionals(**conditionals)
+        conditionals = conditionals.replace("WHERE", "AND", 1)
 
         # Construct the query
         query = (
-            "SELECT date_trunc(%(resolution)s, {timestamp}) AS datetime, "
+            "SELECT {bucket} AS datetime, "
             "{aggregate} FROM {table} "
             "WHERE {timestamp} >= %(start)s "
             "AND {timestamp} <= %(end)s "
             "{conditionals} "
-            "GROUP BY date_trunc(%(resolution)s, {timestamp}) "
-            "ORDER BY date_trunc(%(resolution)s, {timestamp})".format(
+            "GROUP BY {bucket} "
+            "ORDER BY {bucket}".format(
+                bucket=self.dialect.date_trunc(resolution, self.timestamp_field),
                 timestamp=self.timestamp_field,
                 aggregate=agg_query,
                 table=self.table,
                 conditionals=conditionals,
             )
         )
-        params = {"resolution": resolution, "start": start, "end": end}
-        return pd.read_sql(query, self.db, params=params)
+        params.update(resolution=resolution, start=start, end=end)
+        return query, params
 
     def _parse_fields(self, *fields, **kwargs):
         """
         Parse a list of fields to be returned by .read() or ._aggregate(). Any field that isn't
-        self.json_field oesn't change; any fields that reference the JSON field are parsed into
-        JSONB syntax.
+        self.json_field doesn't change; any fields that reference the JSON field are parsed into
+        the dialect's JSON syntax : as text with json_aggregate, or for comparison with json_value.
 
         Returns a comma-separated string that can be used in a SQL query.
         """
@@ -222,10 +1297,13 @@ class Tracker(object):
 
             # If it's a JSON field with some sort of traversal of the JSON, parse that
             else:
-                operator = "#>>" if kwargs.get("json_aggregate") else "#>"
-                jsonfield = self.json_field + " {operator} '{{{subfields}}}'".format(
-                    operator=operator, subfields=", ".join(field.split("__")[1:])
-                )
+                if kwargs.get("json_aggregate"):
+                    mode = "text"
+                elif kwargs.get("json_value"):
+                    mode = "value"
+                else:
+                    mode = "json"
+                jsonfield = self.dialect.json_path(self.json_field, field.split("__")[1:], mode)
 
                 if not kwargs.get("skip_alias"):
                     jsonfield += " AS json_field"
@@ -233,39 +1311,22 @@ class Tracker(object):
 
         return ", ".join(parsed)
 
-    def _parse_values(self, *values):
+    def _parse_conditionals(self, **conditionals):
         """
-        Return a generator where numerical values are strings and strings are 'strings'
-        ( in single quotes ) for PostgreSQL queries.
+        Parse the conditional expressions that are passed to .read() or ._aggregate().
+        This includes modifiers. Values are sent as bind parameters rather than in the SQL, so
+        the same query with different values can reuse the same plan.
 
-        Returns a comma-separated string that can be used in a SQL query.
+        Returns a string that can be used in a SQL query, and a dict of its parameters.
         """
+        return self._parse_conditions(sorted(conditionals.items()))
 
-        # Examples :
-        #   "logged_in"
-        #   3000
-        #   "quentin"
-
-        # Numerical values are as-is, strings get quotes, dicts become JSON strings
-        def sqlsafe(value):
-            if isinstance(value, dict):  # JSON needs to be correctly encoded
-                return "'{}'".format(json.dumps(value))
-            elif isinstance(value, list):  # for the IN operator
-                return "({})".format(", ".join(["'{}'".format(i) for i in value]))
-            else:
-                return "'{}'".format(value)  # other things probably need to be in quotes
-
-        if len(values) == 1:
-            return sqlsafe(values[0])
-        else:
-            return ", ".join(sqlsafe(value) for value in values)
-
-    def _parse_conditionals(self, **conditionals):
+    def _parse_conditions(self, conditions):
         """
-        Parse the conditional expressions that are passed to .read() or ._aggregate().
-        This includes modifiers.
+        Parse a list of conditional expressions and their values, as ._parse_conditionals() does;
+        the same field and modifier may appear more than once.
 
-        Returns a comma-separated string that can be used in a SQL query.
+        Returns a string that can be used in a SQL query, and a dict of its parameters.
         """
 
         # Examples :
@@ -276,33 +1337,60 @@ class Tracker(object):
 
         modifiers = {"gt": ">", "lt": "<", "gte": ">=", "lte": "<=", "contains": "?", "in": "IN"}
 
-        if not conditionals:
-            return ""
-
-        else:
-            conditions_list = []
+        if not conditions:
+            return "", {}
 
-            for key, value in conditionals.items():
-
-                # Determine equality vs nonequality conditionals; determine operation
-                if key.split("__")[-1] in modifiers.keys():
-                    modifier = key.split("__")[-1]
-                    operator = modifiers[modifier]
-                    key = "__".join(key.split("__")[:-1])
-                else:
-                    operator = "="
+        conditions_list = []
+        params = {}
 
-                # Parse the field and the conditional value
-                field = self._parse_fields(key, skip_alias=True)
-                rhs = self._parse_values(value)
+        for i, (key, value) in enumerate(conditions):
+            name = "cond_{}".format(i)
 
-                # In an equality when searching through json_field, compare with text and not JSON
-                if operator == "=":
-                    field = field.replace(" #> ", " #>> ")
+            # Determine equality vs nonequality conditionals; determine operation
+            if key.split("__")[-1] in modifiers.keys():
+                modifier = key.split("__")[-1]
+                operator = modifiers[modifier]
+                key = "__".join(key.split("__")[:-1])
+            else:
+                operator = "="
+
+            # Parse the field; in an equality when searching through json_field, compare with text
+            # and not JSON
+            is_json = key.startswith(self.json_field) and key != self.json_field
+            field = self._parse_fields(
+                key,
+                skip_alias=True,
+                json_aggregate=operator in ("=", "IN"),
+                json_value=operator not in ("=", "IN", "?"),
+            )
 
-                conditions_list.append("{} {} {}".format(field, operator, rhs))
+            # Values are compared as PostgreSQL would compare quoted literals; on PostgreSQL, lists
+            # are sent as a single array of text, so the query is the same however many values
+            # there are. Columns of other types compare with the array cast to their type, so their
+            # indexes can be used
+            if operator == "IN":
+                cast = None
+                if not is_json:
+                    cast = self._kinds().get(key)
+                    if cast in (None, _TEXT, _JSON):
+                        field = self.dialect.text(field)
+                        cast = None
+                conditions_list.append(
+                    self.dialect.any(
+                        field, name, [text_parameter(item) for item in value], params, cast
+                    )
+                )
+            elif operator == "?":
+                conditions_list.append(self.dialect.contains(field, name))
+                params[name] = text_parameter(value)
+            elif operator == "=":
+                conditions_list.append("{} = %({})s".format(field, name))
+                params[name] = text_parameter(value)
+            else:
+                conditions_list.append("{} {} %({})s".format(field, operator, name))
+                params[name] = self.dialect.compare_value(value)
 
-        return "WHERE {}".format(" AND ".join(conditions_list))
+        return "WHERE {}".format(" AND ".join(conditions_list)), params
 
     def __repr__(self):
         return "pawprint.Tracker on table '{}' and database '{}'".format(self.table, self.db)
@@ -311,5 +1399,219 @@ class Tracker(object):
         return "pawprint Tracker object.\n" "db : {}\n" "table : {}".format(self.db, self.table)
 
 
+# New partitions are created detached, filled with their events from the default partition, and
+# then attached, since a partition can't be attached while the default holds events in its range
+_PARTITION_CREATE_QUERY = (
+    "CREATE TABLE {partition} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+)
+_PARTITION_MOVE_QUERY = (
+    "WITH moved AS ("
+    "    DELETE FROM {default} WHERE {timestamp} >= %(lo)s AND {timestamp} < %(hi)s RETURNING *"
+    ") "
+    "INSERT INTO {partition} SELECT * FROM moved"
+)
+
+# Rollup tables hold the count, sum and sum of squares of each field, per bucket and event
+_ROLLUP_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS {table} ("
+    "bucket TIMESTAMP, event TEXT, field TEXT, n BIGINT, sum FLOAT(53), sumsq FLOAT(53)"
+    "); "
+    "CREATE INDEX IF NOT EXISTS {table}_bucket_idx ON {table} (field, bucket); "
+    "CREATE TABLE IF NOT EXISTS {table}_dirty ({timestamp} TIMESTAMP)"
+)
+
+# Each INSERT or COPY into the table logs the earliest timestamp it wrote, in the same
+# transaction, to every rollup's dirty table; the log becomes visible when the events do
+_ROLLUP_LOG_FUNCTION = (
+    "CREATE OR REPLACE FUNCTION {name}() RETURNS trigger LANGUAGE plpgsql AS $$ "
+    "BEGIN {inserts}RETURN NULL; END $$"
+)
+_ROLLUP_LOG_TRIGGER = (
+    "CREATE TRIGGER {name} AFTER INSERT ON {table} REFERENCING NEW TABLE AS new_events "
+    "FOR EACH STATEMENT EXECUTE PROCEDURE {name}()"
+)
+
+# Roll up every field in a single scan of the events in the buckets being recalculated
+_ROLLUP_REFRESH_QUERY = (
+    "INSERT INTO {rollup_table} (bucket, event, field, n, sum, sumsq) "
+    "SELECT date_trunc(%(resolution)s, {timestamp}), {event}::text, v.field, "
+    "    COUNT(v.value), SUM(v.value), SUM(v.value * v.value) "
+    "FROM {table} CROSS JOIN LATERAL (VALUES {values}) AS v (field, value) "
+    "WHERE {timestamp} IS NOT NULL {since} "
+    "GROUP BY 1, 2, 3"
+)
+
+# Combine rolled-up buckets that lie wholly between start and end with the rest of the events,
+# which haven't been rolled up, were written to buckets since the last refresh, or only partly
+# fall in the range
+_ROLLUP_AGGREGATE_QUERY = (
+    "WITH bounds AS ("
+    "    SELECT CASE WHEN date_trunc(%(rollup)s, %(start)s::timestamp) = %(start)s::timestamp "
+    "        THEN date_trunc(%(rollup)s, %(start)s::timestamp) "
+    "        ELSE date_trunc(%(rollup)s, %(start)s::timestamp) + %(step)s::interval END AS lo, "
+    "    LEAST(date_trunc(%(rollup)s, %(end)s::timestamp), "
+    "        (SELECT MAX(bucket) FROM {rollup_table}), "
+    "        (SELECT date_trunc(%(rollup)s, MIN({timestamp})) FROM {rollup_table}_dirty)) AS hi"
+    ") "
+    "SELECT date_trunc(%(resolution)s, bucket) AS datetime, {aggregate} FROM ("
+    "    SELECT bucket, n, sum FROM {rollup_table}, bounds "
+    "    WHERE field = %(field)s {rollup_condition} AND bucket >= bounds.lo AND bucket < bounds.hi "
+    "    UNION ALL "
+    "    SELECT {timestamp}, CASE WHEN value IS NULL THEN 0 ELSE 1 END, value FROM ("
+    "        SELECT {timestamp}, {value} AS value FROM {table}, bounds "
+    "        WHERE {timestamp} >= %(start)s AND {timestamp} <= %(end)s {condition} "
+    "        AND ({timestamp} < bounds.lo OR {timestamp} >= bounds.hi OR bounds.hi IS NULL)"
+    "    ) AS events"
+    ") AS combined "
+    "GROUP BY 1 ORDER BY 1"
+)
+_ROLLUP_AGGREGATES = {
+    "COUNT": "SUM(n)::bigint AS count",
+    "SUM": "SUM(sum) AS sum",
+    "AVG": "SUM(sum) / NULLIF(SUM(n), 0) AS avg",
+}
+
+
+class ReadIterator(object):
+    """
+    This class iterates over the results of Tracker.read_iter() in chunks, fetched from a
+    server-side cursor as they're needed. After each chunk, .after holds the timestamp and id of
+    its last row.
+    """
+
+    def __init__(self, engine, query, params, chunksize, raw=False, after=None):
+        self.engine = engine
+        self.query = query
+        self.params = params
+        self.chunksize = chunksize
+        self.raw = raw
+        self.after = after
+        self._connection = None
+        self._cursor = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+
+        if self._cursor is None:
+            if self._connection is not None:  # we've already finished
+                raise StopIteration
+            self._connection = self.engine.raw_connection()
+            self._cursor = self._connection.cursor(name="pawprint_read_iter")
+            self._cursor.itersize = self.chunksize
+            self._cursor.execute(self.query, self.params)
+
+        rows = self._cursor.fetchmany(self.chunksize)
+        if not rows:
+            self.close()
+            raise StopIteration
+
+        # Remember where we got to, and drop the keys we added to the query
+        self.after = tuple(rows[-1][-2:])
+        rows = [row[:-2] for row in rows]
+
+        if self.raw:
+            return rows
+        columns = [column[0] for column in self._cursor.description[:-2]]
+        return pd.DataFrame.from_records(rows, columns=columns)
+
+    def close(self):
+        """Close the cursor and return its connection to the pool."""
+        if self._cursor is not None:
+            try:
+                self._cursor.close()
+                self._connection.rollback()
+            finally:
+                self._connection.close()
+                self._cursor = None
+
+    def __del__(self):
+        self.close()
+
+
+def _widen(results, by, wide):
+    """Index aggregates by period and, if wide, pivot the groups in by into columns."""
+    if wide:
+        by = list(by)
+        results = results.set_index(["datetime"] + by)
+        if by:
+            results = results.unstack(by)
+    return results
+
+
+def _serialize(value, kind, encode_json):
+    """
+    Serialise a value for a column of the given kind. Text columns get strings, as they always
+    have. JSON columns get JSON, unless the value is a string, which is taken to be JSON already.
+    Other columns get dicts and lists as JSON, and anything the driver adapts natively, like
+    numbers and datetimes, as it is; booleans are only sent natively to columns known not to be
+    text, as they'd otherwise be stored as 'true' rather than 'True'.
+    """
+
+    if value is None:
+        return None
+    if kind is _JSON:
+        return value if isinstance(value, str) else encode_json(value)
+    if isinstance(value, (dict, list)):
+        return encode_json(value)
+    if kind is _TEXT or (kind is None and isinstance(value, bool)):
+        return value if isinstance(value, str) else str(value)
+    if isinstance(value, NATIVE_TYPES):
+        return value
+    return str(value)
+
+
+def _get_engine(db, **pool_settings):
+    """
+    Return the connection engine for a database, creating it if this is the first tracker to
+    connect with these pool settings.
+    """
+
+    key = (db,) + tuple(sorted(pool_settings.items()))
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = dialect_for(db).create_engine(db, **pool_settings)
+        return _engines[key]
+
+
+def _load_config(kwargs):
+    """
+    Merge a tracker's configuration file, if there is one, with locally-passed arguments, and
+    fill in the default schema.
+    """
+
+    if "dotfile" in kwargs:
+        with open(kwargs["dotfile"], "r") as f:
+            config = json.load(f)
+            config.update(kwargs)
+    else:
+        config = kwargs
+
+    # Set a default schema if none is passed
+    if "schema" not in config:
+        config["schema"] = OrderedDict(
+            [
+                ("id", "SERIAL PRIMARY KEY"),
+                ("timestamp", "TIMESTAMP DEFAULT CURRENT_TIMESTAMP"),
+                ("user_id", "TEXT"),
+                ("event", "TEXT"),
+                ("metadata", "JSONB"),
+            ]
+        )
+    else:  # If a schema is passed, ensure it's an ordered dict
+        if not isinstance(config["schema"], OrderedDict) and isinstance(config["schema"], dict):
+            config["schema"] = OrderedDict(config["schema"])
+
+    return config
+
+
+def _close_at_exit(reference):
+    """Write a tracker's remaining queued events, if it still exists, at interpreter exit."""
+    tracker = reference()
+    if tracker is not None:
+        tracker.close()
+
+
 # TODO : strip "event" requirement from aggregates
 # TODO : more comments
@@ -0,0 +1,166 @@
+import queue
+import threading
+
+from pawprint.spool import Spool
+
+# Sentinel placed on the queue to stop the worker thread
+_STOP = object()
+
+
+class BackgroundWriter(object):
+    """
+    This class drains a bounded queue of events into the database from a background thread, so
+    that writing an event never waits on the database. Events spilled to disk when the queue is
+    full are kept in a Spool under spill_path until they've been written; replay stops at the
+    first batch that fails with one of the retry_on exceptions, and tries again later.
+    """
+
+    backpressure_modes = ("block", "drop_oldest", "spill")
+
+    def __init__(
+        self,
+        write_batch,
+        queue_size=10000,
+        batch_size=1000,
+        backpressure="block",
+        spill_path=None,
+        retry_on=(Exception,),
+    ):
+
+        if backpressure not in self.backpressure_modes:
+            raise ValueError(
+                "backpressure must be one of {}".format(", ".join(self.backpressure_modes))
+            )
+        if backpressure == "spill" and spill_path is None:
+            raise ValueError("A spill_path must be set to spill events to disk.")
+
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.backpressure = backpressure
+        self.spill_path = spill_path
+        self.retry_on = retry_on
+        self.closed = False
+
+        # Events spilled by an earlier process are written once the worker catches up
+        self._spill_spool = None
+        if spill_path is not None:
+            self._spill_spool = Spool(spill_path)
+
+        # Counters for monitoring
+        self.counters = {"queued": 0, "written": 0, "dropped": 0, "spilled": 0, "failed": 0}
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="pawprint-writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def depth(self):
+        """The number of events currently waiting to be written."""
+        return self._queue.qsize()
+
+    def put(self, data):
+        """Queue an event, applying the backpressure policy if the queue is full."""
+
+        if self.closed:
+            raise RuntimeError("pawprint background writer is closed.")
+
+        if self.backpressure == "block":
+            self._queue.put(data)
+
+        else:
+            while True:
+                try:
+                    self._queue.put_nowait(data)
+                    break
+                except queue.Full:
+                    if self.backpressure == "spill":
+                        self._spill([data])
+                        return
+
+                # Make room by discarding the oldest queued event, and try again, as other threads
+                # may have filled the room first
+                try:
+                    self._queue.get_nowait()
+                    self._queue.task_done()
+                    self._count("dropped")
+                except queue.Empty:
+                    pass
+
+        self._count("queued")
+
+    def flush(self):
+        """Block until every queued event has been written, then write any spilled events."""
+        self._queue.join()
+        self._replay_spill()
+
+    def close(self):
+        """Write all remaining events and stop the background thread."""
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._replay_spill()
+        if self._spill_spool is not None:
+            self._spill_spool.close()
+
+    def _run(self):
+        """Worker loop : pull as many events as are available, up to batch_size, and write them."""
+
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            events = [data for data in batch if data is not _STOP]
+            if events:
+                self._write(events)
+
+            for _ in batch:
+                self._queue.task_done()
+
+            if batch[-1] is _STOP:
+                return
+
+            # Once the queue has caught up, write any events spilled while it was full
+            if self._spill_spool is not None and self._spill_spool.depth and self._queue.empty():
+                self._replay_spill()
+
+    def _write(self, events):
+        """Write a batch; failures have already been logged by the tracker, so just count them."""
+        try:
+            self.write_batch(events)
+            self._count("written", len(events))
+        except Exception:
+            self._count("failed", len(events))
+
+    def _spill(self, events):
+        """Append events to the spill spool, or drop them if it's full."""
+        spilled = self._spill_spool.append(events)
+        self._count("spilled", spilled)
+        self._count("dropped", len(events) - spilled)
+
+    def _replay_spill(self):
+        """
+        Write any events that were spilled to disk. Events are only removed from the spill once
+        they're written, so those that can't be yet are kept for the next replay.
+        """
+
+        if self._spill_spool is None:
+            return
+
+        rejected = self._spill_spool.counters["rejected"]
+        written = self._spill_spool.replay(
+            self.write_batch, batch_size=self.batch_size, retry_on=self.retry_on
+        )
+        self._count("written", written)
+        self._count("failed", self._spill_spool.counters["rejected"] - rejected)
+
+    def _count(self, counter, n=1):
+        with self._lock:
+            self.counters[counter] += n
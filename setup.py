@@ -16,6 +16,12 @@ setup(
     packages=["pawprint"],
     zip_safe=False,
     test_suite="tests",
-    install_requires=["pandas>=0.19", "sqlalchemy>=1.0", "psycopg2>=2.4"],
+    install_requires=["pandas>=0.19", "sqlalchemy>=1.0", "psycopg2>=2.7"],
+    extras_require={
+        "async": ["asyncpg>=0.18"],
+        "arrow": ["pyarrow>=6.0"],
+        "json": ["orjson>=3.0"],
+        "duckdb": ["duckdb>=0.8", "pyarrow>=6.0"],
+    },
     python_requires=">=3.5",
 )
@@ -98,6 +98,10 @@ def statistics_test_table_names():
         "sessions_table": "pawprint_test_statistics_table__sessions",
         "engagement_table": "pawprint_test_statistics_table__engagement",
         "event_session_map_table": "pawprint_test_statistics_table__event_session_map",
+        "user_sketches_table": "pawprint_test_statistics_table__user_sketches",
+        "user_session_counts_table": "pawprint_test_statistics_table__user_session_counts",
+        "daily_users_table": "pawprint_test_statistics_table__daily_users",
+        "watermarks_table": "pawprint_test_statistics_table__watermarks",
     }
 
 
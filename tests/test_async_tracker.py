@@ -0,0 +1,188 @@
+import asyncio
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+import pawprint
+
+asyncpg = pytest.importorskip("asyncpg")
+
+
+def run(coroutine):
+    """Run a coroutine to completion on a fresh event loop."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_async_write_and_read(pawprint_default_tracker_db_with_table):
+    """Test writing and reading events through the asyncpg connection pool."""
+
+    table_tracker = pawprint_default_tracker_db_with_table
+    tracker = pawprint.AsyncTracker(db=table_tracker.db, table=table_tracker.table)
+
+    async def track():
+        await asyncio.gather(
+            tracker.write(user_id="alice", event="logged_in", metadata={"browser": "Chrome"}),
+            tracker.write(user_id=1337, event="logged_in"),
+            tracker.write(event="server_booted", timestamp="2016-01-01 12:30"),
+        )
+        all_data = await tracker.read()
+        logins = await tracker.read("user_id", event="logged_in")
+        browsers = await tracker.read("metadata__browser", event="logged_in")
+        await tracker.close()
+        return all_data, logins, browsers
+
+    all_data, logins, browsers = run(track())
+
+    assert len(all_data) == 3
+    assert set(all_data.columns) == {"id", "timestamp", "user_id", "event", "metadata"}
+    assert all_data.timestamp.iloc[0] == datetime(2016, 1, 1, 12, 30)
+    assert set(logins.user_id) == {"alice", "1337"}
+    assert list(browsers.columns) == ["json_field"]
+    assert "Chrome" in list(browsers.json_field)
+
+    # The synchronous tracker sees the same data
+    assert len(table_tracker.read()) == 3
+
+
+def test_async_aggregates(pawprint_default_tracker_db_with_table):
+    """Test counting, summing and averaging events asynchronously."""
+
+    table_tracker = pawprint_default_tracker_db_with_table
+    tracker = pawprint.AsyncTracker(db=table_tracker.db, table=table_tracker.table)
+
+    for day, value in [(1, 1), (1, 2), (2, 3)]:
+        table_tracker.write(event="sale", timestamp=datetime(2016, 1, day), metadata={"val": value})
+
+    async def aggregate():
+        counts = await tracker.count(event="sale")
+        sums = await tracker.sum("metadata__val", start="2016-01-01")
+        averages = await tracker.average("metadata__val", resolution="month")
+        await tracker.close()
+        return counts, sums, averages
+
+    counts, sums, averages = run(aggregate())
+
+    assert np.all(counts["count"].values == [2, 1])
+    assert np.all(sums["sum"].values == [3, 3])
+    assert np.all(averages["avg"].values == [2])
+
+
+def test_async_json_encoder(pawprint_default_tracker_db_with_table):
+    """Test that JSON fields are encoded with the tracker's encoder, which handles datetimes."""
+
+    table_tracker = pawprint_default_tracker_db_with_table
+    tracker = pawprint.AsyncTracker(
+        db=table_tracker.db, table=table_tracker.table, json_encoder="json"
+    )
+
+    async def track():
+        await tracker.write(event="signed_up", metadata={"when": datetime(2016, 1, 1, 12, 30)})
+        await tracker.write(event="profile", user_id={"joined": datetime(2016, 1, 2)})
+        events = await tracker.read()
+        await tracker.close()
+        return events
+
+    events = run(track())
+    assert events.metadata.iloc[0] == {"when": "2016-01-01T12:30:00"}
+    assert events.user_id.iloc[1] == '{"joined": "2016-01-02T00:00:00"}'
+
+
+def test_async_statement_cache(pawprint_default_tracker_db_with_table, monkeypatch):
+    """Test that a query is only prepared explicitly the first time it's run."""
+
+    table_tracker = pawprint_default_tracker_db_with_table
+    tracker = pawprint.AsyncTracker(db=table_tracker.db, table=table_tracker.table)
+
+    prepared = []
+    prepare = asyncpg.Connection.prepare
+
+    async def counting_prepare(connection, query, *args, **kwargs):
+        prepared.append(query)
+        return await prepare(connection, query, *args, **kwargs)
+
+    monkeypatch.setattr(asyncpg.Connection, "prepare", counting_prepare)
+
+    async def track():
+        for user in range(3):
+            await tracker.write(event="logged_in", user_id=user)
+        first = await tracker.read(event="logged_in")
+        second = await tracker.read(event="logged_out")
+        await tracker.close()
+        return first, second
+
+    first, second = run(track())
+    assert len(prepared) == 2
+    assert list(first.user_id) == ["0", "1", "2"]
+    assert len(second) == 0 and "user_id" in second.columns
+
+
+def test_async_silent_write_errors():
+    """When there's no database, writes fail silently."""
+
+    tracker = pawprint.AsyncTracker(db=None, table=None)
+    run(tracker.write(event="This will fail silently."))
+
+
+def test_async_aggregate(pawprint_default_tracker_db_with_table):
+    """Test calculating several aggregates in one scan asynchronously."""
+
+    table_tracker = pawprint_default_tracker_db_with_table
+    tracker = pawprint.AsyncTracker(db=table_tracker.db, table=table_tracker.table)
+
+    for day, event in [(1, "a"), (1, "b"), (2, "a")]:
+        table_tracker.write(event=event, timestamp=datetime(2016, 1, day), metadata={"val": day})
+
+    async def aggregate():
+        results = await tracker.aggregate(
+            aggs={"n": ("count", "*"), "total": ("sum", "metadata__val")}, by=["event"], wide=True
+        )
+        await tracker.close()
+        return results
+
+    results = run(aggregate())
+    assert list(results["n"]["a"]) == [1, 1]
+    assert list(results["total"]["a"]) == [1, 2]
+
+
+def test_async_create_and_drop_table(pawprint_default_tracker_db):
+    """Test creating and dropping the table without blocking the event loop."""
+
+    db_tracker = pawprint_default_tracker_db
+    tracker = pawprint.AsyncTracker(db=db_tracker.db, table=db_tracker.table)
+
+    async def create_and_drop():
+        await tracker.create_table(indexes=True)
+        await tracker.write(event="created")
+        events = await tracker.read()
+        await tracker.drop_table()
+        with pytest.warns(UserWarning):
+            with pytest.raises(asyncpg.PostgresError):
+                await tracker.drop_table()
+        await tracker.close()
+        return events
+
+    assert list(run(create_and_drop()).event) == ["created"]
+
+
+def test_async_sync_only(pawprint_default_tracker_db_with_table):
+    """Test that methods that would block the event loop raise."""
+
+    table_tracker = pawprint_default_tracker_db_with_table
+    tracker = pawprint.AsyncTracker(db=table_tracker.db, table=table_tracker.table)
+
+    run(tracker.flush())
+    for method in ("write_many", "write_dataframe", "read_iter", "refresh_rollups"):
+        with pytest.raises(NotImplementedError):
+            getattr(tracker, method)([])
+    with pytest.raises(NotImplementedError):
+        tracker.events.count()
+
+    # As do options for features it doesn't have
+    for option, value in [("buffer_size", 10), ("background", True), ("prepare", True)]:
+        with pytest.raises(NotImplementedError, match=option):
+            pawprint.AsyncTracker(db=table_tracker.db, table=table_tracker.table, **{option: value})
@@ -0,0 +1,61 @@
+import time
+
+import pandas as pd
+
+from pawprint.cache import QueryCache, cache_key
+
+
+def frame(n):
+    return pd.DataFrame({"value": range(n)})
+
+
+def test_hits_and_misses():
+    cache = QueryCache()
+    assert cache.get("query") is None
+    cache.put("query", frame(3))
+    assert len(cache.get("query")) == 3
+    assert cache.counters == {"hits": 1, "misses": 1, "evictions": 0}
+
+
+def test_lru_eviction():
+    """The least recently used results are evicted to stay within the memory bound."""
+
+    size = int(frame(100).memory_usage(index=True, deep=True).sum())
+    cache = QueryCache(max_bytes=size * 2)
+
+    cache.put("first", frame(100))
+    cache.put("second", frame(100))
+    cache.get("first")
+    cache.put("third", frame(100))
+
+    assert cache.get("second") is None
+    assert cache.get("first") is not None
+    assert cache.get("third") is not None
+    assert cache.counters["evictions"] == 1
+    assert cache.size == size * 2
+
+    # Results bigger than the whole cache aren't cached
+    cache.put("huge", frame(1000))
+    assert cache.get("huge") is None
+
+
+def test_ttl_and_invalidate():
+    cache = QueryCache(ttl=60)
+    cache.put("short", frame(1), ttl=0.01)
+    cache.put("long", frame(1))
+    time.sleep(0.02)
+
+    assert cache.get("short") is None
+    assert cache.get("long") is not None
+
+    cache.invalidate()
+    assert cache.get("long") is None
+    assert len(cache) == 0 and cache.size == 0
+
+
+def test_cache_key():
+    """Keys ignore whitespace and the order of parameters."""
+    assert cache_key("SELECT *\n  FROM t ", {"a": 1, "b": 2}) == cache_key(
+        "SELECT * FROM t", {"b": 2, "a": 1}
+    )
+    assert cache_key("SELECT * FROM t", {"a": 1}) != cache_key("SELECT * FROM t", {"a": 2})
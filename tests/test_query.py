@@ -0,0 +1,80 @@
+from datetime import datetime
+
+import pytest
+
+
+def write_events(tracker):
+    for i in range(6):
+        tracker.write(
+            event="logged_in" if i % 2 else "logged_out",
+            user_id="user_{}".format(i % 3),
+            timestamp=datetime(2017, 1, 1 + i // 2, 12),
+            metadata={"val": i, "plan": "free" if i < 3 else "paid"},
+        )
+
+
+def test_queries_are_lazy_and_composable(pawprint_default_tracker_db_with_table):
+    """Queries are built up by chaining, without touching the database until they're run."""
+
+    tracker = pawprint_default_tracker_db_with_table
+    write_events(tracker)
+
+    logins = tracker.events.filter(event="logged_in")
+    later = logins.where(timestamp__gt=datetime(2017, 1, 1, 13))
+    assert logins.count() == 3
+    assert later.count() == 2
+    assert tracker.events.count() == 6
+
+    # The same condition can be refined more than once
+    window = tracker.events.where(timestamp__gt=datetime(2017, 1, 1, 13)).where(
+        timestamp__lt=datetime(2017, 1, 3)
+    )
+    assert window.count() == 2
+
+    events = later.select("user_id", "metadata__val").to_df()
+    assert list(events.user_id) == ["user_0", "user_2"]
+    assert list(events.json_field) == [3, 5]
+
+    chunks = list(logins.select("event").iter(chunksize=2))
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+
+
+def test_query_aggregates(pawprint_default_tracker_db_with_table):
+    """Several aggregates, grouped by period and by fields, come out of a single query."""
+
+    tracker = pawprint_default_tracker_db_with_table
+    write_events(tracker)
+
+    daily = tracker.events.group_by("event", resolution="day").aggregate(
+        events=("count", "*"),
+        users=("count_distinct", "user_id"),
+        total=("sum", "metadata__val"),
+        highest=("max", "metadata__val"),
+    )
+    assert "SELECT" in repr(daily)
+
+    results = daily.filter(event="logged_in").to_df()
+    assert daily.group_by().to_df().equals(daily.to_df())
+    assert list(results.columns) == ["datetime", "event", "events", "users", "total", "highest"]
+    assert list(results.datetime) == [datetime(2017, 1, day) for day in (1, 2, 3)]
+    assert list(results.total) == [1, 3, 5]
+    assert list(results.highest) == [1, 3, 5]
+
+    plans = tracker.events.group_by("metadata__plan").aggregate(average=("avg", "metadata__val"))
+    results = plans.to_df()
+    assert list(results.metadata__plan) == ["free", "paid"]
+    assert list(results.average) == [1, 4]
+
+    overall = tracker.events.aggregate(events=("count", "*"), first=("min", "timestamp")).to_df()
+    assert overall.events[0] == 6
+    assert overall["first"][0] == datetime(2017, 1, 1, 12)
+
+    with pytest.raises(ValueError):
+        tracker.events.aggregate(total=("mode", "metadata__val"))
+    with pytest.raises(ValueError):
+        tracker.events.aggregate(total=("sum", "*"))
+    with pytest.raises(ValueError):
+        tracker.events.group_by("event").to_df()
+    assert "incomplete" in repr(tracker.events.group_by("event"))
+    with pytest.raises(ValueError):
+        daily.iter()
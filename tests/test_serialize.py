@@ -0,0 +1,39 @@
+import json
+from datetime import datetime
+
+import pytest
+
+from pawprint.serialize import JSON_ENCODERS, json_encoder
+
+
+@pytest.mark.parametrize("name", JSON_ENCODERS)
+def test_json_encoders_agree(name):
+    """Every JSON library encodes values the same way, once parsed."""
+
+    try:
+        encode = json_encoder(name)
+    except ImportError:
+        pytest.skip("{} isn't installed".format(name))
+
+    value = {
+        "cart": {"items": [{"sku": "A1", "price": 9.99, "qty": 2}], "total": 19.98},
+        "at": datetime(2017, 1, 1, 12, 30),
+        "tags": ["x", "y"],
+        "none": None,
+        "unicode": "café",
+    }
+    assert json.loads(encode(value)) == {
+        "cart": {"items": [{"sku": "A1", "price": 9.99, "qty": 2}], "total": 19.98},
+        "at": "2017-01-01T12:30:00",
+        "tags": ["x", "y"],
+        "none": None,
+        "unicode": "café",
+    }
+
+
+def test_json_encoder_choice():
+    """The fastest library is used by default, and unknown ones are refused."""
+
+    assert json.loads(json_encoder()({"a": 1})) == {"a": 1}
+    with pytest.raises(ValueError):
+        json_encoder("yaml")
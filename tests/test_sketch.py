@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from pawprint.sketch import HyperLogLog, build, estimate, precision_for
+
+
+def test_precision_for():
+    assert precision_for(0.01) == 14
+    assert precision_for(0.05) == 9
+    assert precision_for(0.0001) == 16  # capped
+
+
+def test_count():
+    """Estimates are exact for small sets and within the error bound for large ones."""
+
+    assert HyperLogLog().count() == 0
+    assert HyperLogLog().add(["Frodo", "Sam", "Frodo"]).count() == 2
+
+    sketch = HyperLogLog(error=0.01).add("user{}".format(i) for i in range(100000))
+    assert abs(sketch.count() - 100000) < 100000 * 3 * sketch.error
+
+
+def test_merge_and_serialise():
+    first = HyperLogLog().add(range(0, 6000))
+    second = HyperLogLog().add(range(3000, 9000))
+
+    merged = first.merge(second)
+    assert abs(merged.count() - 9000) < 9000 * 3 * merged.error
+
+    loaded = HyperLogLog.from_bytes(merged.to_bytes())
+    assert loaded.precision == merged.precision
+    assert loaded.count() == merged.count()
+
+    with pytest.raises(ValueError):
+        first.merge(HyperLogLog(precision=10))
+
+
+def test_build():
+    """Sketching in groups gives the same registers as sketching each group separately."""
+    registers = build([0, 0, 1, 1, 1], ["a", "b", "a", "c", "d"], 12)
+    assert np.all(registers[0] == HyperLogLog(precision=12).add(["a", "b"]).registers)
+    assert np.all(np.round(estimate(registers)) == [2, 3])
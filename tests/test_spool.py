@@ -0,0 +1,125 @@
+import os
+from datetime import datetime
+
+from pawprint.spool import Spool
+
+
+class FlakyDatabase(object):
+    """Stand-in for Tracker._write_batch that fails while it's down."""
+
+    def __init__(self):
+        self.written = []
+        self.down = False
+
+    def write_batch(self, events):
+        if self.down:
+            raise IOError("database is down")
+        self.written.extend(events)
+
+
+def test_spool_replays_in_order(tmpdir):
+    """Spooled events are written oldest first, across segments, and then removed."""
+
+    spool = Spool(str(tmpdir), segment_bytes=50)
+    for i in range(10):
+        assert spool.append([{"event": i}]) == 1
+    spool.append([{"event": "dated", "timestamp": datetime(2017, 1, 1)}])
+
+    assert spool.depth == 11
+    assert len(os.listdir(str(tmpdir))) > 1
+
+    db = FlakyDatabase()
+    assert spool.replay(db.write_batch, batch_size=3) == 11
+    assert [data["event"] for data in db.written] == list(range(10)) + ["dated"]
+    assert db.written[-1]["timestamp"] == "2017-01-01T00:00:00"
+
+    assert spool.depth == 0
+    assert spool.size == 0
+    assert spool.counters["replayed"] == 11
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_spool_keeps_events_until_written(tmpdir):
+    """Replay stops when the database is down, and a new spool carries on where it stopped."""
+
+    db = FlakyDatabase()
+    calls = [0]
+
+    def write_batch(events):
+        calls[0] += 1
+        db.down = calls[0] > 1
+        db.write_batch(events)
+
+    spool = Spool(str(tmpdir))
+    spool.append([{"event": i} for i in range(5)])
+    assert spool.replay(write_batch, batch_size=2, retry_on=IOError) == 2
+    assert spool.depth == 3
+    spool.close()
+
+    # A crash can leave part of a line at the end of a segment
+    segment = os.path.join(str(tmpdir), sorted(os.listdir(str(tmpdir)))[0])
+    with open(segment, "ab") as f:
+        f.write(b'{"event": ')
+
+    spool = Spool(str(tmpdir))
+    assert spool.depth == 3
+    db.down = False
+    assert spool.replay(db.write_batch) == 3
+    assert [data["event"] for data in db.written] == list(range(5))
+
+
+def test_spool_rejects_and_caps(tmpdir):
+    """Events that can't be written are set aside, and events past max_bytes are dropped."""
+
+    def reject(events):
+        raise ValueError("invalid event")
+
+    spool = Spool(str(tmpdir), max_bytes=100)
+    assert spool.append([{"event": "a" * 10}] * 3) == 3
+    assert spool.append([{"event": "a" * 50}]) == 0
+    assert spool.counters["dropped"] == 1
+
+    assert spool.replay(reject, retry_on=IOError) == 0
+    assert spool.counters["rejected"] == 3
+    assert spool.depth == 0
+    assert [name.endswith(".rejected") for name in os.listdir(str(tmpdir))] == [True]
+
+    # Space is freed once events are set aside
+    assert spool.append([{"event": "a" * 50}]) == 1
+
+
+def test_spool_rejects_only_failing_events(tmpdir):
+    """One event that can't be written doesn't set aside the rest of its batch or segment."""
+
+    written = []
+
+    def write_batch(events):
+        if any(data["event"] == 5 for data in events):
+            raise ValueError("invalid event")
+        written.extend(events)
+
+    spool = Spool(str(tmpdir))
+    spool.append([{"event": i} for i in range(20)])
+
+    assert spool.replay(write_batch, batch_size=8, retry_on=IOError) == 19
+    assert [data["event"] for data in written] == [i for i in range(20) if i != 5]
+    assert spool.counters["rejected"] == 1
+    assert spool.depth == 0
+
+    (rejected,) = os.listdir(str(tmpdir))
+    with open(os.path.join(str(tmpdir), rejected)) as f:
+        assert f.read() == '{"event": 5}\n'
+
+
+def test_spool_worker(tmpdir):
+    """The replay worker writes spooled events in the background."""
+
+    db = FlakyDatabase()
+    spool = Spool(str(tmpdir))
+    spool.start(lambda: spool.replay(db.write_batch), interval=0.01)
+    spool.append([{"event": 0}])
+    while spool.depth:
+        pass
+    spool.close()
+
+    assert db.written == [{"event": 0}]
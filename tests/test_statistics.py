@@ -1,5 +1,7 @@
 from datetime import datetime, timedelta
 import numpy as np
+import pandas as pd
+import pytest
 
 import pawprint
 
@@ -235,3 +237,306 @@ def test_event_session_map_table_created(pawprint_default_statistics_tracker):
         col in map_df.columns for col in ["event_id", "user_id", "timestamp", "session_timestamp"]
     )
     assert map_df["timestamp"].max() >= map_df["session_timestamp"].max()
+
+
+def test_event_session_map_matches_sessions(pawprint_default_statistics_tracker):
+    """Every event is mapped to the session that contains it."""
+    tracker = pawprint_default_statistics_tracker
+    stats = pawprint.Statistics(tracker)
+    stats.sessions()
+
+    sessions = stats["sessions"].read()
+    map_df = stats["event_session_map"].read()
+
+    # Events are never mapped to a session that starts after them
+    assert np.all(map_df["session_timestamp"] <= map_df["timestamp"])
+
+    # Each session's events are exactly those mapped to it
+    mapped = map_df.groupby(["user_id", "session_timestamp"]).size()
+    expected = sessions.set_index(["user_id", "timestamp"])["total_events"]
+    assert np.all(mapped.sort_index().values == expected.sort_index().values)
+
+
+def test_sessions_sql_method(pawprint_default_statistics_tracker):
+    """Sessions calculated inside the database match those calculated in pandas."""
+    tracker = pawprint_default_statistics_tracker
+    stats = pawprint.Statistics(tracker)
+
+    stats.sessions()
+    pandas_sessions = stats["sessions"].read()
+    pandas_map = stats["event_session_map"].read()
+
+    stats.sessions(clean=True, method="sql")
+    sql_sessions = stats["sessions"].read()
+    sql_map = stats["event_session_map"].read()
+
+    assert np.all(sql_sessions[tracker.user_field] == ["Frodo", "Gandalf", "Frodo", "Frodo"])
+    assert np.all(sql_sessions.duration == [5, 40, 0, 4])
+    assert np.all(sql_sessions.total_events == [6, 4, 1, 5])
+    assert np.all(sql_sessions.timestamp == pandas_sessions.timestamp)
+
+    pandas_map = pandas_map.sort_values("event_id").reset_index(drop=True)
+    sql_map = sql_map.sort_values("event_id").reset_index(drop=True)
+    assert np.all(pandas_map.values == sql_map.values)
+
+    # Running again with new data only adds new sessions
+    today = datetime.now()
+    yesterday = datetime(today.year, today.month, today.day, 9, 0) - timedelta(days=1)
+    for user, delta in zip(["Sam", "Sam", "Frodo"], [2000, 2010, 2100]):
+        tracker.write(user_id=user, timestamp=yesterday + timedelta(minutes=delta))
+
+    stats.sessions(method="sql")
+    sql_sessions = stats["sessions"].read()
+    assert len(sql_sessions) == 6
+    assert np.all(sql_sessions.total_events.iloc[-2:] == [2, 1])
+
+    # Running again with no new data does nothing
+    stats.sessions(method="sql")
+    assert len(stats["sessions"].read()) == 6
+    assert len(stats["event_session_map"].read()) == 19
+
+
+def test_engagement_rolling_windows(pawprint_default_statistics_tracker):
+    """WAU and MAU count distinct users over the trailing 7 and 30 days."""
+
+    tracker = pawprint_default_statistics_tracker
+    tracker.drop_table()
+    tracker.create_table()
+
+    # One user every day, another weekly, and a third who stops after the first day
+    start = datetime(2017, 1, 1, 12)
+    for day in range(40):
+        timestamp = start + timedelta(days=day, hours=day % 5)
+        tracker.write(event="visit", user_id="daily", timestamp=timestamp)
+        if day % 7 == 0:
+            tracker.write(event="visit", user_id="weekly", timestamp=timestamp)
+    tracker.write(event="visit", user_id="once", timestamp=start)
+
+    stats = pawprint.Statistics(tracker)
+    stats.sessions()
+    stats.engagement(min_sessions=0)
+    stickiness = stats["engagement"].read().set_index("timestamp")
+
+    assert len(stickiness) == 40
+    assert list(stickiness.wau[:7]) == [3] * 7
+    assert list(stickiness.wau[7:]) == [2] * 33
+    assert list(stickiness.mau[:30]) == [3] * 30
+    assert list(stickiness.mau[30:]) == [2] * 10
+
+
+def test_engagement_approximate(pawprint_default_statistics_tracker):
+    """Approximate engagement from user sketches matches the exact counts for few users."""
+
+    tracker = pawprint_default_statistics_tracker
+    stats = pawprint.Statistics(tracker)
+    stats.sessions()
+
+    stats.engagement(min_sessions=0)
+    exact = stats["engagement"].read()
+
+    stats.engagement(clean=True, min_sessions=0, approximate=True)
+    approximate = stats["engagement"].read()
+
+    assert np.all(approximate.timestamp == exact.timestamp)
+    assert np.all(approximate[["dau", "wau", "mau"]] == exact[["dau", "wau", "mau"]])
+
+    # Sketches are built incrementally, and must keep the same error
+    stats.sketches()
+    assert len(stats["user_sketches"].read()) == 2
+    with pytest.raises(ValueError):
+        stats.sketches(error=0.05)
+
+
+def test_count_approximate(pawprint_default_statistics_tracker):
+    """Distinct user counts can be estimated from sketches, and fall back to exact counts."""
+
+    tracker = pawprint_default_statistics_tracker
+    stats = pawprint.Statistics(tracker)
+
+    # Without sketches, the count is exact
+    with pytest.warns(UserWarning):
+        exact = tracker.count("DISTINCT(user_id)", approximate=True)
+
+    stats.sketches()
+    approximate = tracker.count("DISTINCT(user_id)", approximate=True)
+    assert np.all(approximate.values == exact.values)
+
+    by_month = tracker.count("DISTINCT(user_id)", resolution="month", approximate=True)
+    assert by_month["count"].max() == 2
+
+    # Conditional counts can't be estimated
+    with pytest.warns(UserWarning):
+        tracker.count("DISTINCT(user_id)", approximate=True, user_id="Frodo")
+
+
+def test_engagement_incremental(pawprint_default_statistics_tracker):
+    """Incremental engagement matches a full calculation, and only adds new days."""
+
+    tracker = pawprint_default_statistics_tracker
+    stats = pawprint.Statistics(tracker)
+    stats.sessions()
+
+    stats.engagement(min_sessions=2)
+    exact = stats["engagement"].read()
+
+    stats.engagement(clean=True, min_sessions=2, incremental=True)
+    incremental = stats["engagement"].read()
+
+    assert list(incremental.columns) == list(exact.columns)
+    assert np.all(incremental.values == exact.values)
+
+    counts = pd.read_sql(
+        "SELECT * FROM {}".format(stats["user_session_counts"].table), tracker.engine
+    ).set_index("user_id")
+    assert counts.sessions.to_dict() == {"Frodo": 3, "Gandalf": 1}
+
+    # New sessions tomorrow are folded into the running state
+    today = datetime.now()
+    tomorrow = datetime(today.year, today.month, today.day, 12, 0) + timedelta(days=1)
+    for user in ["Frodo", "Sam"]:
+        tracker.write(user_id=user, timestamp=tomorrow)
+    stats.sessions()
+    stats.engagement(min_sessions=2, incremental=True)
+
+    counts = pd.read_sql(
+        "SELECT * FROM {}".format(stats["user_session_counts"].table), tracker.engine
+    ).set_index("user_id")
+    assert counts.sessions.to_dict() == {"Frodo": 4, "Gandalf": 1, "Sam": 1}
+
+    stickiness = stats["engagement"].read()
+    assert len(stickiness) == len(exact) + 1
+    assert stickiness.mau.iloc[-1] == 3
+    assert stickiness.mau_active.iloc[-1] == 1
+
+
+def test_watermarks_and_retention(pawprint_default_statistics_tracker):
+    """Sessions carry on from their watermark once old rows are removed for retention."""
+
+    tracker = pawprint_default_statistics_tracker
+    stats = pawprint.Statistics(tracker)
+    stats.sessions()
+    stats.engagement(min_sessions=0)
+
+    watermark = stats._watermark(stats["event_session_map"])
+    assert watermark == tracker.read().timestamp.max()
+
+    # Every derived row is older than a day, so all of them are removed
+    stats.maintain(retention=0)
+    for name in ("sessions", "event_session_map", "engagement"):
+        assert len(stats[name].read()) == 0
+
+    # Nothing is recalculated, but new events are picked up
+    stats.sessions()
+    assert len(stats["sessions"].read()) == 0
+    tracker.write(user_id="Sam", timestamp=datetime.now())
+    stats.sessions()
+    assert list(stats["sessions"].read().user_id) == ["Sam"]
+    assert stats._watermark(stats["event_session_map"]) > watermark
+
+    # Starting clean forgets the watermark
+    stats.sessions(clean=True)
+    assert len(stats["sessions"].read()) == 5
+
+
+def test_partitioned_sessions(pawprint_default_statistics_tracker):
+    """Sessions can be written to indexed, partitioned tables."""
+
+    tracker = pawprint_default_statistics_tracker
+    tracker.write(user_id="Bilbo", timestamp=datetime(2017, 1, 5))
+    stats = pawprint.Statistics(tracker, partition="month")
+    stats.sessions()
+
+    sessions = stats["sessions"].read()
+    assert list(sessions.user_id) == ["Bilbo", "Frodo", "Gandalf", "Frodo", "Frodo"]
+    assert list(sessions.total_events) == [1, 6, 4, 1, 5]
+
+    # Only the old session falls outside the partitions made up front, and the tables are indexed
+    for name in ("sessions", "event_session_map"):
+        table = stats[name].table
+        assert pd.io.sql.execute(
+            "SELECT user_id FROM {}_default".format(table), tracker.db
+        ).fetchall() == [("Bilbo",)]
+        indexes = pd.io.sql.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = '{}'".format(table), tracker.db
+        ).fetchall()
+        assert ("{}_timestamp_idx".format(table),) in indexes
+
+    # Old sessions are moved into a partition of their own, which maintenance drops
+    assert len(stats["sessions"].read()) == 5
+    stats.maintain(retention=365)
+    assert len(stats["sessions"].read()) == 4
+    assert stats._last_entry(stats["event_session_map"]) == tracker.read().timestamp.max()
+
+
+def test_duckdb_method(pawprint_default_statistics_tracker):
+    """Sessions and engagement calculated in DuckDB match those calculated in pandas."""
+
+    pytest.importorskip("duckdb")
+    pytest.importorskip("pyarrow")
+
+    tracker = pawprint_default_statistics_tracker
+    stats = pawprint.Statistics(tracker)
+
+    stats.sessions()
+    pandas_sessions = stats["sessions"].read()
+    pandas_map = stats["event_session_map"].read()
+    stats.engagement(min_sessions=2)
+    pandas_engagement = stats["engagement"].read()
+
+    stats.sessions(clean=True, method="duckdb")
+    duckdb_sessions = stats["sessions"].read()
+    duckdb_map = stats["event_session_map"].read()
+
+    assert np.all(duckdb_sessions.values == pandas_sessions.values)
+    pandas_map = pandas_map.sort_values("event_id").reset_index(drop=True)
+    duckdb_map = duckdb_map.sort_values("event_id").reset_index(drop=True)
+    assert np.all(pandas_map.values == duckdb_map.values)
+
+    stats.engagement(clean=True, min_sessions=2, method="duckdb")
+    duckdb_engagement = stats["engagement"].read()
+    assert list(duckdb_engagement.columns) == list(pandas_engagement.columns)
+    assert np.all(duckdb_engagement.values == pandas_engagement.values)
+
+    # Running again with no new data does nothing
+    stats.sessions(method="duckdb")
+    stats.engagement(min_sessions=2, method="duckdb")
+    assert len(stats["sessions"].read()) == len(pandas_sessions)
+    assert len(stats["engagement"].read()) == len(pandas_engagement)
+
+    with pytest.raises(ValueError):
+        stats.engagement(method="duckdb", incremental=True)
+
+
+def test_sessions_parallel(pawprint_default_statistics_tracker):
+    """Sessions calculated in shards of users, in parallel, match those calculated at once."""
+
+    tracker = pawprint_default_statistics_tracker
+    stats = pawprint.Statistics(tracker)
+
+    stats.sessions()
+    sessions = stats["sessions"].read().sort_values(["user_id", "timestamp"])
+    event_session_map = stats["event_session_map"].read().sort_values("event_id")
+
+    stats.sessions(clean=True, workers=2, shards=3)
+    parallel_sessions = stats["sessions"].read().sort_values(["user_id", "timestamp"])
+    parallel_map = stats["event_session_map"].read().sort_values("event_id")
+    assert np.all(parallel_sessions.values == sessions.values)
+    assert np.all(parallel_map.values == event_session_map.values)
+
+    # Shards can be retried without writing their sessions twice
+    for shard in range(3):
+        stats._sessions_shard(30, "id", None, shard, 3)
+    assert len(stats["sessions"].read()) == len(sessions)
+    assert len(stats["event_session_map"].read()) == len(event_session_map)
+
+    # Running again with no new data does nothing
+    stats.sessions(workers=2)
+    assert len(stats["sessions"].read()) == len(sessions)
+
+    # Shards that keep failing leave no sessions behind
+    with pytest.raises(Exception):
+        stats.sessions(clean=True, workers=2, event_id_col="missing")
+    assert len(stats["sessions"].read()) == 0
+
+    with pytest.raises(ValueError):
+        stats.sessions(method="sql", workers=2)
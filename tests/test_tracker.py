@@ -1,6 +1,8 @@
 import os
 import json
 import pytest
+import threading
+import time
 
 from datetime import datetime
 from collections import OrderedDict
@@ -298,43 +300,66 @@ def test_parse_fields(pawprint_default_tracker_db):
     assert tracker._parse_fields(*args) == "metadata #> '{a, b}' AS json_field"
 
 
-def test_parse_values(pawprint_default_tracker_db):
-    """Test parsing values for write()."""
-
-    tracker = pawprint_default_tracker_db
-
-    # INSERT INTO table (event) VALUES ('logged_in')
-    args = ("logged_in",)
-    assert tracker._parse_values(*args) == "'logged_in'"
-
-    # INSERT INTO table (event, user_id) VALUES ('logged_in', 'hannah')
-    args = ("logged_in", "hannah")
-    assert tracker._parse_values(*args) == "'logged_in', 'hannah'"
-
-
 def test_parse_conditionals(pawprint_default_tracker_db):
-    """Test kwargs passed to read() and _aggregate() are parsed correctly."""
+    """Test kwargs passed to read() and _aggregate() are parsed into bind parameters."""
 
     tracker = pawprint_default_tracker_db
 
     # SELECT * FROM table
     kwargs = {}
-    assert tracker._parse_conditionals(**kwargs) == ""
+    assert tracker._parse_conditionals(**kwargs) == ("", {})
 
     # SELECT * FROM table WHERE user_id = 'Quentin'
     kwargs = {"user_id": "Quentin"}
-    assert tracker._parse_conditionals(**kwargs) == "WHERE user_id = 'Quentin'"
+    assert tracker._parse_conditionals(**kwargs) == (
+        "WHERE user_id = %(cond_0)s",
+        {"cond_0": "Quentin"},
+    )
 
     # SELECT * FROM table WHERE event = 'logged_in' AND user_id = 'Quentin'
-    kwargs = {"event": "logged_in", "user_id": "Quentin"}
-    assert tracker._parse_conditionals(**kwargs) in (
-        "WHERE event = 'logged_in' AND user_id = 'Quentin'",
-        "WHERE user_id = 'Quentin' AND event = 'logged_in'",
+    kwargs = {"user_id": "Quentin", "event": "logged_in"}
+    assert tracker._parse_conditionals(**kwargs) == (
+        "WHERE event = %(cond_0)s AND user_id = %(cond_1)s",
+        {"cond_0": "logged_in", "cond_1": "Quentin"},
     )
 
     # SELECT * FROM table WHERE event IN ('logged_in', 'logged_out')
     kwargs = {"event__in": ["logged_in", "logged_out"]}
-    assert tracker._parse_conditionals(**kwargs) == "WHERE event IN ('logged_in', 'logged_out')"
+    assert tracker._parse_conditionals(**kwargs) == (
+        "WHERE event::text = ANY(%(cond_0)s)",
+        {"cond_0": ["logged_in", "logged_out"]},
+    )
+
+    # Columns that aren't text compare with the array cast to their type, to use their indexes
+    kwargs = {"id__in": [1, 2]}
+    assert tracker._parse_conditionals(**kwargs) == (
+        "WHERE id = ANY(CAST(%(cond_0)s AS TEXT[])::INTEGER[])",
+        {"cond_0": ["1", "2"]},
+    )
+
+    # JSON subfields are compared as text; other values are sent as they'd be quoted
+    kwargs = {"metadata__a__b": 3, "metadata__c__in": [1, 2], "metadata__d__gt": 4}
+    assert tracker._parse_conditionals(**kwargs) == (
+        "WHERE metadata #>> '{a, b}' = %(cond_0)s "
+        "AND metadata #>> '{c}' = ANY(%(cond_1)s) "
+        "AND metadata #> '{d}' > %(cond_2)s",
+        {"cond_0": "3", "cond_1": ["1", "2"], "cond_2": "4"},
+    )
+
+
+def test_conditionals_with_parameters(pawprint_default_tracker_db_with_table):
+    """Conditional values reach the database as parameters, whatever they contain."""
+
+    tracker = pawprint_default_tracker_db_with_table
+    tracker.write(event="100% done", user_id="o'brien", metadata={"step": 2})
+    tracker.write(event="logged_in", user_id="alice", metadata={"step": 3})
+
+    assert len(tracker.read(event="100% done")) == 1
+    assert len(tracker.read(user_id="o'brien")) == 1
+    assert len(tracker.read(id__in=[1, 2])) == 2
+    assert len(tracker.read(metadata__step__in=[2, 5])) == 1
+    assert len(tracker.read(metadata__step__gte=3)) == 1
+    assert tracker.count(event__in=["logged_in"]).loc[0, "count"] == 1
 
 
 def test_accessing_json_fields(pawprint_default_tracker_db_with_table):
@@ -517,3 +542,673 @@ def test_escaping_from_quotes(pawprint_default_tracker_db_with_table):
         },
     )
     assert len(tracker.read()) == 1
+
+
+def test_buffered_write(pawprint_default_tracker_db_with_table):
+    """Test that buffered events are only written when the buffer fills or is flushed."""
+
+    tracker = pawprint_default_tracker_db_with_table
+    tracker.buffer_size = 3
+
+    tracker.write(event="buffered", user_id="alice")
+    tracker.write(event="buffered", user_id="bob")
+    assert len(tracker.read()) == 0
+
+    # The third event fills the buffer and triggers a flush
+    tracker.write(event="buffered", metadata={"batch": True})
+    assert len(tracker.read()) == 3
+    assert len(tracker._buffer) == 0
+
+    # An explicit flush writes whatever is left
+    tracker.write(event="flushed")
+    assert len(tracker.read()) == 3
+    tracker.flush()
+
+    events = tracker.read()
+    assert len(events) == 4
+    assert list(events.event) == ["buffered", "buffered", "buffered", "flushed"]
+    assert events.metadata.iloc[2] == {"batch": True}
+
+
+def test_buffered_write_by_age(pawprint_default_tracker_db_with_table):
+    """Test that buffered events are flushed once the oldest event reaches the age threshold."""
+
+    tracker = pawprint_default_tracker_db_with_table
+    tracker.buffer_age = 0
+
+    tracker.write(event="stale")
+    assert len(tracker.read()) == 1
+
+    # Once traffic stops, queued events are still written when they're old enough
+    tracker.buffer_age = 0.2
+    tracker.write(event="last")
+    assert len(tracker.read()) == 1
+    time.sleep(1)
+    assert len(tracker.read()) == 2
+
+
+def test_buffered_write_threads(pawprint_default_tracker_db_with_table):
+    """Test that no buffered events are lost when several threads write at once."""
+
+    tracker = pawprint_default_tracker_db_with_table
+    tracker.buffer_size = 7
+
+    def write(thread):
+        for i in range(250):
+            tracker.write(event="thread{}".format(thread), user_id=str(i))
+
+    threads = [threading.Thread(target=write, args=(thread,)) for thread in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    tracker.flush()
+
+    assert tracker.count(resolution="year").loc[0, "count"] == 1000
+
+
+def test_buffered_write_errors(error_logger):
+    """Test that every event in a failed batch is logged."""
+
+    tracker = pawprint.Tracker(db="postgresql:///fail", logger=error_logger, buffer_size=10)
+
+    tracker.write(event="first")
+    tracker.write(event="second")
+    with pytest.raises(Exception):
+        tracker.flush()
+
+    with open("pawprint.log", mode="r") as f:
+        logs = [line for line in f.readlines() if line.startswith("pawprint failed to write.")]
+
+    assert any("Query: INSERT INTO None (event) VALUES ('first')" in line for line in logs)
+    assert any("Query: INSERT INTO None (event) VALUES ('second')" in line for line in logs)
+
+    os.remove("pawprint.log")
+
+
+def test_background_write(pawprint_default_tracker_db_with_table):
+    """Test writing events through the background writer thread."""
+
+    table_tracker = pawprint_default_tracker_db_with_table
+    tracker = pawprint.Tracker(db=table_tracker.db, table=table_tracker.table, background=True)
+
+    for i in range(5):
+        tracker.write(event="background", metadata={"i": i})
+    tracker.flush()
+
+    assert len(tracker.read()) == 5
+    assert tracker.counters["queued"] == 5
+    assert tracker.counters["written"] == 5
+    assert tracker.counters["dropped"] == 0
+
+    tracker.close()
+    with pytest.raises(RuntimeError):
+        tracker.write(event="closed")
+
+
+def test_write_many(pawprint_default_tracker_db_with_table):
+    """Test bulk-loading events from a generator with COPY."""
+
+    tracker = pawprint_default_tracker_db_with_table
+    tracker.auto_timestamp = True
+
+    def events():
+        yield {"event": "bulk", "user_id": "alice", "metadata": {"tab\there": "new\nline"}}
+        yield {"event": "bulk", "user_id": None}
+        yield {"event": "back\\slash", "timestamp": datetime(2016, 1, 1)}
+
+    assert tracker.write_many(events()) == 3
+
+    data = tracker.read()
+    assert len(data) == 3
+    assert data.metadata.iloc[1] == {"tab\there": "new\nline"}
+    assert data.user_id.isnull().sum() == 2
+    assert data.event.iloc[0] == "back\\slash"
+    assert data.timestamp.notnull().all()
+
+    # Events can't set fields that aren't being loaded
+    with pytest.raises(ValueError):
+        tracker.write_many([{"event": "bulk"}, {"user_id": "bob"}])
+    assert len(tracker.read()) == 3
+
+    assert tracker.write_many([]) == 0
+
+
+def test_write_dataframe(pawprint_default_tracker_db_with_table):
+    """Test bulk-loading events from a DataFrame."""
+
+    tracker = pawprint_default_tracker_db_with_table
+
+    df = pd.DataFrame(
+        {
+            "timestamp": pd.to_datetime(["2016-01-01 12:30", "2016-01-02 00:00", None]),
+            "user_id": ["alice", None, "charlotte"],
+            "event": ["logged_in"] * 3,
+            "metadata": [{"val": 1}, {"val": 2}, None],
+        }
+    )
+    assert tracker.write_dataframe(df) == 3
+
+    assert len(tracker.read(timestamp__gt="2015-12-31")) == 2
+    assert tracker.sum("metadata__val")["sum"].sum() == 3
+    assert len(tracker.read(user_id="charlotte")) == 1
+
+
+def test_shared_engine(db_string, tracker_test_table_name):
+    """Trackers on the same database with the same pool settings share a connection engine."""
+
+    tracker = pawprint.Tracker(db=db_string, table=tracker_test_table_name)
+    other_table = pawprint.Tracker(db=db_string, table="another_table")
+    other_pool = pawprint.Tracker(db=db_string, table=tracker_test_table_name, pool_size=1)
+
+    assert tracker.engine is other_table.engine
+    assert tracker.engine is not other_pool.engine
+    assert other_pool.engine.pool.size() == 1
+
+    # Trackers for derived statistics reuse the same engine, and are only created once
+    stats = pawprint.Statistics(other_pool)
+    assert stats["sessions"] is stats["sessions"]
+    assert stats["sessions"].engine is other_pool.engine
+    assert pawprint.Tracker(db=None).engine is None
+
+
+def test_rollups(pawprint_default_tracker_db_with_table):
+    """Aggregates served from rollup tables match those calculated from raw events."""
+
+    tracker = pawprint_default_tracker_db_with_table
+    rollups = pawprint.Tracker(
+        db=tracker.db, table=tracker.table, rollups={"hour": ["metadata__val"], "day": []}
+    )
+
+    def write_events(start, n):
+        timestamps = pd.date_range(start, periods=n, freq="37min")
+        tracker.write_dataframe(
+            pd.DataFrame(
+                {
+                    "timestamp": timestamps,
+                    "event": ["logged_in", "logged_out", None] * (n // 3) + ["logged_in"] * (n % 3),
+                    "metadata": [{"val": i % 7} if i % 5 else {} for i in range(n)],
+                }
+            )
+        )
+
+    def assert_same(aggregate, *args, **kwargs):
+        expected = getattr(tracker, aggregate)(*args, **kwargs)
+        actual = getattr(rollups, aggregate)(*args, **kwargs)
+        assert np.all(actual["datetime"] == expected["datetime"])
+        assert np.allclose(
+            actual.iloc[:, 1].astype(float), expected.iloc[:, 1].astype(float), equal_nan=True
+        )
+
+    def assert_all_same():
+        assert_same("count")
+        assert_same("count", resolution="hour", event="logged_in")
+        assert_same("count", resolution="month", start="2017-01-02 05:30", end="2017-01-04")
+        assert_same("sum", "metadata__val", resolution="hour", start="2017-01-01 10:10")
+        assert_same("average", "metadata__val", resolution="week", event="logged_out")
+        assert_same("average", "metadata__val", resolution="day", end="2017-01-03 07:00")
+
+    try:
+        # Before rollups exist, aggregates come from raw events
+        write_events("2017-01-01", 200)
+        assert_all_same()
+
+        # Once rolled up, recent events are combined with the rollups
+        rollups.refresh_rollups()
+        write_events("2017-01-06 04:00", 50)
+        assert_all_same()
+
+        # Refreshing only recalculates the last bucket onwards
+        rollups.refresh_rollups()
+        rollups.refresh_rollups()
+        assert_all_same()
+
+        # Events that arrive late, in buckets already rolled up, are counted before and after
+        # the next refresh
+        write_events("2017-01-02 03:00", 25)
+        assert_all_same()
+        rollups.refresh_rollups()
+        assert_all_same()
+
+        # Events committed after a refresh that started while they were being written, with
+        # earlier ids than events it rolled up, are counted too
+        connection = tracker.engine.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO {} (timestamp, event) "
+                    "VALUES ('2017-01-01 01:00', 'logged_in')".format(tracker.table)
+                )
+            write_events("2017-01-03 05:00", 5)
+            rollups.refresh_rollups()
+            connection.commit()
+        finally:
+            connection.close()
+        assert_all_same()
+        rollups.refresh_rollups()
+        assert_all_same()
+
+        # Rollups answer without raw events for the buckets they cover
+        tracker.query("DELETE FROM {} WHERE timestamp < '2017-01-02'".format(tracker.table))
+        assert rollups.count().loc[0, "count"] > 0
+        assert rollups.count(resolution="minute")["datetime"].min() >= pd.Timestamp("2017-01-02")
+
+    finally:
+        for resolution in ("hour", "day"):
+            tracker.query(
+                "DROP TABLE IF EXISTS {0}__rollup_{1}, {0}__rollup_{1}_dirty".format(
+                    tracker.table, resolution
+                )
+            )
+
+
+def test_query_cache(pawprint_default_tracker_db_with_table):
+    """Reads and aggregates are cached until the tracker writes to the table."""
+
+    tracker = pawprint.Tracker(
+        db=pawprint_default_tracker_db_with_table.db,
+        table=pawprint_default_tracker_db_with_table.table,
+        cache_size=1024 ** 2,
+    )
+    tracker.write(event="logged_in", user_id="alice")
+
+    first = tracker.read()
+    first.drop(first.index, inplace=True)  # modifying results doesn't affect the cache
+    assert len(tracker.read()) == 1
+    assert len(tracker.count()) == 1
+    assert tracker.cache_counters["hits"] == 1
+    assert tracker.cache_counters["misses"] == 2
+
+    # Writes invalidate the cache
+    tracker.write(event="logged_in", user_id="bob")
+    assert len(tracker.read()) == 2
+    assert tracker.cache_counters["misses"] == 3
+
+    # Passing ttl=0 skips the cache, and trackers don't cache by default
+    tracker.read(ttl=0)
+    assert tracker.cache_counters["hits"] == 1
+    assert pawprint_default_tracker_db_with_table.cache_counters == {}
+
+
+def test_read_iter(pawprint_default_tracker_db_with_table):
+    """Tables can be read lazily in chunks, and reading can carry on where it left off."""
+
+    tracker = pawprint_default_tracker_db_with_table
+    timestamps = pd.date_range("2017-01-01", periods=25, freq="H")
+    tracker.write_dataframe(
+        pd.DataFrame(
+            {
+                "timestamp": timestamps,
+                "user_id": ["alice", "bob"] * 12 + ["alice"],
+                "event": "logged_in",
+            }
+        )
+    )
+
+    chunks = list(tracker.read_iter(chunksize=10))
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), tracker.read())
+
+    # Fields and conditionals work as they do in .read()
+    chunks = tracker.read_iter("timestamp", chunksize=5, user_id="alice")
+    first = next(chunks)
+    assert list(first.columns) == ["timestamp"]
+    assert np.all(first.timestamp == timestamps[0:10:2])
+    assert chunks.after == (timestamps[8], 9)
+    chunks.close()
+
+    # Resume from the last row read
+    rest = pd.concat(tracker.read_iter("timestamp", after=chunks.after, user_id="alice"))
+    assert np.all(rest.timestamp == timestamps[10::2])
+
+    rows = next(tracker.read_iter("user_id", chunksize=2, raw=True))
+    assert rows == [("alice",), ("bob",)]
+
+
+def test_read_arrow_and_export_parquet(pawprint_default_tracker_db_with_table, tmpdir):
+    """Events can be read into Arrow, with types from the table, and exported to Parquet."""
+
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.dataset
+
+    tracker = pawprint_default_tracker_db_with_table
+    tracker.write(event="logged_in", user_id="alice", timestamp="2017-01-01 12:00")
+    tracker.write(event="", timestamp="2017-01-02 13:00", metadata={"a, b": "c\nd"})
+    tracker.write(event="logged_out", user_id="alice", timestamp="2017-02-01 09:30:00.123456")
+
+    table = tracker.read_arrow()
+    assert table.schema.field("id").type == pyarrow.int32()
+    assert table.schema.field("timestamp").type == pyarrow.timestamp("us")
+    assert table.column("event").to_pylist() == ["logged_in", "", "logged_out"]
+    assert table.column("user_id").to_pylist() == ["alice", None, "alice"]
+    assert json.loads(table.column("metadata")[1].as_py()) == {"a, b": "c\nd"}
+
+    expected = tracker.read()
+    actual = table.to_pandas()
+    assert np.all(actual["timestamp"] == expected["timestamp"])
+    assert np.all(actual["id"] == expected["id"])
+
+    assert tracker.read_arrow("user_id", event="logged_out").num_rows == 1
+
+    # Queries without results give empty tables
+    empty = tracker.read_arrow("id", event="signed_up")
+    assert empty.num_rows == 0
+    assert empty.schema.field("id").type == pyarrow.int32()
+    assert tracker.export_parquet(str(tmpdir.join("empty")), event="signed_up") == 0
+
+    # Export to a dataset partitioned by month
+    path = str(tmpdir.join("events"))
+    assert tracker.export_parquet(path, "user_id", "timestamp", partition_by="month") == 3
+    assert sorted(os.listdir(path)) == ["month=2017-01", "month=2017-02"]
+
+    dataset = pyarrow.dataset.dataset(path, format="parquet", partitioning="hive")
+    exported = dataset.to_table().to_pandas().sort_values("timestamp")
+    assert list(exported["user_id"]) == ["alice", None, "alice"]
+    assert list(exported["month"]) == ["2017-01", "2017-01", "2017-02"]
+
+    with pytest.raises(ValueError):
+        tracker.export_parquet(path, partition_by="week")
+
+
+def test_prepared_writes(pawprint_default_tracker_db_with_table):
+    """Writes can run as prepared statements, prepared once per connection."""
+
+    tracker = pawprint.Tracker(
+        db=pawprint_default_tracker_db_with_table.db,
+        table=pawprint_default_tracker_db_with_table.table,
+        prepare=True,
+        pool_size=1,
+        max_overflow=0,
+    )
+
+    for i in range(3):
+        tracker.write(event="logged_in", user_id="user{}".format(i))
+    tracker.write(event="navigation", metadata={"to": "dashboard"})
+
+    events = tracker.read()
+    assert list(events.event) == ["logged_in"] * 3 + ["navigation"]
+    assert events.metadata.iloc[3] == {"to": "dashboard"}
+
+    # One INSERT was built for each set of fields, and one statement prepared for each, and for
+    # the read
+    assert len(tracker._insert_queries) == 2
+    connection = tracker.engine.raw_connection()
+    assert len(connection.info["pawprint_prepared"]) == 3
+    connection.close()
+
+    # If the table changes underneath a prepared statement, writes recover once it's back
+    tracker.drop_table()
+    with pytest.raises(ProgrammingError):
+        tracker.write(event="logged_in", user_id="user0")
+    tracker.create_table()
+    tracker.write(event="logged_in", user_id="user0")
+    assert len(tracker.read()) == 1
+
+
+def test_prepared_reads(pawprint_default_tracker_db_with_table):
+    """Reads and aggregates can run as prepared statements, and return the same results."""
+
+    tracker = pawprint_default_tracker_db_with_table
+    prepared = pawprint.Tracker(
+        db=tracker.db, table=tracker.table, prepare=True, pool_size=1, max_overflow=0
+    )
+
+    for i in range(4):
+        tracker.write(
+            event="logged_in" if i % 2 else "100% done",
+            user_id="user{}".format(i),
+            timestamp=datetime(2017, 1, 1 + i),
+            metadata={"val": i},
+        )
+
+    def assert_same(method, *args, **kwargs):
+        expected = getattr(tracker, method)(*args, **kwargs)
+        actual = getattr(prepared, method)(*args, **kwargs)
+        pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+    assert_same("read")
+    assert_same("read", "user_id", "metadata__val", event="100% done")
+    assert_same("read", id__in=[1, 3], metadata__val__gte=2)
+    assert_same("count", resolution="month", event__in=["logged_in"])
+    assert_same("sum", "metadata__val", start="2017-01-02")
+    assert_same("aggregate", aggs={"n": ("count", "*"), "p50": ("median", "metadata__val")})
+    assert prepared.events.where(id__in=[2, 3, 4]).count() == 3
+
+    # Errors are raised as they are without prepared statements, so aggregates fall back to raw
+    # events until rollups are refreshed
+    rollups = pawprint.Tracker(
+        db=tracker.db, table=tracker.table, prepare=True, rollups={"day": ["metadata__val"]}
+    )
+    assert list(rollups.count()["count"]) == [1, 1, 1, 1]
+    assert list(rollups.sum("metadata__val")["sum"]) == [0, 1, 2, 3]
+    missing = pawprint.Tracker(db=tracker.db, table="pawprint_missing", prepare=True)
+    with pytest.raises(ProgrammingError):
+        missing.read()
+
+    # Running a read again reuses its statement
+    connection = prepared.engine.raw_connection()
+    statements = len(connection.info["pawprint_prepared"])
+    connection.close()
+    prepared.read(id__in=[4], metadata__val__gte=0)
+    connection = prepared.engine.raw_connection()
+    assert len(connection.info["pawprint_prepared"]) == statements
+    connection.close()
+
+
+def test_partitions_and_indexes(pawprint_default_tracker_db):
+    """Test that partitioned tables are created, maintained and aged out."""
+
+    tracker = pawprint_default_tracker_db
+    table = tracker.table
+    tracker.create_table(partition="month", indexes=True)
+
+    def partitions():
+        return sorted(
+            name
+            for name, in pd.io.sql.execute(
+                "SELECT c.relname FROM pg_inherits AS i JOIN pg_class AS c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = '{}'::regclass".format(table),
+                tracker.db,
+            ).fetchall()
+        )
+
+    # The current month and the next three are partitioned, along with a default partition
+    this_month = "{}_{}".format(table, datetime.now().strftime("%Y_%m"))
+    assert len(partitions()) == 5
+    assert this_month in partitions() and "{}_default".format(table) in partitions()
+
+    indexes = [
+        name
+        for name, in pd.io.sql.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = '{}'".format(table), tracker.db
+        ).fetchall()
+    ]
+    for name in ("timestamp", "user", "event", "json"):
+        assert "{}_{}_idx".format(table, name) in indexes
+
+    # Old events go to the default partition, until their month gets a partition
+    tracker.write(event="logged_in", user_id="user0", timestamp=datetime(2019, 1, 5))
+    tracker.write(event="logged_in", user_id="user1", timestamp=datetime.now())
+    assert tracker.maintain_partitions() == {"created": [table + "_2019_01"], "removed": []}
+    assert pd.io.sql.execute(
+        "SELECT COUNT(*) FROM {}_2019_01".format(table), tracker.db
+    ).fetchall() == [(1,)]
+    assert len(tracker.read()) == 2
+
+    # Partitions older than the retention period are dropped
+    removed = tracker.maintain_partitions(retention=365, drop=True)
+    assert removed == {"created": [], "removed": [table + "_2019_01"]}
+    assert (tracker.read().user_id == ["user1"]).all()
+    assert len(partitions()) == 5
+
+    # Only known periods can be partitioned
+    with pytest.raises(ValueError):
+        pawprint.Tracker(db=tracker.db, table="other").create_table(partition="fortnight")
+
+
+def test_spooled_writes(pawprint_default_tracker_db_with_table, tmpdir):
+    """Events are spooled while the database is unavailable, and replayed once it's back."""
+
+    tracker = pawprint_default_tracker_db_with_table
+    spool_path = str(tmpdir.join("spool"))
+
+    # Nothing is listening on this port, so the write can't reach the database
+    unavailable = pawprint.Tracker(
+        db=tracker.db.replace(":5432/", ":5999/"), table=tracker.table, spool_path=spool_path
+    )
+    unavailable.write(event="logged_in", user_id="user0", metadata={"from": "spool"})
+    assert unavailable.spool_counters["depth"] == 1
+    unavailable.close()
+    assert unavailable.spool_counters["replayed"] == 0
+
+    # Invalid events still raise
+    with pytest.raises(ProgrammingError):
+        pawprint.Tracker(db=tracker.db, table=tracker.table, spool_path=spool_path).write(
+            no_such_field=1
+        )
+
+    # A tracker on the same spool replays it, and in defer mode, every event is spooled first
+    deferred = pawprint.Tracker(
+        db=tracker.db, table=tracker.table, spool_path=spool_path, spool_mode="defer"
+    )
+    deferred.write(event="logged_in", user_id="user1")
+    assert deferred.spool_counters["depth"] == 2
+    assert len(tracker.read()) == 0
+
+    deferred.flush()
+    events = tracker.read()
+    assert list(events.user_id) == ["user0", "user1"]
+    assert events.metadata[0] == {"from": "spool"}
+    assert deferred.spool_counters["depth"] == 0
+    deferred.close()
+
+    with pytest.raises(ValueError):
+        pawprint.Tracker(db=tracker.db, table=tracker.table, spool_mode="sometimes")
+
+
+def test_native_values(pawprint_default_tracker_db_with_table):
+    """Values are sent to the database as native types, rather than as strings."""
+
+    tracker = pawprint_default_tracker_db_with_table
+    timestamp = datetime(2017, 1, 1, 12, 30, 15, 123456)
+
+    tracker.write(event="a", user_id=None, timestamp=timestamp, metadata=["x", {"y": 1}])
+    tracker.write_many([{"event": "b", "user_id": 7, "metadata": [1, 2]}])
+
+    events = tracker.read()
+    assert events.user_id[0] is None
+    assert events.timestamp[0] == timestamp
+    assert events.metadata[0] == ["x", {"y": 1}]
+    assert events.user_id[1] == "7"
+    assert events.metadata[1] == [1, 2]
+
+    with pytest.raises(ValueError):
+        pawprint.Tracker(db=tracker.db, table=tracker.table, json_encoder="yaml")
+
+
+def test_native_value_round_trips(pawprint_default_tracker_db_with_table):
+    """Values are stored the same way by every write path, and can be read back as written."""
+
+    tracker = pawprint_default_tracker_db_with_table
+
+    tracker.write(event=True, user_id=1, metadata=5)
+    tracker.write_many([{"event": True, "user_id": 2, "metadata": True}])
+    tracker.buffer_size = 2
+    tracker.write(event=True, user_id=3, metadata="[1]")
+    tracker.write(event=False, user_id=4, metadata={"a": False})
+
+    events = tracker.read(event=True).sort_values("user_id").reset_index(drop=True)
+    assert list(events.event) == ["True", "True", "True"]
+    assert list(events.user_id) == ["1", "2", "3"]
+    assert events.metadata[0] == 5
+    assert events.metadata[1] is True
+    assert events.metadata[2] == [1]
+    assert tracker.read(event=False).metadata[0] == {"a": False}
+
+
+def test_sqlite(tmpdir):
+    """Trackers can write, read and aggregate events in a local SQLite file."""
+
+    tracker = pawprint.Tracker(db="sqlite:///{}".format(tmpdir.join("events.db")), table="events")
+    tracker.create_table(indexes=True)
+
+    tracker.write(event="login", user_id="a", metadata={"val": 3, "tags": ["x", "y"]})
+    tracker.write(event="login", user_id="b", metadata={"val": 5, "tags": ["y"]})
+    tracker.write(event="logout", user_id="a", timestamp=datetime(2017, 1, 1, 12, 30))
+    tracker.write_many([{"event": "bulk", "user_id": "c", "metadata": {"val": 7}}] * 2)
+
+    events = tracker.read().sort_values("id").reset_index(drop=True)
+    assert len(events) == 5
+    assert events.timestamp.dtype == "datetime64[ns]"
+    assert events.metadata[0] == {"val": 3, "tags": ["x", "y"]}
+    assert events.metadata[2] is None
+
+    values = tracker.read("metadata__val", event__in=["login", "bulk"]).json_field
+    assert sorted(values) == [3, 5, 7, 7]
+    assert sorted(tracker.read("user_id", metadata__val__gt=4).user_id) == ["b", "c", "c"]
+    assert sorted(tracker.read("user_id", metadata__tags__contains="y").user_id) == ["a", "b"]
+    assert list(tracker.read("event", timestamp__lt=datetime(2018, 1, 1)).event) == ["logout"]
+
+    counts = tracker.count(resolution="year")
+    assert list(counts["count"]) == [1, 4]
+    assert counts.datetime[0] == datetime(2017, 1, 1)
+    assert tracker.sum("metadata__val", resolution="month")["sum"].iloc[-1] == 22
+    assert tracker.average("metadata__val", event="login", resolution="day")["avg"][0] == 4
+
+    # Features that rely on PostgreSQL aren't available
+    with pytest.raises(NotImplementedError):
+        tracker.read_iter()
+
+    tracker.drop_table()
+
+
+def test_aggregate(pawprint_default_tracker_db_with_table):
+    """Several aggregates, grouped by period and by fields, are calculated in one query."""
+
+    tracker = pawprint_default_tracker_db_with_table
+    for day, event, price in [
+        (1, "sale", 10),
+        (1, "sale", 20),
+        (1, "refund", 5),
+        (2, "sale", 30),
+        (2, "sale", 50),
+        (2, "sale", 70),
+    ]:
+        tracker.write(event=event, timestamp=datetime(2017, 1, day, 12), metadata={"price": price})
+
+    aggs = OrderedDict(
+        [
+            ("n", ("count", "*")),
+            ("total", ("sum", "metadata__price")),
+            ("average", ("avg", "metadata__price")),
+            ("cheapest", ("min", "metadata__price")),
+            ("median", ("median", "metadata__price")),
+            ("p90", ("p90", "metadata__price")),
+        ]
+    )
+    results = tracker.aggregate("day", aggs=aggs, by=["event"])
+    assert list(results.columns) == ["datetime", "event"] + list(aggs)
+    assert list(results.event) == ["refund", "sale", "sale"]
+    assert list(results.n) == [1, 2, 3]
+    assert list(results.total) == [5, 30, 150]
+    assert list(results.average) == [5, 15, 50]
+    assert list(results.cheapest) == [5, 10, 30]
+    assert list(results["median"]) == [5, 15, 50]
+    assert list(results.p90) == pytest.approx([5, 19, 66])
+
+    # Wide results have a column per aggregate and event
+    wide = tracker.aggregate("day", aggs=aggs, by=["event"], wide=True)
+    assert list(wide.index) == [datetime(2017, 1, 1), datetime(2017, 1, 2)]
+    assert wide[("total", "sale")].tolist() == [30, 150]
+    assert np.isnan(wide[("total", "refund")].iloc[1])
+
+    # Aggregates can be limited in time and by conditions, and taken over all time
+    totals = tracker.aggregate(
+        None, aggs={"total": ("sum", "metadata__price")}, start=datetime(2017, 1, 2), event="sale"
+    )
+    assert totals.total[0] == 150
+
+    with pytest.raises(ValueError):
+        tracker.aggregate("day")
+    with pytest.raises(ValueError):
+        tracker.aggregate("day", aggs={"x": ("mode", "metadata__price")})
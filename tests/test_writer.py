@@ -0,0 +1,186 @@
+import json
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+from pawprint.writer import BackgroundWriter
+
+
+class SlowDatabase(object):
+    """Stand-in for Tracker._write_batch that holds every batch until it's released."""
+
+    def __init__(self):
+        self.written = []
+        self.release = threading.Event()
+
+    def write_batch(self, events):
+        self.release.wait()
+        self.written.extend(events)
+
+
+def test_background_writer_writes_everything():
+    """Events put on the queue are all written by the time the writer is flushed."""
+
+    db = SlowDatabase()
+    db.release.set()
+    writer = BackgroundWriter(db.write_batch, batch_size=3)
+
+    for i in range(10):
+        writer.put({"event": i})
+    writer.flush()
+
+    assert [data["event"] for data in db.written] == list(range(10))
+    assert writer.counters["queued"] == 10
+    assert writer.counters["written"] == 10
+    assert writer.depth == 0
+
+    writer.close()
+    with pytest.raises(RuntimeError):
+        writer.put({"event": "too late"})
+
+
+def test_background_writer_drop_oldest():
+    """When the queue is full, the oldest queued events are discarded."""
+
+    db = SlowDatabase()
+    writer = BackgroundWriter(
+        db.write_batch, queue_size=2, batch_size=1, backpressure="drop_oldest"
+    )
+
+    # The first event is picked up by the worker, which then waits on the database
+    writer.put({"event": 0})
+    while writer.depth:
+        pass
+    for i in range(1, 5):
+        writer.put({"event": i})
+
+    db.release.set()
+    writer.close()
+
+    assert [data["event"] for data in db.written] == [0, 3, 4]
+    assert writer.counters["dropped"] == 2
+    assert writer.counters["written"] == 3
+
+
+def test_background_writer_drop_oldest_never_blocks():
+    """Threads putting events on a full queue at once never wait for the database."""
+
+    db = SlowDatabase()
+    writer = BackgroundWriter(
+        db.write_batch, queue_size=1, batch_size=1, backpressure="drop_oldest"
+    )
+
+    def put():
+        for i in range(500):
+            writer.put({"event": i})
+
+    threads = [threading.Thread(target=put) for _ in range(4)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert not any(thread.is_alive() for thread in threads)
+
+    db.release.set()
+    writer.close()
+    assert writer.counters["queued"] == 2000
+    assert writer.counters["written"] + writer.counters["dropped"] == 2000
+
+
+def test_background_writer_spill(tmpdir):
+    """When the queue is full, events are spilled to disk and written on flush."""
+
+    db = SlowDatabase()
+    spill_path = tmpdir.join("spill")
+    writer = BackgroundWriter(
+        db.write_batch, queue_size=1, batch_size=1, backpressure="spill", spill_path=str(spill_path)
+    )
+
+    writer.put({"event": 0})
+    while writer.depth:
+        pass
+    writer.put({"event": 1})
+    writer.put({"event": 2, "timestamp": datetime(2017, 1, 1)})
+
+    (segment,) = spill_path.listdir()
+    spilled = [json.loads(line) for line in segment.readlines()]
+    assert spilled == [{"event": 2, "timestamp": "2017-01-01T00:00:00"}]
+    assert writer.counters["spilled"] == 1
+
+    db.release.set()
+    writer.flush()
+
+    assert [data["event"] for data in db.written] == [0, 1, 2]
+    assert spill_path.listdir() == []
+    writer.close()
+
+
+def test_background_writer_keeps_spill(tmpdir):
+    """Spilled events that can't be written yet are kept until the database is back."""
+
+    class DownDatabase(SlowDatabase):
+        def write_batch(self, events):
+            if not self.release.is_set():
+                raise IOError("database unavailable")
+            self.written.extend(events)
+
+    db = DownDatabase()
+    writer = BackgroundWriter(
+        db.write_batch,
+        queue_size=1,
+        batch_size=1,
+        backpressure="spill",
+        spill_path=str(tmpdir.join("spill")),
+        retry_on=IOError,
+    )
+
+    for i in range(50):
+        writer.put({"event": i})
+    writer.flush()
+    spilled = writer.counters["spilled"]
+    assert spilled > 0
+    assert writer.counters["failed"] == 50 - spilled
+
+    db.release.set()
+    writer.flush()
+    assert len(db.written) == spilled
+    assert writer.counters["written"] == spilled
+    writer.close()
+
+
+def test_background_writer_replays_spill(tmpdir):
+    """Spilled events are written by the worker once the queue has room, without a flush."""
+
+    db = SlowDatabase()
+    spill_path = tmpdir.join("spill")
+    writer = BackgroundWriter(
+        db.write_batch, queue_size=1, batch_size=1, backpressure="spill", spill_path=str(spill_path)
+    )
+
+    writer.put({"event": 0})
+    while writer.depth:
+        pass
+    for i in range(1, 4):
+        writer.put({"event": i})
+    assert writer.counters["spilled"] == 2
+
+    db.release.set()
+    deadline = time.time() + 5
+    while len(db.written) < 4 and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert sorted(data["event"] for data in db.written) == [0, 1, 2, 3]
+    assert spill_path.listdir() == []
+    writer.close()
+
+
+def test_background_writer_options():
+    """Invalid backpressure settings are rejected."""
+
+    with pytest.raises(ValueError):
+        BackgroundWriter(lambda events: None, backpressure="panic")
+    with pytest.raises(ValueError):
+        BackgroundWriter(lambda events: None, backpressure="spill")